@@ -0,0 +1,306 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import resource
+import tracemalloc
+import contextlib
+import subprocess
+from datetime import datetime
+from dotenv import load_dotenv
+
+load_dotenv()
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(APP_DIR)
+# strategic_pipeline.py と同じく、app/ を基準に services をインポートする
+sys.path.insert(0, APP_DIR)
+
+from services.strategic_log_generator import generate_strategic_logs
+from services.category_discovery_agent import CategoryDiscoveryAgent
+from services.classification_agent import ClassificationAgent
+from services.log_stream import iter_log_batches
+from services.stand_in_models import StandInEmbeddings, StandInChatModel
+from strategic_pipeline import StrategicPipeline
+
+DEFAULT_SIZES = "1000,10000,100000"
+DEFAULT_OUTPUT_DIR = os.getenv("BENCHMARK_OUTPUT_DIR", os.path.join(PROJECT_DIR, "data", "benchmarks"))
+# 生成するログのタイムスタンプの基準時刻 (シードと合わせて、毎回同じコーパスにする)
+CORPUS_BASE_TIME = datetime(2025, 1, 1)
+RESULT_FORMAT_VERSION = 1
+
+
+def _max_rss_mb():
+    """プロセスの最大常駐メモリ (Linuxは KB、macOSは バイト単位で返る)"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+
+
+class StageRecorder:
+    """ステージごとの所要時間・スループット・ピークメモリを計測して記録する
+
+    ピークメモリは tracemalloc で計測した、そのステージ中のPythonとNumPyの割り当ての最大値。
+    tracemalloc は割り当てを遅くするため、trace_memory=False にすると時間だけを計測する。
+    """
+
+    def __init__(self, trace_memory=True, verbose=False):
+        self.trace_memory = trace_memory
+        self.verbose = verbose
+        self.stages = []
+
+    def measure(self, name, events, fn):
+        if self.trace_memory:
+            tracemalloc.start()
+        output = io.StringIO()
+        started = time.perf_counter()
+        try:
+            # パイプラインやエージェントの進捗表示は、verbose でなければ結果の表示に混ぜない
+            with contextlib.redirect_stdout(sys.stdout if self.verbose else output):
+                value = fn()
+        finally:
+            seconds = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+            if self.trace_memory:
+                tracemalloc.stop()
+
+        stage = {
+            "stage": name,
+            "events": events,
+            "seconds": seconds,
+            "events_per_second": events / seconds if seconds > 0 else None,
+            "peak_memory_mb": peak / (1024 * 1024) if peak is not None else None,
+            "max_rss_mb": _max_rss_mb()
+        }
+        self.stages.append(stage)
+        memory = f", peak {stage['peak_memory_mb']:.1f} MB" if peak is not None else ""
+        print(f"  {name}: {seconds:.3f}s ({stage['events_per_second'] or 0:.0f} events/s{memory})")
+        return value
+
+
+def _stand_in_models(args):
+    embeddings = StandInEmbeddings(
+        n_features=args.embedding_dimensions,
+        batch_size=args.embedding_batch_size,
+        latency_ms=args.embedding_latency_ms
+    )
+    llm = StandInChatModel(latency_ms=args.llm_latency_ms, latency_per_1k_chars_ms=args.llm_latency_per_1k_chars_ms)
+    return embeddings, llm
+
+
+def benchmark_strategic_loop(size, args, work_dir):
+    """size 件のコーパスを生成し、発見・分類・パイプライン全体をスタンドインのモデルで計測する"""
+    print(f"\n--- {size} events ---")
+    recorder = StageRecorder(args.trace_memory, args.verbose)
+    logs_dir = os.path.join(work_dir, "raw_event_logs")
+    discovery_options = {"k_selection": args.k_selection, "sample_size": args.discovery_sample_size}
+
+    recorder.measure("generate_corpus", size, lambda: generate_strategic_logs(
+        logs_dir, size, output_format="ndjson", seed=args.seed, base_time=CORPUS_BASE_TIME,
+        shard_size=args.shard_size, compress=args.compress
+    ))
+
+    embeddings, llm = _stand_in_models(args)
+    discovery_agent = recorder.measure("discovery_load", size, lambda: CategoryDiscoveryAgent(
+        logs_dir=logs_dir, embedding_model=embeddings, llm=llm, **discovery_options
+    ))
+    discovered = len(discovery_agent.logs)
+    result = recorder.measure("discovery", discovered, discovery_agent.discover_categories)
+    del discovery_agent
+
+    if result is not None:
+        classification_agent = ClassificationAgent(result.category_centroids(), embedding_model=embeddings)
+
+        def classify_all():
+            for batch in iter_log_batches(logs_dir, args.batch_size or 10000):
+                classification_agent.classify_many(batch)
+        recorder.measure("classification", size, classify_all)
+
+    embeddings, llm = _stand_in_models(args)
+    pipeline = StrategicPipeline(
+        base_dir=work_dir, batch_size=args.batch_size or None, discovery_options=discovery_options,
+        embedding_model=embeddings, llm=llm
+    )
+    recorder.measure("pipeline", size, pipeline.run)
+
+    return {
+        "events": size,
+        "categories": len(result.categories) if result is not None else 0,
+        "stages": recorder.stages,
+        # パイプライン全体のステージで呼び出した回数
+        "pipeline_llm_calls": llm.calls,
+        "pipeline_llm_prompt_chars": llm.prompt_chars,
+        "pipeline_embedded_texts": embeddings.texts
+    }
+
+
+def benchmark_api(args, work_dir):
+    """スタンドインのモデルで構築した推論エンジンを差し込み、/events/ のハンドラを計測する"""
+    print(f"\n--- API ({args.api_requests} requests) ---")
+    os.makedirs(work_dir, exist_ok=True)
+    # app.main のインポート前に、一時的なDBとナレッジインデックスを指定する
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(work_dir, 'benchmark.db')}"
+    os.environ["KNOWLEDGE_INDEX_DIR"] = os.path.join(work_dir, "knowledge_index")
+    os.environ["INFERENCE_WARMUP"] = "lazy"
+    sys.path.insert(0, PROJECT_DIR)
+    previous_dir = os.getcwd()
+    os.chdir(PROJECT_DIR) # 推論エンジンはナレッジベースを PoC_Sandbox からの相対パスで読む
+    try:
+        from fastapi.testclient import TestClient
+        import app.main as api
+        from app.services.event_generator import generate_dummy_event
+        from app.services.inference_engine import InferenceEngine
+        from app.services.stand_in_models import StandInEmbeddings as ApiEmbeddings, StandInChatModel as ApiChatModel
+
+        recorder = StageRecorder(args.trace_memory, args.verbose)
+        embeddings = ApiEmbeddings(n_features=args.embedding_dimensions, latency_ms=args.embedding_latency_ms)
+        llm = ApiChatModel(latency_ms=args.llm_latency_ms, latency_per_1k_chars_ms=args.llm_latency_per_1k_chars_ms)
+        engine = recorder.measure("engine_build", 0, lambda: InferenceEngine(
+            llm=llm, embeddings=embeddings, embedding_model_name=embeddings.model_name
+        ))
+        api.inference_loader.install(engine)
+
+        rng = random.Random(args.seed)
+        events = [generate_dummy_event(rng) for _ in range(args.api_requests)]
+        with TestClient(api.app) as client:
+            def post_events():
+                for event in events:
+                    client.post("/events/", json=event).raise_for_status()
+            recorder.measure("post_events", len(events), post_events)
+
+            def page_events():
+                cursor = None
+                while True:
+                    params = {"limit": 500, **({"cursor": cursor} if cursor else {})}
+                    page = client.get("/events/page", params=params).json()
+                    cursor = page["next_cursor"]
+                    if not cursor:
+                        return
+            recorder.measure("page_events", len(events), page_events)
+            recorder.measure("export_events", len(events),
+                             lambda: client.get("/events/export", params={"include_inference": "true"}).raise_for_status())
+        return {"requests": len(events), "stages": recorder.stages, "tiers": engine.tier_stats(), "llm_calls": llm.calls}
+    finally:
+        os.chdir(previous_dir)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=APP_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _environment():
+    import numpy
+    import sklearn
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": numpy.__version__,
+        "scikit-learn": sklearn.__version__
+    }
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """同じ件数・同じステージの所要時間が、ベースラインより tolerance の割合を超えて遅くなったものを返す"""
+    def index(report):
+        stages = {}
+        for run in report.get("runs", []):
+            for stage in run["stages"]:
+                stages[(f"{run['events']} events", stage["stage"])] = stage["seconds"]
+        api = report.get("api") or {}
+        for stage in api.get("stages", []):
+            stages[(f"api {api['requests']} requests", stage["stage"])] = stage["seconds"]
+        return stages
+
+    current, previous = index(results), index(baseline)
+    regressions = []
+    for key, seconds in current.items():
+        base = previous.get(key)
+        if base and seconds > base * (1 + tolerance):
+            regressions.append({"run": key[0], "stage": key[1], "baseline_seconds": base,
+                                "seconds": seconds, "slowdown": seconds / base})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="スタンドインのモデルで戦略ループと戦術ループの性能を計測する (外部APIは呼ばない)")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="コーパスの件数 (カンマ区切り、例: 1000,10000,100000,1000000)")
+    parser.add_argument("--seed", type=int, default=42, help="コーパスとイベントの生成に使うシード")
+    parser.add_argument("--shard-size", type=int, default=100000, help="NDJSONシャード1つあたりのログ数")
+    parser.add_argument("--compress", action="store_true", help="シャードをgzipで圧縮する")
+    parser.add_argument("--batch-size", type=int, default=10000, help="パイプラインのストリーム処理の件数 (0 なら全件をメモリで処理)")
+    parser.add_argument("--k-selection", choices=["exhaustive", "fast"], default="fast", help="発見ステップのkの選び方")
+    parser.add_argument("--discovery-sample-size", type=int, default=None, help="発見ステップで使うログの件数 (省略時は全件)")
+    parser.add_argument("--embedding-dimensions", type=int, default=256, help="スタンドインの埋め込みの次元数")
+    parser.add_argument("--embedding-batch-size", type=int, default=100, help="スタンドインの埋め込みの1回あたりの件数")
+    parser.add_argument("--embedding-latency-ms", type=float, default=0.0, help="埋め込みの呼び出し1回あたりの待ち時間")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="LLMの呼び出し1回あたりの待ち時間")
+    parser.add_argument("--llm-latency-per-1k-chars-ms", type=float, default=0.0, help="プロンプト1000文字あたりの追加の待ち時間")
+    parser.add_argument("--api-requests", type=int, default=1000, help="POST /events/ を送る回数 (0 ならAPIは計測しない)")
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false",
+                        help="ピークメモリを計測しない (tracemalloc による速度低下を避ける)")
+    parser.add_argument("--output", default=None, help="結果のJSONの保存先 (省略時は data/benchmarks/ に日時付きで保存)")
+    parser.add_argument("--baseline", default=None, help="比較するベースラインの結果のJSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="ベースラインより遅くなってもよい割合")
+    parser.add_argument("--keep-data", action="store_true", help="生成したコーパスと出力を削除しない")
+    parser.add_argument("--verbose", action="store_true", help="パイプラインの進捗表示も出力する")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    results = {
+        "format_version": RESULT_FORMAT_VERSION,
+        "created_at": datetime.now().isoformat(),
+        "git_commit": _git_commit(),
+        "environment": _environment(),
+        "config": vars(args),
+        "runs": [],
+        "api": None
+    }
+
+    work_root = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        for size in sizes:
+            work_dir = os.path.join(work_root, f"corpus_{size}")
+            results["runs"].append(benchmark_strategic_loop(size, args, work_dir))
+            if not args.keep_data:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        if args.api_requests:
+            results["api"] = benchmark_api(args, os.path.join(work_root, "api"))
+    finally:
+        if args.keep_data:
+            print(f"\nBenchmark data kept in {work_root}")
+        else:
+            shutil.rmtree(work_root, ignore_errors=True)
+
+    output_path = args.output or os.path.join(DEFAULT_OUTPUT_DIR, f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        results["baseline"] = {"path": args.baseline, "tolerance": args.tolerance, "regressions": regressions}
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\nBenchmark results saved to {output_path}")
+
+    for regression in regressions:
+        print(f"Regression in {regression['run']} / {regression['stage']}: "
+              f"{regression['seconds']:.3f}s vs {regression['baseline_seconds']:.3f}s ({regression['slowdown']:.2f}x)")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
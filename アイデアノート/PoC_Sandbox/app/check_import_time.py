@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# app.main のインポートにかけてよい時間 (ミリ秒)
+DEFAULT_IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "1500"))
+
+# 新しいプロセスで app.main をインポートし、所要時間と推論エンジンの状態を出力する
+MEASURE_SCRIPT = """
+import sys, json, time
+started = time.perf_counter()
+import app.main
+elapsed_ms = (time.perf_counter() - started) * 1000
+print(json.dumps({
+    "import_ms": elapsed_ms,
+    "engine_state": app.main.inference_loader.state,
+    "engine_module_imported": "app.services.inference_engine" in sys.modules,
+    "langchain_imported": any(name.split(".")[0].startswith("langchain") for name in sys.modules)
+}))
+"""
+
+
+def measure_import_time(runs=3):
+    """app.main のインポート時間を別プロセスで runs 回計測し、最も速かった回の結果を返す"""
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    # インポートでリポジトリのDBに触れないように、一時的なDBを指定する
+    with tempfile.TemporaryDirectory() as work_dir:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(work_dir, 'import_check.db')}")
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, "-c", MEASURE_SCRIPT],
+                cwd=project_dir, env=env, capture_output=True, text=True, check=True
+            ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+    return min(results, key=lambda result: result["import_ms"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="APIサーバーのインポート時間が予算内に収まっているかを確認する")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_IMPORT_TIME_BUDGET_MS,
+                        help="app.main のインポートにかけてよい時間 (ミリ秒)")
+    parser.add_argument("--runs", type=int, default=3, help="計測の回数 (最も速かった回で判定する)")
+    args = parser.parse_args()
+
+    result = measure_import_time(args.runs)
+    print(json.dumps({**result, "budget_ms": args.budget_ms}, indent=2))
+
+    failures = []
+    if result["import_ms"] > args.budget_ms:
+        failures.append(f"Importing app.main took {result['import_ms']:.0f} ms (budget {args.budget_ms:.0f} ms).")
+    if result["engine_state"] != "cold" or result["engine_module_imported"]:
+        failures.append("The inference engine was initialized at import time.")
+    if result["langchain_imported"]:
+        failures.append("LangChain was imported at import time.")
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+    print("Import time is within budget.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -10,12 +10,57 @@ load_dotenv()
 # PoCでは、ファイルベースのSQLiteを使用します。
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./poc_database.db")
 
+# 書き込みモード。"production" にすると、SQLiteをWALモードで使い、接続プールを設定し、
+# イベントの記録を1つの書き込みスレッドにまとめてグループコミットする (app/services/event_writer.py)
+DATABASE_MODE = os.getenv("DATABASE_MODE", "default")
+PRODUCTION_MODE = DATABASE_MODE == "production"
+
+engine_options = {}
+if PRODUCTION_MODE:
+    engine_options.update(
+        pool_size=int(os.getenv("DATABASE_POOL_SIZE", "10")),
+        max_overflow=int(os.getenv("DATABASE_MAX_OVERFLOW", "20")),
+        pool_pre_ping=True
+    )
+
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     # SQLiteを使用する場合、複数のスレッドで同じ接続を共有できないため、
     # connect_args={"check_same_thread": False} が必要です。
-    connect_args={"check_same_thread": False}
+    connect_args={"check_same_thread": False},
+    **engine_options
 )
+
+if PRODUCTION_MODE and SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """接続ごとにWALモードと書き込み向けの設定を有効にする"""
+        cursor = dbapi_connection.cursor()
+        # 読み取りが書き込みをブロックせず、コミットごとのジャーナル全体のfsyncも不要になる
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # WALでは NORMAL でもアプリのクラッシュではデータを失わない (電源断で直近のコミットを失う可能性はある)
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # ロックの競合時にすぐ失敗せず、指定ミリ秒まで待つ
+        cursor.execute(f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))}")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA wal_autocheckpoint=10000")
+        cursor.close()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base() 
\ No newline at end of file
+Base = declarative_base() 
+
+def add_missing_columns(table):
+    """
+    モデルに後から追加した列を、既存のテーブルに ALTER TABLE で追加する (create_all は既存のテーブルを変更しない)。
+    追加できるのは NULL を許容する列だけで、既存の行の値は NULL になる。
+    """
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+    missing = [column for column in table.columns if column.name not in existing]
+    if not missing:
+        return []
+    with engine.begin() as connection:
+        for column in missing:
+            column_type = column.type.compile(dialect=engine.dialect)
+            connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+    return [column.name for column in missing]
@@ -0,0 +1,411 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(APP_DIR)
+
+DEFAULT_OUTPUT_DIR = os.getenv("LOAD_TEST_OUTPUT_DIR", os.path.join(PROJECT_DIR, "data", "load_tests"))
+DEFAULT_MIX = "post_event=4,generate_and_process=1,list_events=2"
+RESULT_FORMAT_VERSION = 2
+
+# エンドポイント名 -> (メソッド, パス, リクエストごとの引数を作る関数)
+ENDPOINTS = {
+    "post_event": ("POST", "/events/", lambda rng, generate: {"json": generate(rng)}),
+    "post_event_async": ("POST", "/events/async/", lambda rng, generate: {"json": generate(rng)}),
+    "generate_and_process": ("POST", "/events/generate_and_process/", lambda rng, generate: {}),
+    "list_events": ("GET", "/events/", lambda rng, generate: {"params": {"limit": 100}}),
+    "page_events": ("GET", "/events/page", lambda rng, generate: {"params": {"limit": 100}}),
+}
+
+
+def parse_mix(mix):
+    """"post_event=4,list_events=1" を [(エンドポイント名, 重み), ...] にする"""
+    weights = []
+    for item in mix.split(","):
+        if not item.strip():
+            continue
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"Unknown endpoint '{name}' in --mix (choose from {', '.join(ENDPOINTS)})")
+        weights.append((name, float(weight or 1)))
+    if not weights:
+        raise ValueError("--mix must name at least one endpoint")
+    return weights
+
+
+class LatencyRecorder:
+    """エンドポイントごとのレイテンシ・ステータスコード・エラーを集める"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = Counter()
+
+    def record(self, endpoint, seconds, status):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        self.statuses.setdefault(endpoint, Counter())[str(status)] += 1
+        if not isinstance(status, int) or status >= 400:
+            self.errors[endpoint] += 1
+
+    def summary(self, duration):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            values = np.array(latencies) * 1000
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            endpoints[endpoint] = {
+                "requests": len(values),
+                "errors": self.errors[endpoint],
+                "statuses": dict(self.statuses[endpoint]),
+                "throughput_rps": len(values) / duration if duration > 0 else None,
+                "mean_ms": float(values.mean()),
+                "p50_ms": float(p50),
+                "p95_ms": float(p95),
+                "p99_ms": float(p99),
+                "max_ms": float(values.max())
+            }
+        return endpoints
+
+
+class SQLiteLockMonitor:
+    """SQLAlchemy のイベントで、SQLiteのロックによる待ちと失敗を数える (APIと同じプロセスで動かす場合のみ)
+
+    SQLiteはロックを取れないと busy_timeout の間内部で待つため、待ち時間そのものは取得できない。
+    そこで書き込み (INSERT / UPDATE / DELETE) とコミットのうち threshold_ms 以上かかったものをロック待ちとして数え、
+    待ちきれずに "database is locked" で失敗したものはエラーとして数える。
+    """
+
+    def __init__(self, engine, session_factory, threshold_ms=20.0):
+        self.engine = engine
+        self.session_factory = session_factory
+        self.threshold = threshold_ms / 1000
+        self.writes = 0
+        self.commits = 0
+        self.slow_writes = 0
+        self.slow_commits = 0
+        self.wait_seconds = 0.0
+        self.max_write_ms = 0.0
+        self.max_commit_ms = 0.0
+        self.lock_errors = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def install(self):
+        from sqlalchemy import event
+        event.listen(self.engine, "before_cursor_execute", self._before_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_execute)
+        event.listen(self.engine, "handle_error", self._handle_error)
+        event.listen(self.session_factory, "before_commit", self._before_commit)
+        event.listen(self.session_factory, "after_commit", self._after_commit)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._local.execute_started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:6].upper() not in ("INSERT", "UPDATE", "DELETE"):
+            return
+        seconds = time.perf_counter() - self._local.execute_started
+        with self._lock:
+            self.writes += 1
+            self.max_write_ms = max(self.max_write_ms, seconds * 1000)
+            if seconds >= self.threshold:
+                self.slow_writes += 1
+                self.wait_seconds += seconds
+
+    def _before_commit(self, session):
+        self._local.commit_started = time.perf_counter()
+
+    def _after_commit(self, session):
+        started = getattr(self._local, "commit_started", None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        self._local.commit_started = None
+        with self._lock:
+            self.commits += 1
+            self.max_commit_ms = max(self.max_commit_ms, seconds * 1000)
+            if seconds >= self.threshold:
+                self.slow_commits += 1
+                self.wait_seconds += seconds
+
+    def _handle_error(self, context):
+        message = str(context.original_exception).lower()
+        if "database is locked" in message or "database table is locked" in message:
+            with self._lock:
+                self.lock_errors += 1
+
+    def summary(self):
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "writes": self.writes,
+            "commits": self.commits,
+            "lock_waits": self.slow_writes + self.slow_commits,
+            "slow_writes": self.slow_writes,
+            "slow_commits": self.slow_commits,
+            "lock_wait_seconds": self.wait_seconds,
+            "max_write_ms": self.max_write_ms,
+            "max_commit_ms": self.max_commit_ms,
+            "lock_errors": self.lock_errors
+        }
+
+
+async def _send(client, recorder, endpoint, request_kwargs, started):
+    method, path, _ = ENDPOINTS[endpoint]
+    try:
+        response = await client.request(method, path, **request_kwargs)
+        status = response.status_code
+    except Exception as e:
+        status = type(e).__name__
+    recorder.record(endpoint, time.perf_counter() - started, status)
+
+
+async def closed_loop(client, recorder, args, choose, generate):
+    """concurrency 個のクライアントが、応答を受け取るたびに次のリクエストを送る"""
+    deadline = time.perf_counter() + args.duration
+    issued = 0
+
+    async def worker(worker_id):
+        nonlocal issued
+        rng = random.Random(args.seed * 1000 + worker_id)
+        while time.perf_counter() < deadline and (not args.requests or issued < args.requests):
+            issued += 1
+            endpoint = choose(rng)
+            await _send(client, recorder, endpoint, ENDPOINTS[endpoint][2](rng, generate), time.perf_counter())
+
+    await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+    return {"issued": issued, "queued": 0, "max_backlog": 0}
+
+
+async def open_loop(client, recorder, args, choose, generate):
+    """応答を待たずに、平均 rate 件/秒でリクエストを送る (到着間隔は指数分布、--uniform なら一定)
+
+    同時に処理中のリクエストが concurrency 件に達している間の到着は捨てずに待たせ、空きができた順に送る。
+    レイテンシは予定した送信時刻から測るため、サーバーが詰まって待った分も含まれる (coordinated omission を避ける)。
+    待たされた到着の数を queued、待ちの最大の長さを max_backlog として返す。
+    """
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    deadline = started + args.duration
+    scheduled = started
+    slots = asyncio.Semaphore(args.concurrency)
+    in_flight = set()
+    issued = queued = backlog = max_backlog = 0
+
+    async def send_when_free(endpoint, request_kwargs, scheduled_at, waiting):
+        nonlocal backlog
+        async with slots:
+            if waiting:
+                backlog -= 1
+            await _send(client, recorder, endpoint, request_kwargs, scheduled_at)
+
+    while scheduled < deadline and (not args.requests or issued < args.requests):
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        waiting = slots.locked()
+        if waiting:
+            queued += 1
+            backlog += 1
+            max_backlog = max(max_backlog, backlog)
+        endpoint = choose(rng)
+        task = asyncio.create_task(send_when_free(endpoint, ENDPOINTS[endpoint][2](rng, generate), scheduled, waiting))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+        issued += 1
+        scheduled += 1 / args.rate if args.uniform else rng.expovariate(args.rate)
+    if in_flight:
+        await asyncio.gather(*in_flight)
+    return {"issued": issued, "queued": queued, "max_backlog": max_backlog}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _configure_app(args, work_dir):
+    """一時的なDBで app.main をインポートし、指定された推論エンジンを差し込む"""
+    # app.main のインポート前に、DBと推論エンジンの構築方法を指定する
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(work_dir, 'load_test.db')}"
+    if args.database_mode:
+        os.environ["DATABASE_MODE"] = args.database_mode
+    os.environ["KNOWLEDGE_INDEX_DIR"] = os.path.join(work_dir, "knowledge_index")
+    if args.engine != "real":
+        os.environ["INFERENCE_WARMUP"] = "lazy"
+    sys.path.insert(0, PROJECT_DIR)
+    import app.main as api
+    from app.database import engine, SessionLocal
+    from app.services.stand_in_models import StandInInferenceEngine, StandInEmbeddings, StandInChatModel
+
+    if args.engine == "stub":
+        api.inference_loader.install(StandInInferenceEngine(
+            latency_ms=args.inference_latency_ms, jitter_ms=args.inference_jitter_ms, seed=args.seed
+        ))
+    elif args.engine == "stand-in":
+        from app.services.inference_engine import InferenceEngine
+        embeddings = StandInEmbeddings(latency_ms=args.embedding_latency_ms)
+        llm = StandInChatModel(latency_ms=args.inference_latency_ms)
+        api.inference_loader.install(InferenceEngine(llm=llm, embeddings=embeddings, embedding_model_name=embeddings.model_name))
+
+    monitor = SQLiteLockMonitor(engine, SessionLocal, args.lock_wait_threshold_ms)
+    monitor.install()
+    return api, monitor
+
+
+async def run_load(args, work_dir):
+    import httpx
+    from services.event_generator import generate_dummy_event
+
+    weights = parse_mix(args.mix)
+    names, cumulative = [name for name, _ in weights], np.cumsum([weight for _, weight in weights]).tolist()
+    choose = lambda rng: rng.choices(names, cum_weights=cumulative)[0]
+    run_loop = open_loop if args.mode == "open" else closed_loop
+    recorder = LatencyRecorder()
+    monitor = None
+    server = None
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    previous_dir = os.getcwd()
+    os.chdir(PROJECT_DIR) # 推論エンジンはナレッジベースを PoC_Sandbox からの相対パスで読む
+    try:
+        if args.url:
+            # 起動済みのサーバーに送る (推論エンジンの差し替えとロックの計測はできない)
+            client = httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout)
+            app_context = None
+        else:
+            api, monitor = _configure_app(args, work_dir)
+            if args.transport == "http":
+                import uvicorn
+                port = _free_port()
+                server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=port, log_level="warning"))
+                thread = threading.Thread(target=server.run, name="load-test-server", daemon=True)
+                thread.start()
+                while not server.started:
+                    await asyncio.sleep(0.05)
+                client = httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=args.timeout)
+                app_context = None
+            else:
+                # ASGIを直接呼ぶ (ネットワークを経由しないので、ハンドラとDBだけの性能になる)
+                client = httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://load-test",
+                                           timeout=args.timeout)
+                app_context = api.app.router.lifespan_context(api.app)
+
+        async with client:
+            if app_context is not None:
+                await app_context.__aenter__()
+            try:
+                print(f"Running {args.mode}-loop load test for {args.duration:.0f}s "
+                      f"({'rate ' + str(args.rate) + ' req/s, ' if args.mode == 'open' else ''}"
+                      f"concurrency {args.concurrency}, mix {args.mix})...")
+                started = time.perf_counter()
+                counts = await run_loop(client, recorder, args, choose, generate_dummy_event)
+                duration = time.perf_counter() - started
+            finally:
+                if app_context is not None:
+                    await app_context.__aexit__(None, None, None)
+    finally:
+        if server is not None:
+            server.should_exit = True
+        os.chdir(previous_dir)
+
+    endpoints = recorder.summary(duration)
+    total = sum(endpoint["requests"] for endpoint in endpoints.values())
+    return {
+        "duration_seconds": duration,
+        "requests": total,
+        "errors": sum(endpoint["errors"] for endpoint in endpoints.values()),
+        "throughput_rps": total / duration if duration > 0 else None,
+        **counts,
+        "endpoints": endpoints,
+        "sqlite": monitor.summary() if monitor is not None else None
+    }
+
+
+def print_report(result):
+    print(f"\n{result['requests']} requests in {result['duration_seconds']:.2f}s "
+          f"({result['throughput_rps']:.1f} req/s, {result['errors']} errors, "
+          f"{result['queued']} queued behind --concurrency, max backlog {result['max_backlog']})")
+    print(f"{'endpoint':<22}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, endpoint in result["endpoints"].items():
+        print(f"{name:<22}{endpoint['requests']:>9}{endpoint['errors']:>8}{endpoint['throughput_rps']:>9.1f}"
+              f"{endpoint['p50_ms']:>9.1f}{endpoint['p95_ms']:>9.1f}{endpoint['p99_ms']:>9.1f}{endpoint['max_ms']:>9.1f}")
+    if result["max_backlog"] > result["config"]["concurrency"]:
+        print(f"Warning: arrivals queued up to {result['max_backlog']} deep; the offered rate exceeds what the server "
+              f"sustains at concurrency {result['config']['concurrency']}, so latencies include queueing time.")
+    sqlite = result["sqlite"]
+    if sqlite is not None:
+        print(f"SQLite: {sqlite['lock_waits']} writes/commits >= {sqlite['threshold_ms']:.0f}ms (likely lock waits) "
+              f"({sqlite['slow_writes']} writes, {sqlite['slow_commits']} commits, {sqlite['lock_wait_seconds']:.2f}s), "
+              f"{sqlite['lock_errors']} lock errors, max write {sqlite['max_write_ms']:.1f}ms, "
+              f"max commit {sqlite['max_commit_ms']:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="イベントAPIに並行してリクエストを送り、エンドポイントごとのレイテンシを計測する")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed",
+                        help="closed: 応答を待ってから次を送る / open: 応答を待たずに一定の到着率で送る")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時に送るリクエスト数の上限 (closed ではクライアント数)")
+    parser.add_argument("--rate", type=float, default=100.0, help="open モードの平均到着率 (件/秒)")
+    parser.add_argument("--uniform", action="store_true", help="open モードの到着間隔を一定にする (省略時は指数分布)")
+    parser.add_argument("--duration", type=float, default=10.0, help="計測する秒数")
+    parser.add_argument("--requests", type=int, default=0, help="送るリクエスト数の上限 (0 なら duration まで)")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help=f"エンドポイントと重み ({', '.join(ENDPOINTS)} から選ぶ、例: {DEFAULT_MIX})")
+    parser.add_argument("--transport", choices=["asgi", "http"], default="asgi",
+                        help="asgi: アプリをプロセス内で直接呼ぶ / http: localhostでuvicornを起動して送る")
+    parser.add_argument("--url", default=None, help="起動済みのサーバーのURL (指定するとアプリを起動しない)")
+    parser.add_argument("--engine", choices=["stub", "stand-in", "real"], default="stub",
+                        help="stub: 待つだけの推論エンジン / stand-in: スタンドインのモデルでRAGを構築 / real: Gemini")
+    parser.add_argument("--inference-latency-ms", type=float, default=50.0, help="stub / stand-in の推論の待ち時間")
+    parser.add_argument("--inference-jitter-ms", type=float, default=0.0, help="stub の待ち時間に加える 0〜N ミリ秒の揺らぎ")
+    parser.add_argument("--embedding-latency-ms", type=float, default=0.0, help="stand-in の埋め込みの待ち時間")
+    parser.add_argument("--database-url", default=None, help="使うDB (省略時は一時ディレクトリのSQLite)")
+    parser.add_argument("--database-mode", choices=["default", "production"], default=None,
+                        help="DATABASE_MODE (production ならWALとグループコミット)")
+    parser.add_argument("--lock-wait-threshold-ms", type=float, default=20.0,
+                        help="この時間以上かかった書き込みとコミットをロック待ちとして数える")
+    parser.add_argument("--timeout", type=float, default=60.0, help="1リクエストのタイムアウト (秒)")
+    parser.add_argument("--seed", type=int, default=42, help="ペイロードと到着間隔の生成に使うシード")
+    parser.add_argument("--output", default=None, help="結果のJSONの保存先 (省略時は data/load_tests/ に日時付きで保存)")
+    args = parser.parse_args()
+
+    # services は app/ を基準にインポートする (strategic_pipeline.py と同じ)
+    sys.path.insert(0, APP_DIR)
+    work_dir = tempfile.mkdtemp(prefix="load_test_")
+    try:
+        result = {
+            "format_version": RESULT_FORMAT_VERSION,
+            "created_at": datetime.now().isoformat(),
+            "config": vars(args),
+            **asyncio.run(run_load(args, work_dir))
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print_report(result)
+
+    output_path = args.output or os.path.join(DEFAULT_OUTPUT_DIR, f"load-test-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\nLoad test results saved to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
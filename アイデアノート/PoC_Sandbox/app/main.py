@@ -1,21 +1,87 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from sqlalchemy.orm import Session
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Literal
+from datetime import datetime
+from contextlib import asynccontextmanager
+import asyncio
 import json
+import time
+import os
 
 from . import models, schemas
-from .database import SessionLocal, engine
-from .services import event_logger, event_generator
-from .services.inference_engine import inference_engine
+from .database import SessionLocal, engine, PRODUCTION_MODE, add_missing_columns
+from .services import event_logger, event_generator, metrics
+from .services.engine_loader import InferenceEngineLoader, DEFAULT_WARMUP_MODE
+from .services.inference_worker import InferenceWorkerPool
+from .services.event_writer import GroupCommitWriter
+from .services.online_classifier import OnlineClassifier, ONLINE_CLASSIFICATION_ENABLED
 
-# データベーステーブルを作成
-models.Base.metadata.create_all(bind=engine)
+def migrate_database():
+    """
+    テーブルを作成し、既存のDBに後から追加した列とインデックスを追加する。
+    インポートしただけでDBを変更しないように、起動時 (lifespan) に実行する。
+    """
+    models.Base.metadata.create_all(bind=engine)
+    # 既存のDBにも、後から追加した列を追加する (create_all は既存のテーブルを変更しない)
+    add_missing_columns(models.EventLog.__table__)
+    # 既存のDBにも、後から追加したインデックスを作成する (create_all は既存のテーブルには作らない)
+    for index in models.EventLog.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+# 一括登録で1リクエストに含められるイベント数の上限
+EVENT_BATCH_MAX_SIZE = int(os.getenv("EVENT_BATCH_MAX_SIZE", "10000"))
+# エクスポートで1回のクエリに取得する行数
+EVENT_EXPORT_CHUNK_SIZE = int(os.getenv("EVENT_EXPORT_CHUNK_SIZE", "1000"))
+
+# 推論エンジンはインポート時には構築せず、起動後のバックグラウンドまたは初回の推論で構築する
+inference_loader = InferenceEngineLoader()
+
+# 非同期モードの推論を実行するワーカープール
+inference_pool = InferenceWorkerPool(session_factory=SessionLocal, ask=inference_loader.ask)
+
+# 本番の書き込みモード (DATABASE_MODE=production) では、イベントの記録をグループコミットでまとめる
+event_writer = GroupCommitWriter(SessionLocal) if PRODUCTION_MODE else None
+
+# 取り込んだイベントを戦略ループのカテゴリの重心でマイクロバッチごとに分類する (ONLINE_CLASSIFICATION=true で有効)
+online_classifier = OnlineClassifier(SessionLocal)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await asyncio.to_thread(migrate_database)
+    if DEFAULT_WARMUP_MODE == "background":
+        inference_loader.start_warmup()
+    if event_writer is not None:
+        event_writer.start()
+    if ONLINE_CLASSIFICATION_ENABLED:
+        online_classifier.start()
+    await inference_pool.start()
+    yield
+    await inference_pool.stop()
+    await asyncio.to_thread(online_classifier.stop)
+    if event_writer is not None:
+        await asyncio.to_thread(event_writer.stop)
 
 app = FastAPI(
     title="動的知覚・推論システム PoC",
-    description="戦術ループの動作を検証するためのAPI"
+    description="戦術ループの動作を検証するためのAPI",
+    lifespan=lifespan
 )
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    """APIのレイテンシをルート (パスのテンプレート) ごとのヒストグラムに記録する"""
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.HTTP_REQUEST_DURATION.observe(
+        time.perf_counter() - started,
+        method=request.method,
+        route=route.path if route is not None else "unmatched",
+        status=response.status_code
+    )
+    return response
+
 # Dependency
 def get_db():
     db = SessionLocal()
@@ -24,73 +90,311 @@ def get_db():
     finally:
         db.close()
 
-@app.post("/events/", response_model=schemas.EventLogOut, tags=["Events"])
+def _log_event(db: Session, event: schemas.EventLogIn, status: str = "processed") -> models.EventLog:
+    """イベントを記録する。本番の書き込みモードではグループコミットのライターを経由する"""
+    if event_writer is None:
+        db_event = event_logger.validate_and_log_event(db=db, event=event, status=status)
+    else:
+        event_id = event_writer.write(event, status)
+        db_event = event_logger.get_event(db, event_id=event_id)
+    online_classifier.submit(db_event.id, event.event_type, event.raw_event)
+    return db_event
+
+def _ask_and_record(db: Session, inference_engine, db_event: models.EventLog) -> Dict[str, Any]:
+    """イベントに対する推論を実行し、結果とレイテンシを推論結果のテーブルに記録する
+
+    推論に失敗した場合は、非同期のワーカーと同じくイベントのステータスを error にしてから例外を送出する。
+    """
+    # JSON形式のraw_eventを文字列に変換してクエリとして渡す
+    query_str = json.dumps(db_event.raw_event, ensure_ascii=False, indent=2)
+    started = time.perf_counter()
+    try:
+        inference_result = inference_engine.ask(query_str)
+    except Exception as e:
+        event_logger.log_inference_result(
+            db, db_event.id, latency_ms=(time.perf_counter() - started) * 1000, error=str(e)
+        )
+        event_logger.update_event_status(db, db_event.id, "error")
+        raise
+    latency_ms = (time.perf_counter() - started) * 1000
+    event_logger.log_inference_result(db, db_event.id, inference_result, latency_ms=latency_ms)
+    return inference_result
+
+def _with_inference(db: Session, events: List[models.EventLog], include_inference: bool = True) -> List[schemas.EventWithInferenceOut]:
+    """イベントに最新の推論結果を付ける。include_inference=False なら推論結果は問い合わせない"""
+    results = event_logger.get_latest_inference_results(db, [event.id for event in events]) if include_inference else {}
+    items = []
+    for event in events:
+        item = schemas.EventWithInferenceOut.model_validate(event)
+        if event.id in results:
+            item.inference = schemas.InferenceResultOut.model_validate(results[event.id])
+        items.append(item)
+    return items
+
+def _get_inference_engine():
+    """推論エンジンを取得する (構築中なら完了を待つ)。構築に失敗した場合は 503 を返す"""
+    try:
+        return inference_loader.get()
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Inference engine is unavailable: {e}")
+
+@app.get("/health/ready", tags=["Health"])
+def read_readiness():
+    """
+    推論エンジンの準備状況 (cold / warming / ready / failed) を取得します。
+    準備ができていない間は 503 を返します。DBだけを使うエンドポイントは準備状況に関係なく利用できます。
+    """
+    status = inference_loader.status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+@app.post("/events/", response_model=schemas.EventWithInferenceOut, tags=["Events"])
 def create_event_and_get_inference(event: schemas.EventLogIn, db: Session = Depends(get_db)):
     """
     新しいイベントを記録し、そのイベントに対する推論（アクション提案）を取得します。
     """
+    inference_engine = _get_inference_engine()
+
     # 1. バリデーターとロガーを使ってイベントをDBに記録
-    db_event = event_logger.validate_and_log_event(db=db, event=event)
+    db_event = _log_event(db, event)
     
     # 2. 推論エンジンにイベント情報を渡してアクションを提案させる
-    #    JSON形式のraw_eventを文字列に変換してクエリとして渡す
-    query_str = json.dumps(db_event.raw_event, ensure_ascii=False, indent=2)
-    inference_result = inference_engine.ask(query_str)
-    
-    # 3. 推論結果をnotesフィールドに追記して更新（オプション）
-    notes_with_inference = (
-        f"Inference Result: {inference_result['answer']}\\n"
-        f"Source: {inference_result['source_documents']}"
-    )
-    db_event.notes = f"{db_event.notes or ''}\\n---\\n{notes_with_inference}"
-    db.commit()
-    db.refresh(db_event)
+    # 3. 推論結果を推論結果のテーブルに記録
+    _ask_and_record(db, inference_engine, db_event)
     
-    return db_event
+    return _with_inference(db, [db_event])[0]
 
 @app.post("/events/generate_and_process/", tags=["Events"])
 def generate_and_process_event(db: Session = Depends(get_db)):
     """
     ダミーのイベントを自動生成し、記録と推論を一度に行います。
     """
+    inference_engine = _get_inference_engine()
+
     # 1. ダミーイベントを生成
     dummy_event_data = event_generator.generate_dummy_event()
     event = schemas.EventLogIn(**dummy_event_data)
     
     # 2. イベントの記録と推論の実行
     #    (create_event_and_get_inference と同じロジックを再利用)
-    db_event = event_logger.validate_and_log_event(db=db, event=event)
-    query_str = json.dumps(db_event.raw_event, ensure_ascii=False, indent=2)
-    inference_result = inference_engine.ask(query_str)
-    
-    notes_with_inference = (
-        f"Inference Result: {inference_result['answer']}\\n"
-        f"Source: {inference_result['source_documents']}"
-    )
-    db_event.notes = f"{db_event.notes or ''}\\n---\\n{notes_with_inference}"
-    db.commit()
-    db.refresh(db_event)
+    db_event = _log_event(db, event)
+    inference_result = _ask_and_record(db, inference_engine, db_event)
     
     return {
         "processed_event": schemas.EventLogOut.from_orm(db_event),
         "inference": inference_result
     }
 
+@app.post("/events/batch", response_model=schemas.EventBatchOut, tags=["Events"])
+def create_events_batch(events: List[schemas.EventLogIn], db: Session = Depends(get_db)):
+    """
+    複数のイベントを1つのトランザクションでまとめて記録し、採番されたIDを返します。
+    推論は行いません。
+    """
+    if len(events) > EVENT_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Too many events in one batch (max {EVENT_BATCH_MAX_SIZE})."
+        )
+    try:
+        event_ids = event_logger.validate_and_log_events_bulk(db, events)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    for event_id, event in zip(event_ids, events):
+        online_classifier.submit(event_id, event.event_type, event.raw_event)
+    return {"ids": event_ids, "count": len(event_ids)}
+
+async def _enqueue_event(db: Session, event: schemas.EventLogIn) -> models.EventLog:
+    """イベントを pending として記録し、推論をワーカープールに任せる"""
+    # 記録する前に空きを確認し、受け付けられないイベントはDBに残さない
+    if inference_pool.is_full():
+        raise HTTPException(
+            status_code=503,
+            detail="Inference queue is full. Retry later.",
+            headers={"Retry-After": "1"}
+        )
+    # DBへの書き込みと読み込みはブロッキングなので、イベントループを止めないようにスレッドで実行する
+    if event_writer is None:
+        db_event = await asyncio.to_thread(event_logger.validate_and_log_event, db=db, event=event, status="pending")
+    else:
+        # コミットを待つ間もイベントループを止めず、他のリクエストと同じバッチで記録されるようにする
+        event_id = await asyncio.wrap_future(event_writer.submit(event, "pending"))
+        db_event = await asyncio.to_thread(event_logger.get_event, db, event_id=event_id)
+    online_classifier.submit(db_event.id, event.event_type, event.raw_event)
+    if not inference_pool.submit(db_event.id):
+        # 記録を待つ間にキューが満杯になった場合は、処理されない pending を残さずに rejected として 503 を返す
+        await asyncio.to_thread(event_logger.update_event_status, db, db_event.id, "rejected")
+        raise HTTPException(
+            status_code=503,
+            detail="Inference queue is full. Retry later.",
+            headers={"Retry-After": "1"}
+        )
+    return db_event
 
-@app.get("/events/", response_model=List[schemas.EventLogOut], tags=["Events"])
-def read_events(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+@app.post("/events/async/", response_model=schemas.EventLogOut, status_code=202, tags=["Events"])
+async def create_event_async(event: schemas.EventLogIn, db: Session = Depends(get_db)):
+    """
+    新しいイベントを記録して即座に応答し、推論はバックグラウンドで実行します。
+    推論の完了は GET /events/{event_id}/status で確認できます。
+    """
+    return await _enqueue_event(db, event)
+
+@app.post("/events/generate_and_process/async/", response_model=schemas.EventLogOut, status_code=202, tags=["Events"])
+async def generate_and_process_event_async(db: Session = Depends(get_db)):
+    """
+    ダミーのイベントを自動生成して記録し、推論はバックグラウンドで実行します。
+    """
+    event = schemas.EventLogIn(**event_generator.generate_dummy_event())
+    return await _enqueue_event(db, event)
+
+@app.get("/database/writer", tags=["Database"])
+def read_database_writer():
+    """
+    グループコミットの書き込みスレッドの統計 (バッチ数、平均バッチサイズなど) を取得します。
+    """
+    if event_writer is None:
+        return {"mode": "default"}
+    return {"mode": "production", **event_writer.stats()}
+
+@app.get("/events/classification", tags=["Events"])
+def read_online_classification():
+    """
+    取り込み時の分類の状態 (読み込んだカテゴリ、分類・未分類の件数) と、直近の未分類の割合、再発見の起動状況を取得します。
+    """
+    return online_classifier.stats()
+
+@app.get("/inference/cache", tags=["Inference"])
+def read_inference_cache():
+    """
+    推論結果キャッシュのヒット率などの統計を取得します。
+    """
+    inference_engine = inference_loader.peek()
+    if inference_engine is None:
+        raise HTTPException(status_code=503, detail="Inference engine is not ready.", headers={"Retry-After": "1"})
+    if inference_engine.cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **inference_engine.cache.stats()}
+
+@app.get("/inference/tiers", tags=["Inference"])
+def read_inference_tiers():
+    """
+    段階的推論 (キャッシュ / マニュアルの検索のみ / LLM) のそれぞれで応答した件数と、LLMを呼ばずに済んだ割合を取得します。
+    """
+    inference_engine = inference_loader.peek()
+    if inference_engine is None:
+        raise HTTPException(status_code=503, detail="Inference engine is not ready.", headers={"Retry-After": "1"})
+    return inference_engine.tier_stats()
+
+@app.post("/inference/knowledge/reload", tags=["Inference"])
+def reload_knowledge():
+    """
+    ナレッジベースの追加・変更をインデックスに反映します。変更のあった文書だけを再ベクトル化します。
+    """
+    return _get_inference_engine().reload_knowledge()
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["Health"])
+def read_metrics():
+    """
+    処理ステージ (埋め込み、KMeans、分類、LLM、検索、DBコミット) とAPIのレイテンシを、
+    Prometheus のテキスト形式のカウンタとヒストグラムで取得します。
+    """
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/inference/queue", tags=["Inference"])
+def read_inference_queue():
+    """
+    非同期推論のワーカープールの状態を取得します。
+    """
+    return inference_pool.stats()
+
+
+@app.get("/events/", response_model=List[schemas.EventWithInferenceOut], tags=["Events"])
+def read_events(skip: int = 0, limit: int = 100, include_inference: bool = False, db: Session = Depends(get_db)):
     """
     記録されたイベントのリストを取得します。
+    include_inference=true を指定すると、各イベントの最新の推論結果を含めます。
     """
     events = event_logger.get_events(db, skip=skip, limit=limit)
-    return events
+    return _with_inference(db, events, include_inference)
+
+@app.get("/events/page", response_model=schemas.EventPageOut, tags=["Events"])
+def read_events_page(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    event_type: Optional[str] = None,
+    status: Optional[str] = None,
+    category: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    order: Literal["asc", "desc"] = "desc",
+    include_inference: bool = False,
+    db: Session = Depends(get_db)
+):
+    """
+    イベントを (timestamp, id) の順にページ単位で取得します。
+    レスポンスの next_cursor を次のリクエストの cursor に渡すと続きを取得できます (深いページでも速度が落ちません)。
+    event_type / status / category (取り込み時の分類) / 時間範囲 (start 以上 end 未満) で絞り込めます。
+    include_inference=true を指定すると、各イベントの最新の推論結果を含めます。
+    """
+    try:
+        events, next_cursor = event_logger.get_events_page(
+            db, limit=limit, cursor=cursor, event_type=event_type,
+            status=status, start=start, end=end, order=order, category=category
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"items": _with_inference(db, events, include_inference), "next_cursor": next_cursor}
+
+@app.get("/events/export", tags=["Events"])
+def export_events(
+    event_type: Optional[str] = None,
+    status: Optional[str] = None,
+    category: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    include_inference: bool = False
+):
+    """
+    条件に合うイベントを古い順にNDJSON (1行1イベント) でストリーミング出力します。
+    サーバーは一定件数ずつDBから読み出して送信するため、全件をメモリに載せません。
+    include_inference=true を指定すると、各イベントの最新の推論結果を含めます。
+    """
+    def generate():
+        # レスポンスの送信中もセッションを使うため、リクエストの依存関係とは別にセッションを開く
+        db = SessionLocal()
+        try:
+            for events in event_logger.iter_events(
+                db, chunk_size=EVENT_EXPORT_CHUNK_SIZE, event_type=event_type,
+                status=status, start=start, end=end, category=category
+            ):
+                yield "".join(
+                    item.model_dump_json() + "\n" for item in _with_inference(db, events, include_inference)
+                )
+        finally:
+            db.close()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+@app.get("/events/{event_id}", response_model=schemas.EventWithInferenceOut, tags=["Events"])
+def read_event(event_id: int, include_inference: bool = True, db: Session = Depends(get_db)):
+    """
+    特定のIDのイベントを、最新の推論結果と一緒に取得します。
+    """
+    db_event = event_logger.get_event(db, event_id=event_id)
+    if db_event is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    return _with_inference(db, [db_event], include_inference)[0]
 
-@app.get("/events/{event_id}", response_model=schemas.EventLogOut, tags=["Events"])
-def read_event(event_id: int, db: Session = Depends(get_db)):
+@app.get("/events/{event_id}/status", response_model=schemas.EventStatusOut, tags=["Events"])
+def read_event_status(event_id: int, db: Session = Depends(get_db)):
     """
-    特定のIDのイベントを取得します。
+    イベントの処理状況 (pending / processed / error / rejected) と、最新の推論結果を取得します。
     """
     db_event = event_logger.get_event(db, event_id=event_id)
     if db_event is None:
         raise HTTPException(status_code=404, detail="Event not found")
-    return db_event 
\ No newline at end of file
+    inference = event_logger.get_latest_inference_results(db, [event_id]).get(event_id)
+    return {
+        "id": db_event.id,
+        "status": db_event.status,
+        "inference": schemas.InferenceResultOut.model_validate(inference) if inference is not None else None
+    }
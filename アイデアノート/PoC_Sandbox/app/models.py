@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, JSON
+from sqlalchemy import Column, Integer, String, DateTime, JSON, Index, Float, Boolean, ForeignKey
 from sqlalchemy.sql import func
 from .database import Base
 
@@ -9,5 +9,36 @@ class EventLog(Base):
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     event_type = Column(String, index=True)
     raw_event = Column(JSON)
-    status = Column(String, default="processed") # "processed", "error", "pending"
-    notes = Column(String, nullable=True) 
\ No newline at end of file
+    status = Column(String, default="processed") # "processed", "error", "pending", "rejected"
+    notes = Column(String, nullable=True)
+    # 取り込み時に戦略ループの重心で分類した結果 (未分類は "unclassified"、分類前は NULL)
+    category = Column(String, nullable=True)
+    category_similarity = Column(Float, nullable=True)
+
+    __table_args__ = (
+        # (timestamp, id) のキーセットページングと時間範囲での絞り込み用
+        Index("ix_event_logs_timestamp_id", "timestamp", "id"),
+        # イベント種別で絞り込んだ一覧用
+        Index("ix_event_logs_event_type_timestamp_id", "event_type", "timestamp", "id"),
+        # ステータスで絞り込んだ一覧 (pending の再投入など) 用
+        Index("ix_event_logs_status_timestamp_id", "status", "timestamp", "id"),
+        # カテゴリで絞り込んだ一覧 (既知のインシデントの振り分けや未分類のイベントの確認) 用
+        Index("ix_event_logs_category_timestamp_id", "category", "timestamp", "id"),
+    )
+
+class InferenceResult(Base):
+    """イベントに対する推論の結果。イベント本体の行を小さく保つため、別のテーブルに記録する"""
+    __tablename__ = "inference_results"
+
+    id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(Integer, ForeignKey("event_logs.id"), index=True, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    answer = Column(String, nullable=True)
+    source_documents = Column(JSON, nullable=True) # 参照したマニュアルのパスのリスト
+    latency_ms = Column(Float, nullable=True) # 推論の呼び出しにかかった時間 (キャッシュからの応答を含む)
+    model = Column(String, nullable=True)
+    tier = Column(String, nullable=True) # "retrieval" / "llm"
+    cached = Column(Boolean, default=False)
+    similarity = Column(Float, nullable=True)
+    error = Column(String, nullable=True) # 推論に失敗した場合のエラー内容
+
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, ConfigDict
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 # ベースモデル
 class EventLogIn(BaseModel):
@@ -13,5 +13,45 @@ class EventLogOut(EventLogIn):
     id: int
     timestamp: datetime
     status: str
+    category: Optional[str] = None # 取り込み時の分類 (分類前は null)
+    category_similarity: Optional[float] = None
 
-    model_config = ConfigDict(from_attributes=True) 
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True) 
+
+# 推論結果
+class InferenceResultOut(BaseModel):
+    id: int
+    event_id: int
+    created_at: Optional[datetime] = None
+    answer: Optional[str] = None
+    source_documents: Optional[List[str]] = None
+    latency_ms: Optional[float] = None
+    model: Optional[str] = None
+    tier: Optional[str] = None
+    cached: bool = False
+    similarity: Optional[float] = None
+    error: Optional[str] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+# 最新の推論結果を含めたイベント (inference は含めない指定の場合や未推論の場合は null)
+class EventWithInferenceOut(EventLogOut):
+    inference: Optional[InferenceResultOut] = None
+
+# 非同期推論の進捗確認用のモデル
+class EventStatusOut(BaseModel):
+    id: int
+    status: str
+    inference: Optional[InferenceResultOut] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+# 一括登録の結果
+class EventBatchOut(BaseModel):
+    ids: List[int]
+    count: int
+
+# キーセットページングの結果 (next_cursor を次のリクエストの cursor に渡す)
+class EventPageOut(BaseModel):
+    items: List[EventWithInferenceOut]
+    next_cursor: Optional[str] = None
@@ -1,30 +1,67 @@
 import json
 import os
-import glob
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from sklearn.cluster import KMeans
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
+from threadpoolctl import threadpool_limits
+from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import PromptTemplate
 import numpy as np
 from dotenv import load_dotenv
+from .embedding_backends import get_embedding_model
+from .embedding_cache import embed_unique
+from .log_stream import sample_logs
+from . import metrics
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
+# fastモードで同時に評価するkの数の既定値。広げすぎると、肘が早く決まっても打ち切る前に不要なkまで学習してしまう
+K_SELECTION_WAVE_SIZE = int(os.getenv("K_SELECTION_WAVE_SIZE", "4"))
+
+@dataclass
+class DiscoveryResult:
+    """カテゴリ発見の結果と、その過程で計算したクラスタリングの成果物"""
+    categories: dict # {"category_1": {"name": ...}, ...}
+    unique_vectors: np.ndarray # 埋め込み用テキストの重複を除いたベクトル
+    inverse: np.ndarray # self.logs と同じ順序の、各ログに対応する unique_vectors の行番号
+    counts: np.ndarray # unique_vectors の各行に対応するログの件数
+    labels: np.ndarray # 各ログのクラスタ番号
+    centroids: np.ndarray # クラスタ番号順の重心 (k x 次元)
+    k: int
+    category_clusters: dict = field(default_factory=dict) # {"category_1": クラスタ番号, ...}
+
+    @property
+    def vectors(self):
+        """self.logs と同じ順序の埋め込みベクトル (ログ件数分の行列を作るので、大量のログでは unique_vectors を使う)"""
+        return self.unique_vectors[self.inverse]
+
+    def category_centroids(self):
+        """カテゴリIDごとの重心を返す (ClassificationAgentの入力形式)"""
+        return {cat_id: self.centroids[cluster] for cat_id, cluster in self.category_clusters.items()}
+
 class CategoryDiscoveryAgent:
-    def __init__(self, logs_dir="アイデアノート/PoC_Sandbox/data/raw_event_logs", max_clusters=10):
+    def __init__(self, logs_dir="アイデアノート/PoC_Sandbox/data/raw_event_logs", max_clusters=10,
+                 k_selection="exhaustive", k_sample_size=5000, k_n_jobs=None, k_warm_start=False, k_patience=3,
+                 sample_size=None, embedding_model=None, llm=None):
         self.logs_dir = logs_dir
         self.max_clusters = max_clusters # 試行する最大クラスタ数
-        self.embedding_model = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-        self.llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0) # 2.5-flashを利用
+        self.sample_size = sample_size # 指定した場合、全ログからこの件数だけをサンプリングして発見に使う
+        # kの選び方: "exhaustive" は全件で全kを順に試す従来方式、"fast" はサンプル上で並列に試し早期終了する
+        self.k_selection = k_selection
+        self.k_sample_size = k_sample_size # fastモードでkの評価に使う最大サンプル数
+        self.k_n_jobs = k_n_jobs or min(K_SELECTION_WAVE_SIZE, os.cpu_count() or 1) # fastモードで同時に評価するkの数
+        self.k_warm_start = k_warm_start # 直前のkの重心から初期化する (この場合kは順に評価する)
+        self.k_patience = k_patience # 肘の位置がこの数のk分だけ変わらなければ打ち切る
+        self.k_selection_report = None # 直近のk選択の結果 (選ばれたk、kごとのSSEと所要時間)
+        self.embedding_model = embedding_model or get_embedding_model() # EMBEDDING_BACKEND で選んだ実装
+        self.llm = llm or ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0) # 2.5-flashを利用
         self.logs = self._load_logs()
         
     def _load_logs(self):
-        log_files = glob.glob(os.path.join(self.logs_dir, "*.json"))
-        logs = []
-        for file in log_files:
-            with open(file, 'r', encoding='utf-8') as f:
-                logs.append(json.load(f))
-        return logs
+        # 1ファイル1ログのJSONとNDJSONシャードの両方を、ストリームとして読み込む
+        return sample_logs(self.logs_dir, self.sample_size)
 
     def _get_text_for_embedding(self, log):
         """ログからベクトル化に適したテキストを抽出・整形する"""
@@ -38,43 +75,164 @@ class CategoryDiscoveryAgent:
             text += f"Service: {log['service']}. "
         return text
 
-    def _find_optimal_k(self, vectors):
-        """エルボー法を用いて最適なクラスタ数(k)を決定する"""
+    @staticmethod
+    def _elbow_k(k_values, sse):
+        """SSEの2階差分が最大となるk (肘) を返す"""
+        if len(sse) < 3:
+            return k_values[0] # データが少ない場合は最小のk
+        deltas = np.diff(sse, 2) # 2階差分を取る
+        return k_values[np.argmax(deltas) + 1] # 差分が最大の点が肘
+
+    def _find_optimal_k(self, vectors, sample_weight=None):
+        """エルボー法を用いて最適なクラスタ数(k)を決定する
+
+        sample_weight を渡すと、各行をその件数分のログとみなしてクラスタリングする。
+        """
+        if self.k_selection == "fast":
+            return self._find_optimal_k_fast(vectors, sample_weight)
+
+        started = time.perf_counter()
         sse = []
-        k_range = range(2, self.max_clusters + 1) # 2クラスタから試行
+        timings = {}
+        k_range = range(2, min(self.max_clusters, len(vectors)) + 1) # 2クラスタから試行 (異なる点の数まで)
         for k in k_range:
-            kmeans = KMeans(n_clusters=k, random_state=42, n_init='auto').fit(vectors)
+            fit_started = time.perf_counter()
+            with metrics.span("kmeans_fit", items=len(vectors)):
+                kmeans = KMeans(n_clusters=k, random_state=42, n_init='auto').fit(vectors, sample_weight=sample_weight)
+            timings[k] = time.perf_counter() - fit_started
             sse.append(kmeans.inertia_) # inertia_はSSEを返す
 
         # SSEの減少率が最も大きい点を「肘」とする
-        if len(sse) < 2:
-            return 2 # データが少ない場合はデフォルト値
-
-        deltas = np.diff(sse, 2) # 2階差分を取る
-        optimal_k = k_range[np.argmax(deltas) + 1] # 差分が最大の点が肘
+        optimal_k = self._elbow_k(list(k_range), sse)
+        self.k_selection_report = {
+            "method": "exhaustive",
+            "optimal_k": optimal_k,
+            "sample_size": len(vectors),
+            "weighted_size": int(np.sum(sample_weight)) if sample_weight is not None else len(vectors),
+            "sse": dict(zip(k_range, sse)),
+            "timings": timings,
+            "stopped_early": False,
+            "total_seconds": time.perf_counter() - started
+        }
         print(f"Optimal number of clusters (k) found: {optimal_k}")
         return optimal_k
 
+    @staticmethod
+    def _fit_inertia(vectors, k, init=None, sample_weight=None):
+        """1つのkでKMeansを学習し、(SSE, 重心, 所要時間) を返す"""
+        started = time.perf_counter()
+        with metrics.span("kmeans_fit", items=len(vectors)):
+            if init is None:
+                kmeans = KMeans(n_clusters=k, random_state=42, n_init='auto').fit(vectors, sample_weight=sample_weight)
+            else:
+                kmeans = KMeans(n_clusters=k, init=init, n_init=1, random_state=42).fit(vectors, sample_weight=sample_weight)
+        return kmeans.inertia_, kmeans.cluster_centers_, time.perf_counter() - started
+
+    @staticmethod
+    def _warm_start_centers(vectors, previous_centers):
+        """直前のkの重心に、既存の重心から最も遠い点を1つ加えてk+1個の初期重心を作る"""
+        # |x - c|^2 = |x|^2 - 2x・c + |c|^2 で計算し、(サンプル数 x k x 次元) の中間配列を作らない
+        distances = (
+            (vectors ** 2).sum(axis=1)[:, None]
+            - 2 * vectors @ previous_centers.T
+            + (previous_centers ** 2).sum(axis=1)[None, :]
+        ).min(axis=1)
+        return np.vstack([previous_centers, vectors[np.argmax(distances)]])
+
+    def _find_optimal_k_fast(self, vectors, sample_weight=None):
+        """サンプル上でkを並列に評価し、肘の位置が安定したら打ち切る高速版のエルボー法"""
+        started = time.perf_counter()
+        vectors = np.asarray(vectors)
+        weights = np.ones(len(vectors), dtype=np.int64) if sample_weight is None else np.asarray(sample_weight)
+        if len(vectors) > self.k_sample_size:
+            # 重み付きの行を件数分のログとみなし、ログ単位で k_sample_size 件を非復元抽出する
+            rng = np.random.default_rng(42)
+            picked = rng.choice(int(weights.sum()), self.k_sample_size, replace=False)
+            rows, weights = np.unique(np.searchsorted(np.cumsum(weights), picked, side="right"), return_counts=True)
+            vectors = vectors[rows]
+
+        k_values = list(range(2, min(self.max_clusters, len(vectors)) + 1))
+        evaluated_k, sse, timings = [], [], {}
+        elbow, stable_for, stopped_early = None, 0, False
+        previous_centers = None
+
+        # 各KMeansはシングルスレッドにして、k_n_jobs 個のkを同時に評価する (k_patience による打ち切りはこの単位で判定する)
+        with threadpool_limits(limits=1), ThreadPoolExecutor(max_workers=self.k_n_jobs) as executor:
+            position = 0
+            while position < len(k_values):
+                if self.k_warm_start:
+                    # ウォームスタートは直前のkの結果に依存するため、kを1つずつ順に評価する
+                    wave = k_values[position:position + 1]
+                    init = None if previous_centers is None else self._warm_start_centers(vectors, previous_centers)
+                    results = [self._fit_inertia(vectors, wave[0], init, weights)]
+                    previous_centers = results[0][1]
+                else:
+                    wave = k_values[position:position + self.k_n_jobs]
+                    results = list(executor.map(lambda k: self._fit_inertia(vectors, k, sample_weight=weights), wave))
+                position += len(wave)
+
+                for k, (inertia, _, seconds) in zip(wave, results):
+                    evaluated_k.append(k)
+                    sse.append(inertia)
+                    timings[k] = seconds
+
+                    # 肘の候補が patience 個のk分だけ変わらなければ、肘は明確になったとみなす
+                    candidate = self._elbow_k(evaluated_k, sse) if len(sse) >= 3 else None
+                    if candidate is not None and candidate == elbow:
+                        stable_for += 1
+                    else:
+                        elbow, stable_for = candidate, 0
+                if elbow is not None and stable_for >= self.k_patience and position < len(k_values):
+                    stopped_early = True
+                    break
+
+        optimal_k = self._elbow_k(evaluated_k, sse)
+        self.k_selection_report = {
+            "method": "fast",
+            "optimal_k": optimal_k,
+            "sample_size": len(vectors),
+            "weighted_size": int(weights.sum()),
+            "sse": dict(zip(evaluated_k, sse)),
+            "timings": timings,
+            "stopped_early": stopped_early,
+            "total_seconds": time.perf_counter() - started
+        }
+        print(f"Optimal number of clusters (k) found: {optimal_k} "
+              f"(fast mode, evaluated k={evaluated_k[0]}..{evaluated_k[-1]} on {len(vectors)} samples)")
+        return optimal_k
+
     def discover_categories(self):
         """ログをクラスタリングし、新しいカテゴリ名をバッチ処理で一度に生成する"""
         if not self.logs or len(self.logs) < 2:
             print("Not enough logs to perform clustering.")
-            return {}
+            return None
 
+        # 同じテキストになるログは1回だけ埋め込み、件数を重みとしてユニークな行だけをクラスタリングする
         log_texts = [self._get_text_for_embedding(log) for log in self.logs]
-        vectors = self.embedding_model.embed_documents(log_texts)
-        
-        optimal_k = self._find_optimal_k(np.array(vectors))
-        kmeans = KMeans(n_clusters=optimal_k, random_state=42, n_init='auto').fit(vectors)
+        vectors, inverse, counts = embed_unique(self.embedding_model, log_texts)
+        print(f"Embedded {len(vectors)} distinct texts for {len(log_texts)} logs.")
+        if len(vectors) < 2:
+            print("Not enough distinct logs to perform clustering.")
+            return None
+
+        optimal_k = self._find_optimal_k(vectors, counts)
+        with metrics.span("kmeans_fit", items=len(vectors)):
+            kmeans = KMeans(n_clusters=optimal_k, random_state=42, n_init='auto').fit(vectors, sample_weight=counts)
+        unique_labels = kmeans.labels_
+        labels = unique_labels[inverse]
         
-        # 各クラスタのサンプルログを準備
+        # 各クラスタの重心 (件数で重み付けした平均 = 全ログの平均) と、プロンプト用のサンプルログを準備
+        centroids = np.zeros((optimal_k, vectors.shape[1]))
         cluster_samples_for_prompt = ""
         for i in range(optimal_k):
-            cluster_logs = [self.logs[j] for j, label in enumerate(kmeans.labels_) if label == i]
-            if not cluster_logs:
+            cluster_rows = np.where(unique_labels == i)[0]
+            if len(cluster_rows) == 0:
                 continue
+            centroids[i] = np.average(vectors[cluster_rows], axis=0, weights=counts[cluster_rows])
+            cluster_indices = np.where(labels == i)[0]
             
-            sample_logs_text = "\\n".join([json.dumps(log, ensure_ascii=False) for log in cluster_logs[:5]])
+            cluster_logs = [self.logs[j] for j in cluster_indices[:5]]
+            sample_logs_text = "\\n".join([json.dumps(log, ensure_ascii=False) for log in cluster_logs])
             cluster_samples_for_prompt += f"\\n--- Cluster {i+1} Samples ---\\n{sample_logs_text}\\n"
 
         prompt = PromptTemplate.from_template(
@@ -92,7 +250,8 @@ class CategoryDiscoveryAgent:
         chain = prompt | self.llm
         
         print(f"Generating names for {optimal_k} categories in a single batch...")
-        response_content = chain.invoke({"cluster_samples": cluster_samples_for_prompt}).content
+        with metrics.span("discovery_llm"):
+            response_content = chain.invoke({"cluster_samples": cluster_samples_for_prompt}).content
         
         try:
             # LLMの出力（文字列）をJSONとしてパース
@@ -105,13 +264,19 @@ class CategoryDiscoveryAgent:
             response = json.loads(response_content)
         except (json.JSONDecodeError, IndexError) as e:
             print(f"Error: Failed to decode LLM response as JSON. Error: {e}\\nResponse:\\n{response_content}")
-            return {}
+            return None
 
         # LLMの回答を整形して最終的な出力を作成
         discovered_categories = {}
+        category_clusters = {}
         for i, (key, value) in enumerate(response.items()):
             # keyが "cluster_1" や "category_1" のような形式を想定
-            new_key = f"category_{i+1}"
+            cluster_index = self._cluster_index_from_key(key, default=i, k=optimal_k)
+            if cluster_index is None or cluster_index in category_clusters.values():
+                print(f"Warning: Skipping category {key} with no matching cluster.")
+                continue
+            new_key = f"category_{len(discovered_categories)+1}"
+            category_clusters[new_key] = cluster_index
             # valueがカテゴリ名そのものであるか、辞書に含まれているかを考慮
             if isinstance(value, dict) and 'name' in value:
                  discovered_categories[new_key] = {'name': value['name']}
@@ -121,17 +286,25 @@ class CategoryDiscoveryAgent:
                  print(f"Warning: Unexpected format for cluster {key}: {value}")
                  discovered_categories[new_key] = {'name': 'Unnamed Category'}
             
-            print(f"Generated Category {i+1}: {discovered_categories[new_key]['name']}")
-
-        return discovered_categories
-
-if __name__ == '__main__':
-    agent = CategoryDiscoveryAgent()
-    categories = agent.discover_categories()
-    
-    # 結果をファイルに保存
-    output_path = "アイデアノート/PoC_Sandbox/data/discovered_categories.json"
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(categories, f, ensure_ascii=False, indent=4)
-        
-    print(f"\\nDiscovered categories saved to {output_path}") 
\ No newline at end of file
+            print(f"Generated Category {len(discovered_categories)}: {discovered_categories[new_key]['name']}")
+
+        return DiscoveryResult(
+            categories=discovered_categories,
+            unique_vectors=vectors,
+            inverse=inverse,
+            counts=counts,
+            labels=labels,
+            centroids=centroids,
+            k=optimal_k,
+            category_clusters=category_clusters
+        )
+
+    @staticmethod
+    def _cluster_index_from_key(key, default, k):
+        """LLMが返したキー ("cluster_3" など) から0始まりのクラスタ番号を取り出す"""
+        suffix = str(key).rsplit("_", 1)[-1]
+        if suffix.isdigit():
+            index = int(suffix) - 1
+        else:
+            index = default
+        return index if 0 <= index < k else None
@@ -1,18 +1,35 @@
 import json
 import os
 import numpy as np
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 from dotenv import load_dotenv
-from sklearn.metrics.pairwise import cosine_similarity
+from .embedding_backends import get_embedding_model
+from .embedding_cache import embed_unique
+from . import metrics
 
 load_dotenv()
 
 class ClassificationAgent:
-    def __init__(self, category_centroids):
+    def __init__(self, category_centroids, batch_size=None, embedding_model=None):
         self.category_centroids = category_centroids
-        self.embedding_model = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
+        # 埋め込みは EMBEDDING_BACKEND で選んだ実装 (発見・推論と共通)
+        self.embedding_model = embedding_model or get_embedding_model()
+        self.batch_size = batch_size or getattr(self.embedding_model, "batch_size", 100) # 一度に埋め込むログ数
+
+        # 重心を1つの行列にまとめ、あらかじめL2正規化しておく (内積 = コサイン類似度)
+        self.category_ids = list(category_centroids.keys())
+        if self.category_ids:
+            centroid_matrix = np.array([category_centroids[cat_id] for cat_id in self.category_ids], dtype=np.float32)
+            self.centroid_matrix = self._normalize(centroid_matrix)
+        else:
+            self.centroid_matrix = None
+
+    @staticmethod
+    def _normalize(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
 
     def _get_text_for_embedding(self, log):
         """ログからベクトル化に適したテキストを抽出・整形する"""
@@ -26,27 +43,48 @@ class ClassificationAgent:
             text += f"Service: {log['service']}. "
         return text
 
+    def classify_vectors(self, vectors, similarity_threshold=0.75):
+        """埋め込み済みのベクトル群を一度の行列積で分類し、(カテゴリID, 類似度) のリストを返す"""
+        if self.centroid_matrix is None or len(vectors) == 0:
+            return [("unclassified", -1.0)] * len(vectors)
+
+        with metrics.span("classification", items=len(vectors)):
+            log_matrix = self._normalize(np.asarray(vectors, dtype=np.float32))
+            similarities = log_matrix @ self.centroid_matrix.T
+            best_indices = np.argmax(similarities, axis=1)
+            best_scores = similarities[np.arange(len(best_indices)), best_indices]
+
+        # 閾値未満のログは末尾の "unclassified" を指すようにまとめて置き換える
+        labels = np.array(self.category_ids + ["unclassified"], dtype=object)
+        best_indices = np.where(best_scores < similarity_threshold, len(self.category_ids), best_indices)
+        return list(zip(labels[best_indices].tolist(), best_scores.astype(float).tolist()))
+
+    def embed_unique_logs(self, log_entries):
+        """同じテキストになるログは1回だけ埋め込み、(ユニークな行列, 各ログの行番号, 各行の件数) を返す"""
+        log_texts = [self._get_text_for_embedding(log) for log in log_entries]
+        return embed_unique(self.embedding_model, log_texts, batch_size=self.batch_size)
+
+    def embed_logs(self, log_entries):
+        """複数のログを埋め込み、(件数 x 次元) の行列で返す (同じテキストは1回だけ埋め込む)"""
+        vectors, inverse, _ = self.embed_unique_logs(log_entries)
+        return vectors[inverse] if len(vectors) else np.zeros((0, 0), dtype=np.float32)
+
+    def classify_unique(self, vectors, inverse, similarity_threshold=0.75):
+        """ユニークなベクトルだけを分類し、inverse で各ログの (カテゴリID, 類似度) に戻す"""
+        results = self.classify_vectors(vectors, similarity_threshold)
+        return [results[row] for row in inverse]
+
+    def classify_many(self, log_entries, similarity_threshold=0.75):
+        """複数のログをバッチで埋め込み、ベクトル距離に基づいてまとめて分類する"""
+        if self.centroid_matrix is None:
+            return [("unclassified", -1.0)] * len(log_entries)
+        vectors, inverse, _ = self.embed_unique_logs(log_entries)
+        return self.classify_unique(vectors, inverse, similarity_threshold)
+
     def classify_log(self, log_entry, similarity_threshold=0.75):
         """ベクトル距離に基づいて単一のログを分類し、未知カテゴリを検知する"""
-        if not self.category_centroids:
-            return "unclassified"
-            
-        log_text = self._get_text_for_embedding(log_entry)
-        log_vector = self.embedding_model.embed_query(log_text)
-        
-        best_match_category = "unclassified"
-        max_similarity = -1.0
-        
-        for cat_id, centroid_vector in self.category_centroids.items():
-            similarity = cosine_similarity([log_vector], [centroid_vector])[0][0]
-            if similarity > max_similarity:
-                max_similarity = similarity
-                best_match_category = cat_id
-        
-        if max_similarity < similarity_threshold:
-            return "unclassified"
-        
-        return best_match_category
+        category_id, _ = self.classify_many([log_entry], similarity_threshold)[0]
+        return category_id
 
     def classify_logs_in_batch(self, log_entries):
         """複数のログエントリをバッチで分類する"""
@@ -86,27 +124,3 @@ class ClassificationAgent:
         })
         
         return response
-
-if __name__ == '__main__':
-    # テスト用のダミーログ
-    sample_log = {
-        "log_id": "log_101",
-        "timestamp": "2025-07-05T18:30:00.123456",
-        "event_type": "service_error",
-        "service": "database",
-        "details": {
-            "error_code": 503,
-            "message": "Database connection refused by server.",
-            "severity": "critical"
-        }
-    }
-
-    agent = ClassificationAgent()
-    result_id = agent.classify_log(sample_log)
-    
-    print(f"Log: {json.dumps(sample_log, indent=2)}")
-    print(f"\\nClassified as: {result_id}")
-    
-    # カテゴリ名も表示してみる
-    if result_id in agent.category_centroids:
-        print(f"Category Name: {agent.category_centroids[result_id]['name']}") 
\ No newline at end of file
@@ -0,0 +1,98 @@
+import os
+import threading
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from dotenv import load_dotenv
+from .embedding_cache import CachedEmbeddings
+
+load_dotenv()
+
+# 埋め込みの実装: "google" は Gemini の埋め込みAPI (ディスクキャッシュ付き)、"local" はネットワーク不要のハッシュ埋め込み
+DEFAULT_BACKEND = os.getenv("EMBEDDING_BACKEND", "google").lower()
+DEFAULT_GOOGLE_MODEL = os.getenv("EMBEDDING_MODEL", "models/text-embedding-004")
+DEFAULT_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "100")) # 一度に埋め込むテキスト数
+DEFAULT_DTYPE = os.getenv("EMBEDDING_DTYPE", "float32") # ベクトル行列の型 (float16 / float32 / float64)
+DEFAULT_LOCAL_DIMENSIONS = int(os.getenv("EMBEDDING_LOCAL_DIMENSIONS", "1024"))
+
+BACKENDS = ("google", "local")
+
+
+class HashingEmbeddings(Embeddings):
+    """単語 (1-2gram) と文字 n-gram を特徴量ハッシングでベクトル化する、CPUだけで動く埋め込み
+
+    学習や語彙の保存が不要で、同じテキストは常に同じベクトルになるため、
+    プロセスやマシンが変わっても発見・分類・推論の結果を比較できる。
+    意味的な類似は捉えないが、ログのように定型的な文面の分類には十分で、APIの往復がない分だけ速い。
+    """
+
+    def __init__(self, n_features=DEFAULT_LOCAL_DIMENSIONS, batch_size=DEFAULT_BATCH_SIZE, dtype=DEFAULT_DTYPE):
+        from sklearn.feature_extraction.text import HashingVectorizer
+        self.n_features = n_features
+        self.batch_size = batch_size
+        self.dtype = np.dtype(dtype)
+        self.model_name = f"local-hashing-{n_features}"
+        common = {"n_features": n_features, "alternate_sign": False, "norm": None, "lowercase": True}
+        self._word_vectorizer = HashingVectorizer(analyzer="word", ngram_range=(1, 2), **common)
+        self._char_vectorizer = HashingVectorizer(analyzer="char_wb", ngram_range=(3, 4), **common)
+
+    def embed_array(self, texts):
+        """テキストを batch_size 件ずつベクトル化し、L2正規化した (件数 x n_features) の行列で返す"""
+        matrix = np.zeros((len(texts), self.n_features), dtype=self.dtype)
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            # 単語の一致を文字 n-gram より重く扱う
+            features = 2.0 * self._word_vectorizer.transform(batch) + self._char_vectorizer.transform(batch)
+            dense = np.sqrt(features.toarray()) # 長い文面で頻出する n-gram の影響を抑える
+            norms = np.linalg.norm(dense, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            matrix[start:start + len(batch)] = dense / norms
+        return matrix
+
+    def embed_documents(self, texts):
+        return self.embed_array(list(texts)).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def embedding_model_name(backend=None, model=None):
+    """インデックスやキャッシュ、パイプラインの状態に記録する、埋め込みの識別名 (変わると作り直しになる)"""
+    backend = (backend or DEFAULT_BACKEND).lower()
+    if backend == "local":
+        return f"local-hashing-{DEFAULT_LOCAL_DIMENSIONS}"
+    return model or DEFAULT_GOOGLE_MODEL
+
+
+def create_embedding_backend(backend=None, model=None, batch_size=None, dtype=None, cached=True):
+    """設定 (引数、なければ環境変数) に従って埋め込みモデルを新しく作る
+
+    google の場合、cached=True ならディスクキャッシュを前段に置き、未キャッシュのテキストだけをAPIに送る。
+    """
+    backend = (backend or DEFAULT_BACKEND).lower()
+    batch_size = batch_size or DEFAULT_BATCH_SIZE
+    dtype = dtype or DEFAULT_DTYPE
+    if backend == "local":
+        return HashingEmbeddings(batch_size=batch_size, dtype=dtype)
+    if backend != "google":
+        raise ValueError(f"Unknown embedding backend '{backend}'. Choose one of: {', '.join(BACKENDS)}.")
+
+    from langchain_google_genai import GoogleGenerativeAIEmbeddings
+    model = model or DEFAULT_GOOGLE_MODEL
+    embeddings = GoogleGenerativeAIEmbeddings(model=model)
+    if not cached:
+        return embeddings
+    return CachedEmbeddings(embeddings, model_name=model, batch_size=batch_size, dtype=dtype)
+
+
+# プロセス内の全エージェントで同じモデル (googleなら同じキャッシュとSQLite接続) を共有する
+_shared_models = {}
+_shared_lock = threading.Lock()
+
+
+def get_embedding_model(backend=None, model=None):
+    """設定に従った埋め込みモデルを返す。同じ設定なら同じインスタンスを再利用する"""
+    key = ((backend or DEFAULT_BACKEND).lower(), embedding_model_name(backend, model))
+    with _shared_lock:
+        if key not in _shared_models:
+            _shared_models[key] = create_embedding_backend(backend, model)
+        return _shared_models[key]
@@ -0,0 +1,185 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from dotenv import load_dotenv
+from . import metrics
+
+load_dotenv()
+
+DEFAULT_EMBEDDING_MODEL = "models/text-embedding-004"
+# 作業ディレクトリ (リポジトリのルートかAPIの PoC_Sandbox) によらず、PoC_Sandbox/data に保存する
+DEFAULT_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "data", "embedding_cache.sqlite3")
+)
+DEFAULT_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "500000"))
+
+# SQLiteのバインド変数の上限に収まるように、IN句は分割して発行する
+_SQL_CHUNK_SIZE = 500
+
+
+class EmbeddingCache:
+    """モデル名とテキストのハッシュをキーとして、埋め込みベクトルをディスクに保存するキャッシュ"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model_name, text):
+        """モデル名とテキストからキャッシュキー(SHA-256)を作成する"""
+        return hashlib.sha256(f"{model_name}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """複数のキーをまとめて引き、見つかったものだけを {key: vector} で返す"""
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return found
+
+        now = time.time()
+        with self._lock:
+            for start in range(0, len(keys), _SQL_CHUNK_SIZE):
+                chunk = keys[start:start + _SQL_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+            # ヒットしたエントリは最近使われたものとして更新し、退避対象から外す
+            if found:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self._conn.commit()
+        return found
+
+    def put_many(self, items):
+        """{key: vector} をまとめて書き込み、上限を超えた分を古い順に退避する"""
+        if not items:
+            return
+        now = time.time()
+        rows = [
+            (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for key, vector in items.items()
+        ]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """エントリ数が上限を超えていれば、最後に使われた時刻が古いものから削除する (LRU)"""
+        if not self.max_entries:
+            return
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                (overflow,)
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """任意のEmbeddingsの前段に置き、未キャッシュのテキストだけを埋め込みAPIに送るラッパー"""
+
+    def __init__(self, embeddings, model_name=DEFAULT_EMBEDDING_MODEL, cache=None, batch_size=100, dtype="float32"):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache if cache is not None else EmbeddingCache()
+        self.batch_size = batch_size
+        self.dtype = np.dtype(dtype) # embed_unique などで作るベクトル行列の型
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        keys = [EmbeddingCache.make_key(self.model_name, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+
+        # 同じテキストが複数回出てきても、APIに送るのは1回だけにする
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+
+        # ヒット・ミスは呼び出しごとのユニークなテキスト単位で数える
+        self.hits += sum(1 for key in dict.fromkeys(keys) if key in vectors)
+        self.misses += len(missing)
+
+        missing_items = list(missing.items())
+        for start in range(0, len(missing_items), self.batch_size):
+            batch = missing_items[start:start + self.batch_size]
+            with metrics.span("embedding_api_batch", items=len(batch)):
+                new_vectors = self.embeddings.embed_documents([text for _, text in batch])
+            new_items = {key: vector for (key, _), vector in zip(batch, new_vectors)}
+            self.cache.put_many(new_items)
+            vectors.update(new_items)
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text):
+        # ログ分類では重心(ドキュメント埋め込み)と比較するため、クエリもドキュメントとして埋め込み、
+        # 発見・分類の各ステップで同じキャッシュエントリを共有する
+        return self.embed_documents([text])[0]
+
+
+def embed_unique(embedding_model, texts, dtype=None, batch_size=None):
+    """同じテキストは1回だけ埋め込み、(ユニークなテキストのベクトル行列, 各テキストの行番号, 各行の出現回数) を返す
+
+    ログの埋め込み用テキストは種類が少ないため、行列・クラスタリング・分類をユニークな行だけで行い、
+    結果は inverse で各ログに戻す (例: labels[inverse])。
+    dtype と batch_size を省略すると、埋め込みモデルの設定を使う。
+    """
+    dtype = dtype or getattr(embedding_model, "dtype", np.float32)
+    batch_size = batch_size or getattr(embedding_model, "batch_size", None)
+    rows = {}
+    inverse = np.fromiter((rows.setdefault(text, len(rows)) for text in texts), dtype=np.int64, count=len(texts))
+    counts = np.bincount(inverse, minlength=len(rows))
+    unique_texts = list(rows)
+    if hasattr(embedding_model, "embed_array"):
+        # ローカルの埋め込みは行列を直接返せるので、リストを経由しない
+        with metrics.span("embedding_batch", items=len(unique_texts)):
+            vectors = np.asarray(embedding_model.embed_array(unique_texts), dtype=dtype)
+        return vectors, inverse, counts
+    batch_size = batch_size or max(len(unique_texts), 1) # 埋め込みAPIへ一度に送る件数
+    vectors = []
+    for start in range(0, len(unique_texts), batch_size):
+        batch = unique_texts[start:start + batch_size]
+        with metrics.span("embedding_batch", items=len(batch)):
+            vectors.extend(embedding_model.embed_documents(batch))
+    vectors = np.asarray(vectors, dtype=dtype) if vectors else np.zeros((0, 0), dtype=dtype)
+    return vectors, inverse, counts
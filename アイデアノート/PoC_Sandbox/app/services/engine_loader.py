@@ -0,0 +1,87 @@
+import os
+import time
+import importlib
+import threading
+from typing import Any, Dict, Optional
+
+# background: 起動直後からバックグラウンドで構築する / lazy: 最初の推論リクエストで構築する
+DEFAULT_WARMUP_MODE = os.getenv("INFERENCE_WARMUP", "background")
+
+
+class InferenceEngineLoader:
+    """推論エンジンを、初回の利用時またはバックグラウンドで初期化するローダー
+
+    推論エンジンのモジュール (LangChain / FAISS / Gemini) はここで初めてインポートするため、
+    APIサーバーはRAGの構築を待たずに起動し、DBだけを使うエンドポイントにすぐ応答できる。
+    構築中に推論が必要になった呼び出しは、構築が終わるまで待つ。
+    """
+
+    def __init__(self, module_name: str = ".inference_engine", package: str = __package__):
+        self.module_name = module_name
+        self.package = package
+        self.state = "cold" # cold / warming / ready / failed
+        self.error: Optional[str] = None
+        self.warmup_started_at: Optional[float] = None
+        self.warmup_seconds: Optional[float] = None
+        self._engine = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start_warmup(self):
+        """バックグラウンドのスレッドで推論エンジンの構築を始める"""
+        if self._engine is not None or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._warmup, name="inference-engine-warmup", daemon=True)
+        self._thread.start()
+
+    def _warmup(self):
+        try:
+            self.get()
+        except Exception as e:
+            print(f"Inference engine warm-up failed: {e}")
+
+    def get(self):
+        """構築済みの推論エンジンを返す。未構築なら構築し、構築中なら完了を待つ"""
+        if self._engine is not None:
+            return self._engine
+        with self._lock:
+            if self._engine is not None:
+                return self._engine
+            self.state = "warming"
+            self.error = None
+            self.warmup_started_at = time.time()
+            started = time.perf_counter()
+            try:
+                module = importlib.import_module(self.module_name, self.package)
+                engine = module.get_inference_engine()
+            except Exception as e:
+                self.state = "failed"
+                self.error = str(e)
+                raise
+            self.warmup_seconds = time.perf_counter() - started
+            self._engine = engine
+            self.state = "ready"
+            return engine
+
+    def install(self, engine):
+        """構築済みの推論エンジンを差し込む (スタンドインのモデルを使うベンチマークや負荷試験用)"""
+        with self._lock:
+            self._engine = engine
+            self.state = "ready"
+            self.error = None
+
+    def peek(self):
+        """構築済みなら推論エンジンを、そうでなければ None を返す (構築は始めない)"""
+        return self._engine
+
+    def ask(self, query: str) -> Dict[str, Any]:
+        return self.get().ask(query)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "ready": self.state == "ready",
+            "error": self.error,
+            "warmup_started_at": self.warmup_started_at,
+            "warmup_seconds": self.warmup_seconds
+        }
@@ -1,12 +1,13 @@
 import random
 from typing import Dict, Any
 
-def generate_dummy_event() -> Dict[str, Any]:
+def generate_dummy_event(rng=random) -> Dict[str, Any]:
     """
     ダミーのイベントデータを生成する。
+    rng に random.Random(seed) を渡すと、毎回同じ順序でイベントが生成される。
     """
     event_types = ["user_login", "item_purchase", "system_alert"]
-    event_type = random.choice(event_types)
+    event_type = rng.choice(event_types)
     
     event_payload = {
         "event_type": event_type,
@@ -15,19 +16,19 @@ def generate_dummy_event() -> Dict[str, Any]:
 
     if event_type == "user_login":
         event_payload["raw_event"] = {
-            "user_id": f"user_{random.randint(100, 999)}",
-            "ip_address": f"192.168.1.{random.randint(1, 254)}"
+            "user_id": f"user_{rng.randint(100, 999)}",
+            "ip_address": f"192.168.1.{rng.randint(1, 254)}"
         }
     elif event_type == "item_purchase":
         event_payload["raw_event"] = {
-            "product_id": f"prod_{random.randint(1000, 9999)}",
-            "quantity": random.randint(1, 5),
-            "price": round(random.uniform(10.0, 500.0), 2)
+            "product_id": f"prod_{rng.randint(1000, 9999)}",
+            "quantity": rng.randint(1, 5),
+            "price": round(rng.uniform(10.0, 500.0), 2)
         }
     elif event_type == "system_alert":
         event_payload["raw_event"] = {
-            "service": random.choice(["database", "api_gateway", "auth_service"]),
-            "severity": random.choice(["info", "warning", "critical"]),
+            "service": rng.choice(["database", "api_gateway", "auth_service"]),
+            "severity": rng.choice(["info", "warning", "critical"]),
             "message": "Service is experiencing high latency."
         }
         
@@ -1,26 +1,129 @@
+import json
+import base64
+from datetime import datetime, timezone
+from sqlalchemy import insert, select, update, literal, tuple_, type_coerce, String
 from sqlalchemy.orm import Session
 from .. import models, schemas
-from typing import Dict, Any
+from . import metrics
+from typing import Dict, Any, List, Optional, Iterator, Tuple
 
-def validate_and_log_event(db: Session, event: schemas.EventLogIn) -> models.EventLog:
+def _timed_commit(db: Session, items: int = 1):
     """
-    イベントを検証し、データベースに記録する。
-    PoC段階では、バリデーションは単純なものとする。
+    トランザクションをコミットし、所要時間を db_commit のメトリクスに記録する。
+    """
+    with metrics.span("db_commit", items=items):
+        db.commit()
+
+def _validate_event(event: schemas.EventLogIn):
+    """
+    イベントを検証する。PoC段階では、バリデーションは単純なものとする。
     """
     if not event.event_type or not event.raw_event:
         # 実際にはもっと複雑なバリデーションが必要
         raise ValueError("Event type and raw event data are required.")
 
+def validate_and_log_event(db: Session, event: schemas.EventLogIn, status: str = "processed") -> models.EventLog:
+    """
+    イベントを検証し、データベースに記録する。
+    推論を後から非同期に行う場合は status="pending" で記録する。
+    """
+    _validate_event(event)
+
     db_event = models.EventLog(
         event_type=event.event_type,
         raw_event=event.raw_event,
-        notes=event.notes
+        notes=event.notes,
+        status=status
     )
     db.add(db_event)
-    db.commit()
+    _timed_commit(db)
     db.refresh(db_event)
     return db_event
 
+def validate_and_log_events_bulk(db: Session, events: List[schemas.EventLogIn], status: str = "processed") -> List[int]:
+    """
+    複数のイベントをすべて検証してから、一括INSERTで1つのトランザクションとして記録する。
+    1件でも不正なイベントがあれば何も記録しない。採番されたIDを入力と同じ順序で返す。
+    """
+    for index, event in enumerate(events):
+        try:
+            _validate_event(event)
+        except ValueError as e:
+            raise ValueError(f"Invalid event at index {index}: {e}") from e
+
+    if not events:
+        return []
+
+    rows = [
+        {
+            "event_type": event.event_type,
+            "raw_event": event.raw_event,
+            "notes": event.notes,
+            "status": status
+        }
+        for event in events
+    ]
+    statement = insert(models.EventLog).returning(models.EventLog.id, sort_by_parameter_order=True)
+    event_ids = list(db.scalars(statement, rows))
+    _timed_commit(db, items=len(event_ids))
+    return event_ids
+
+def update_event_status(db: Session, event_id: int, status: str):
+    """
+    イベントのステータス ("processed" / "error" / "pending" / "rejected") を更新する。
+    """
+    db.execute(update(models.EventLog).where(models.EventLog.id == event_id).values(status=status))
+    _timed_commit(db)
+
+def update_event_categories(db: Session, results: List[Tuple[int, str, float]]):
+    """
+    取り込み時の分類結果 [(イベントID, カテゴリID, 類似度), ...] を、主キーでの一括UPDATEと1回のコミットで記録する。
+    """
+    if not results:
+        return
+    db.execute(update(models.EventLog), [
+        {"id": event_id, "category": category, "category_similarity": similarity}
+        for event_id, category, similarity in results
+    ])
+    _timed_commit(db, items=len(results))
+
+def log_inference_result(db: Session, event_id: int, result: Optional[Dict[str, Any]] = None,
+                         latency_ms: Optional[float] = None, error: Optional[str] = None) -> models.InferenceResult:
+    """
+    イベントに対する推論の結果 (失敗した場合はエラー内容) を記録する。
+    """
+    result = result or {}
+    db_result = models.InferenceResult(
+        event_id=event_id,
+        answer=result.get("answer"),
+        source_documents=result.get("source_documents"),
+        latency_ms=latency_ms,
+        model=result.get("model"),
+        tier=result.get("tier"),
+        cached=bool(result.get("cached", False)),
+        similarity=result.get("similarity"),
+        error=error
+    )
+    db.add(db_result)
+    _timed_commit(db)
+    db.refresh(db_result)
+    return db_result
+
+def get_latest_inference_results(db: Session, event_ids: List[int]) -> Dict[int, models.InferenceResult]:
+    """
+    複数のイベントについて、それぞれ最新の推論結果を1回のクエリで取得する。
+    """
+    if not event_ids:
+        return {}
+    results = (
+        db.query(models.InferenceResult)
+        .filter(models.InferenceResult.event_id.in_(event_ids))
+        .order_by(models.InferenceResult.id)
+        .all()
+    )
+    # ID順に上書きしていくため、イベントごとに最後 (最新) の結果が残る
+    return {result.event_id: result for result in results}
+
 def get_event(db: Session, event_id: int):
     """
     IDを指定してイベントログを取得する。
@@ -30,5 +133,154 @@ def get_event(db: Session, event_id: int):
 def get_events(db: Session, skip: int = 0, limit: int = 100):
     """
     イベントログのリストを取得する。
+    OFFSETはページが深くなるほど遅くなるため、大量のログを辿る場合は get_events_page を使う。
+    """
+    return db.query(models.EventLog).offset(skip).limit(limit).all()
+
+def _db_timestamp(value: datetime) -> str:
+    """
+    datetime を、SQLiteに保存されている timestamp と文字列として正しく比較できる形式に変換する。
+    SQLiteの server_default (CURRENT_TIMESTAMP) は UTC の 'YYYY-MM-DD HH:MM:SS' で保存される。
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    text = value.strftime("%Y-%m-%d %H:%M:%S")
+    if value.microsecond:
+        text += f".{value.microsecond:06d}"
+    return text
+
+def _is_sqlite(db: Session) -> bool:
+    return db.get_bind().dialect.name == "sqlite"
+
+def _timestamp_key(sqlite: bool):
+    """
+    timestamp の比較に使う列。SQLiteは DateTime を文字列で保存するため、保存されている文字列のまま比較する
+    (バインドした datetime は '.000000' 付きの文字列になり、秒までの値と正しく比較できない)。
+    他のDBでは DateTime の列をそのまま比較する。
+    """
+    return type_coerce(models.EventLog.timestamp, String) if sqlite else models.EventLog.timestamp
+
+def _timestamp_value(value: datetime, sqlite: bool):
+    """
+    _timestamp_key と比較する値。タイムゾーンなしの datetime はUTCとして扱う。
+    """
+    if sqlite:
+        return literal(_db_timestamp(value), String)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return literal(value, models.EventLog.timestamp.type)
+
+def encode_cursor(timestamp: datetime, event_id: int) -> str:
+    """
+    ページの最後の行の (timestamp, id) から、次のページを取得するためのカーソルを作る。
+    """
+    payload = json.dumps([timestamp.isoformat(), event_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    カーソルを (timestamp, id) に戻す。不正なカーソルなら ValueError。
+    """
+    try:
+        timestamp, event_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        timestamp = datetime.fromisoformat(timestamp)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(event_id, int):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return timestamp, event_id
+
+def _select_events(event_type: Optional[str] = None, status: Optional[str] = None,
+                   start: Optional[datetime] = None, end: Optional[datetime] = None,
+                   order: str = "desc", category: Optional[str] = None, sqlite: bool = True):
+    """
+    絞り込み条件と (timestamp, id) の並び順を指定したSELECT文を作る。
+    """
+    timestamp_key = _timestamp_key(sqlite)
+    statement = select(models.EventLog)
+    if event_type is not None:
+        statement = statement.where(models.EventLog.event_type == event_type)
+    if status is not None:
+        statement = statement.where(models.EventLog.status == status)
+    if category is not None:
+        statement = statement.where(models.EventLog.category == category)
+    if start is not None:
+        statement = statement.where(timestamp_key >= _timestamp_value(start, sqlite))
+    if end is not None:
+        statement = statement.where(timestamp_key < _timestamp_value(end, sqlite))
+    if order == "asc":
+        return statement.order_by(models.EventLog.timestamp.asc(), models.EventLog.id.asc())
+    return statement.order_by(models.EventLog.timestamp.desc(), models.EventLog.id.desc())
+
+def _after_cursor(statement, cursor: Tuple[datetime, int], order: str = "desc", sqlite: bool = True):
+    """
+    カーソルの位置より後ろの行だけを対象にする (OFFSETを使わないキーセットページング)。
+    """
+    timestamp, event_id = cursor
+    key = tuple_(_timestamp_key(sqlite), models.EventLog.id)
+    position = tuple_(_timestamp_value(timestamp, sqlite), literal(event_id))
+    return statement.where(key > position if order == "asc" else key < position)
+
+def get_events_page(db: Session, limit: int = 100, cursor: Optional[str] = None,
+                    event_type: Optional[str] = None, status: Optional[str] = None,
+                    start: Optional[datetime] = None, end: Optional[datetime] = None,
+                    order: str = "desc", category: Optional[str] = None) -> Tuple[List[models.EventLog], Optional[str]]:
+    """
+    イベントログを (timestamp, id) の順に limit 件取得し、次のページのカーソルと一緒に返す。
+    最後のページでは次のカーソルは None になる。
+    """
+    sqlite = _is_sqlite(db)
+    statement = _select_events(event_type, status, start, end, order, category, sqlite)
+    if cursor is not None:
+        statement = _after_cursor(statement, decode_cursor(cursor), order, sqlite)
+
+    events = list(db.scalars(statement.limit(limit + 1)))
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = encode_cursor(events[-1].timestamp, events[-1].id)
+    return events, next_cursor
+
+def iter_events(db: Session, chunk_size: int = 1000,
+                event_type: Optional[str] = None, status: Optional[str] = None,
+                start: Optional[datetime] = None, end: Optional[datetime] = None,
+                order: str = "asc", category: Optional[str] = None) -> Iterator[List[models.EventLog]]:
+    """
+    条件に合うイベントログを chunk_size 件ずつ取得して返すジェネレーター。
+    チャンクごとにキーセットで続きを問い合わせるため、全件をメモリに載せず、長い読み取りトランザクションも持たない。
+    """
+    sqlite = _is_sqlite(db)
+    cursor = None
+    while True:
+        statement = _select_events(event_type, status, start, end, order, category, sqlite)
+        if cursor is not None:
+            statement = _after_cursor(statement, cursor, order, sqlite)
+        events = list(db.scalars(statement.limit(chunk_size)))
+        if not events:
+            return
+        cursor = (events[-1].timestamp, events[-1].id)
+        yield events
+        # 返したチャンクはセッションから切り離し、メモリを解放する
+        for event in events:
+            db.expunge(event)
+        db.commit()
+        if len(events) < chunk_size:
+            return
+
+def iter_events_after_id(db: Session, after_id: int = 0, chunk_size: int = 1000) -> Iterator[List[models.EventLog]]:
+    """
+    ID が after_id より大きいイベントログを、ID順に chunk_size 件ずつ返すジェネレーター (記録順のエクスポート用)。
     """
-    return db.query(models.EventLog).offset(skip).limit(limit).all() 
\ No newline at end of file
+    while True:
+        statement = (select(models.EventLog).where(models.EventLog.id > after_id)
+                     .order_by(models.EventLog.id.asc()).limit(chunk_size))
+        events = list(db.scalars(statement))
+        if not events:
+            return
+        after_id = events[-1].id
+        yield events
+        for event in events:
+            db.expunge(event)
+        db.commit()
+        if len(events) < chunk_size:
+            return
@@ -0,0 +1,154 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Dict, Any, List, Optional
+from sqlalchemy import insert
+from .. import models, schemas
+from .event_logger import _validate_event, _timed_commit
+
+DEFAULT_MAX_BATCH_SIZE = int(os.getenv("GROUP_COMMIT_MAX_BATCH_SIZE", "500"))
+DEFAULT_MAX_DELAY_MS = float(os.getenv("GROUP_COMMIT_MAX_DELAY_MS", "5"))
+
+_STOP = object()
+
+
+class GroupCommitWriter:
+    """イベントの記録を1つの書き込みスレッドに集め、まとめてコミットするライター
+
+    短い時間 (max_delay_ms) の間に届いたイベントを最大 max_batch_size 件まで1つのINSERTと
+    1回のコミットで記録する。同時に書き込むクライアントが増えても、DBのロックの取り合いと
+    コミットごとのfsyncが増えないため、記録のスループットが上がる。
+    submit は採番されたIDを結果に持つ Future を返す。
+    書き込みスレッドが動いていないとき (開始前・停止後・異常終了) は、呼び出し元のスレッドで直接記録する。
+    """
+
+    def __init__(self, session_factory, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_delay_ms: float = DEFAULT_MAX_DELAY_MS):
+        self.session_factory = session_factory
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.retried_batches = 0
+        self.direct_writes = 0
+        self.largest_batch = 0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="event-group-commit-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """キューに残っているイベントを書き終えてから停止する"""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, event: schemas.EventLogIn, status: str = "processed") -> Future:
+        """イベントを検証して書き込みキューに入れる。不正なイベントはその場で ValueError"""
+        _validate_event(event)
+        future = Future()
+        item = ({
+            "event_type": event.event_type,
+            "raw_event": event.raw_event,
+            "notes": event.notes,
+            "status": status
+        }, future)
+        if self._thread is None or not self._thread.is_alive():
+            # キューに入れても誰も書かず、結果を待つ側が止まってしまうので、その場で記録する
+            with self._stats_lock:
+                self.direct_writes += 1
+            self._commit([item])
+            return future
+        self._queue.put(item)
+        return future
+
+    def write(self, event: schemas.EventLogIn, status: str = "processed") -> int:
+        """イベントを記録し、コミットされるまで待って採番されたIDを返す"""
+        return self.submit(event, status).result()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize(),
+            "max_batch_size": self.max_batch_size,
+            "max_delay_ms": self.max_delay * 1000,
+            "batches": self.batches,
+            "written": self.written,
+            "failed": self.failed,
+            "retried_batches": self.retried_batches,
+            "direct_writes": self.direct_writes,
+            "largest_batch": self.largest_batch,
+            "average_batch": self.written / self.batches if self.batches else 0.0
+        }
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            # 最初のイベントから max_delay の間、または max_batch_size 件に達するまで集める
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+        # 停止の指示より後に届いたイベントも書いておく
+        remaining = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                remaining.append(item)
+        for start in range(0, len(remaining), self.max_batch_size):
+            self._commit(remaining[start:start + self.max_batch_size])
+
+    def _commit(self, batch: List[tuple]):
+        rows = [row for row, _ in batch]
+        db = self.session_factory()
+        try:
+            statement = insert(models.EventLog).returning(models.EventLog.id, sort_by_parameter_order=True)
+            event_ids = list(db.scalars(statement, rows))
+            _timed_commit(db, items=len(event_ids))
+        except Exception as e:
+            db.rollback()
+            if len(batch) == 1:
+                with self._stats_lock:
+                    self.failed += 1
+                batch[0][1].set_exception(e)
+                return
+            # どの行が原因かわからないので1件ずつ記録し直し、失敗した行のリクエストだけにエラーを返す
+            with self._stats_lock:
+                self.retried_batches += 1
+            for item in batch:
+                self._commit([item])
+            return
+        finally:
+            db.close()
+
+        with self._stats_lock:
+            self.batches += 1
+            self.written += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+        for (_, future), event_id in zip(batch, event_ids):
+            future.set_result(event_id)
@@ -0,0 +1,153 @@
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional
+
+# イベントごとに値が変わるだけで、推論結果には影響しないフィールド
+DEFAULT_MASK_FIELDS = (
+    "user_id", "ip_address", "product_id", "price", "quantity",
+    "timestamp", "log_id", "request_id", "session_id",
+)
+# フィールド名に関係なく、文字列の中からマスクする値のパターン
+DEFAULT_MASK_PATTERNS = (
+    (r"\b\d{1,3}(?:\.\d{1,3}){3}\b", "<ip>"),
+    (r"\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?\b", "<timestamp>"),
+    (r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b", "<uuid>"),
+)
+MASK_VALUE = "<masked>"
+
+
+def _fields_from_env():
+    value = os.getenv("INFERENCE_CACHE_MASK_FIELDS")
+    if value is None:
+        return DEFAULT_MASK_FIELDS
+    return tuple(field.strip() for field in value.split(",") if field.strip())
+
+
+class InferenceCache:
+    """正規化したイベントをキーとして推論結果を保持する、LRU + TTL のキャッシュ
+
+    ユーザーIDやIPアドレスなど、イベントごとに変わるフィールドをマスクしてからキーを作るため、
+    同じ種類のインシデントは2回目以降LLMを呼ばずに応答できる。
+    version_fn (ナレッジベースの内容を表す値を返す関数) を渡すと、その値が変わった時点で全件を破棄する。
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 600.0,
+                 mask_fields: Iterable[str] = DEFAULT_MASK_FIELDS,
+                 mask_patterns: Iterable = DEFAULT_MASK_PATTERNS,
+                 version_fn: Optional[Callable[[], Any]] = None, version_check_interval: float = 5.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.mask_fields = set(mask_fields)
+        self.mask_patterns = [(re.compile(pattern), replacement) for pattern, replacement in mask_patterns]
+        self.version_fn = version_fn
+        self.version_check_interval = version_check_interval
+
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = version_fn() if version_fn else None
+        self._version_checked_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_env(cls, version_fn=None):
+        """環境変数の設定からキャッシュを作る。INFERENCE_CACHE_ENABLED=false なら None"""
+        if os.getenv("INFERENCE_CACHE_ENABLED", "true").lower() in ("0", "false", "no"):
+            return None
+        return cls(
+            max_entries=int(os.getenv("INFERENCE_CACHE_MAX_ENTRIES", "1024")),
+            ttl_seconds=float(os.getenv("INFERENCE_CACHE_TTL_SECONDS", "600")),
+            mask_fields=_fields_from_env(),
+            version_fn=version_fn
+        )
+
+    # --- 正規化 ---
+
+    def _mask_text(self, text: str) -> str:
+        for pattern, replacement in self.mask_patterns:
+            text = pattern.sub(replacement, text)
+        return text
+
+    def _mask(self, value):
+        if isinstance(value, dict):
+            return {
+                key: MASK_VALUE if key in self.mask_fields else self._mask(item)
+                for key, item in value.items()
+            }
+        if isinstance(value, list):
+            return [self._mask(item) for item in value]
+        if isinstance(value, str):
+            return self._mask_text(value)
+        return value
+
+    def normalize(self, query: str) -> str:
+        """クエリ (JSON文字列のイベント) から、揮発的な値を除いたキャッシュキーを作る"""
+        try:
+            event = json.loads(query)
+        except (TypeError, ValueError):
+            return self._mask_text(" ".join(str(query).split()))
+        return json.dumps(self._mask(event), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+    # --- 参照と更新 ---
+
+    def _check_version(self):
+        """一定間隔でナレッジベースの内容を確認し、変わっていれば全件を破棄する (ロック取得済みで呼ぶ)"""
+        if self.version_fn is None:
+            return
+        now = time.monotonic()
+        if now - self._version_checked_at < self.version_check_interval:
+            return
+        self._version_checked_at = now
+        version = self.version_fn()
+        if version != self._version:
+            self._version = version
+            self._entries.clear()
+            self.invalidations += 1
+
+    def get(self, query: str) -> Optional[Dict[str, Any]]:
+        key = self.normalize(query)
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, query: str, result: Dict[str, Any]):
+        key = self.normalize(query)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, dict(result))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
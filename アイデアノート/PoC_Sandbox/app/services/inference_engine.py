@@ -1,43 +1,108 @@
 import os
-from langchain_community.document_loaders import DirectoryLoader, TextLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
+import glob
+import hashlib
+import threading
+from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
+from langchain_community.vectorstores.utils import DistanceStrategy
 from dotenv import load_dotenv
+from .inference_cache import InferenceCache
+from .knowledge_index import KnowledgeIndex
+from .embedding_backends import create_embedding_backend, embedding_model_name
+from . import metrics
 
 load_dotenv()
 
-# APIキーが設定されているか確認 (Google)
-if not os.getenv("GOOGLE_API_KEY"):
-    raise ValueError("GOOGLE_API_KEY is not set in the environment variables.")
-
 KNOWLEDGE_BASE_DIR = "data/knowledge_base"
+SYNTHESIZED_KNOWLEDGE_DIR = "data/synthesized_knowledge"
+KNOWLEDGE_INDEX_DIR = os.getenv("KNOWLEDGE_INDEX_DIR", "data/knowledge_index")
+EMBEDDING_MODEL_NAME = embedding_model_name() # EMBEDDING_BACKEND / EMBEDDING_MODEL で切り替える
+LLM_MODEL_NAME = "gemini-2.5-flash"
+
+# 段階的推論: マニュアルのセクションとの類似度が十分に高いイベントは、LLMを呼ばずにそのセクションを返す
+TIERED_INFERENCE_ENABLED = os.getenv("INFERENCE_TIERED", "false").lower() in ("1", "true", "yes")
+FAST_PATH_THRESHOLD = float(os.getenv("INFERENCE_FAST_PATH_THRESHOLD", "0.8"))
+# 1位と2位のセクションの類似度の差がこれ未満なら、どちらとも決められないとしてLLMに回す
+FAST_PATH_MARGIN = float(os.getenv("INFERENCE_FAST_PATH_MARGIN", "0.02"))
+
+def knowledge_source_dirs():
+    """推論で参照するナレッジのディレクトリ。戦略ループが生成したマニュアルは環境変数で追加できる"""
+    source_dirs = [KNOWLEDGE_BASE_DIR]
+    if os.getenv("INCLUDE_SYNTHESIZED_KNOWLEDGE", "false").lower() in ("1", "true", "yes"):
+        source_dirs.append(SYNTHESIZED_KNOWLEDGE_DIR)
+    return source_dirs
+
+def knowledge_base_fingerprint(knowledge_base_dirs=None):
+    """ナレッジベースのファイル構成と更新状況を表すハッシュ値 (内容が変わると値が変わる)"""
+    if knowledge_base_dirs is None:
+        knowledge_base_dirs = knowledge_source_dirs()
+    elif isinstance(knowledge_base_dirs, str):
+        knowledge_base_dirs = [knowledge_base_dirs]
+    digest = hashlib.sha256()
+    for knowledge_base_dir in knowledge_base_dirs:
+        for path in sorted(glob.glob(os.path.join(knowledge_base_dir, "**", "*.md"), recursive=True)):
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
 
 class InferenceEngine:
-    def __init__(self):
-        print("Initializing Inference Engine with Gemini...")
-        self.qa_chain = self._build_chain()
-        print("Inference Engine initialized.")
+    def __init__(self, llm=None, embeddings=None, embedding_model_name=EMBEDDING_MODEL_NAME):
+        """llm と embeddings を渡すと、Gemini の代わりにそれを使う (ベンチマークやオフラインでの検証用)"""
+        # APIキーが設定されているか確認 (Google)
+        if llm is None and not os.getenv("GOOGLE_API_KEY"):
+            raise ValueError("GOOGLE_API_KEY is not set in the environment variables.")
 
-    def _build_chain(self):
-        # 1. ドキュメントの読み込み
-        loader = DirectoryLoader(
-            KNOWLEDGE_BASE_DIR,
-            glob="**/*.md",
-            loader_cls=TextLoader,
-            loader_kwargs={"encoding": "utf-8"}
+        print("Initializing Inference Engine with Gemini..." if llm is None else "Initializing Inference Engine...")
+        self.llm = llm or ChatGoogleGenerativeAI(temperature=0, model=LLM_MODEL_NAME)
+        self.llm_model_name = LLM_MODEL_NAME if llm is None else getattr(llm, "model_name", type(llm).__name__)
+        # 1-3. ドキュメントの読み込み・分割・ベクトル化 (保存済みのインデックスを再利用し、変更分だけ埋め込む)
+        self.source_dirs = knowledge_source_dirs()
+        # 埋め込みはインデックスに保存されるので、ディスクキャッシュは挟まない
+        self.embeddings = embeddings or create_embedding_backend(cached=False)
+        self.embedding_model_name = embedding_model_name
+        self.knowledge_index = KnowledgeIndex(
+            self.source_dirs,
+            KNOWLEDGE_INDEX_DIR,
+            self.embeddings,
+            self.embedding_model_name
         )
-        documents = loader.load()
+        self.qa_chain = self._build_chain(self.knowledge_index.load_or_build())
 
-        # 2. テキストの分割
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-        texts = text_splitter.split_documents(documents)
+        # 段階的推論で使う、マニュアルの見出し単位のインデックス (内積 = コサイン類似度)
+        self.tiered = TIERED_INFERENCE_ENABLED
+        self.fast_path_threshold = FAST_PATH_THRESHOLD
+        self.fast_path_margin = FAST_PATH_MARGIN
+        self.section_index = None
+        self.section_store = None
+        if self.tiered:
+            self.section_index = KnowledgeIndex(
+                self.source_dirs,
+                os.path.join(KNOWLEDGE_INDEX_DIR, "sections"),
+                self.embeddings,
+                self.embedding_model_name,
+                split_mode="sections",
+                vectorstore_kwargs={"normalize_L2": True, "distance_strategy": DistanceStrategy.MAX_INNER_PRODUCT}
+            )
+            self.section_store = self.section_index.load_or_build()
+        # どの段階で応答したかの件数 (LLMの呼び出しをどれだけ減らせたかの確認用)
+        self.tier_counts = {"cache": 0, "retrieval": 0, "llm": 0}
+        self._tier_lock = threading.Lock()
 
-        # 3. ベクトルストアの構築 (Gemini)
-        embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
-        vectorstore = FAISS.from_documents(texts, embeddings)
+        # 正規化したイベントをキーとする推論結果のキャッシュ (ナレッジベースが変わると破棄される)
+        self.cache = InferenceCache.from_env(version_fn=lambda: knowledge_base_fingerprint(self.source_dirs))
+        print("Inference Engine initialized.")
+
+    def reload_knowledge(self):
+        """ナレッジベースの変更をインデックスに反映し、チェーンとキャッシュを作り直す"""
+        self.qa_chain = self._build_chain(self.knowledge_index.load_or_build())
+        if self.section_index is not None:
+            self.section_store = self.section_index.load_or_build()
+        if self.cache is not None:
+            self.cache.invalidate()
+        return self.knowledge_index.last_refresh
+
+    def _build_chain(self, vectorstore):
         retriever = vectorstore.as_retriever()
 
         # 4. プロンプトの定義
@@ -59,9 +124,8 @@ class InferenceEngine:
         )
         
         # 5. LLMとチェーンの構築 (Gemini)
-        llm = ChatGoogleGenerativeAI(temperature=0, model="gemini-2.5-flash")
         qa_chain = RetrievalQA.from_chain_type(
-            llm=llm,
+            llm=self.llm,
             chain_type="stuff",
             retriever=retriever,
             chain_type_kwargs={"prompt": prompt},
@@ -72,15 +136,98 @@ class InferenceEngine:
     def ask(self, query: str):
         """
         与えられたクエリ（イベント情報）に対して推論を実行する。
+        同じ種類のイベントに対する推論結果がキャッシュにあれば、LLMを呼ばずにそれを返す。
+        段階的推論が有効な場合は、マニュアルのセクションとの類似度が閾値以上ならそのセクションを返し、
+        確信度が低いイベントや未知のイベントだけをLLMに回す。応答の "tier" に、どの段階で答えたかを記録する。
         """
-        # クエリを整形して、よりLLMが理解しやすい形にする
-        formatted_query = f"以下のイベントが発生しました。内容を分析し、対応を提案してください。\\n\\n{query}"
-        
-        result = self.qa_chain({"query": formatted_query})
+        if self.cache is not None:
+            with metrics.span("inference_cache_lookup"):
+                cached = self.cache.get(query)
+            if cached is not None:
+                self._count_tier("cache")
+                cached["cached"] = True
+                return cached
+
+        similarity = None
+        response = None
+        if self.section_store is not None:
+            with metrics.span("inference_section_retrieval"):
+                response, similarity = self._answer_from_section(query)
+
+        if response is None:
+            # クエリを整形して、よりLLMが理解しやすい形にする
+            formatted_query = f"以下のイベントが発生しました。内容を分析し、対応を提案してください。\\n\\n{query}"
+
+            # 検索と生成の所要時間を分けて計測するため、RetrievalQA の2つの段階を個別に呼ぶ
+            with metrics.span("inference_retrieval"):
+                source_documents = self.qa_chain.retriever.invoke(formatted_query)
+            with metrics.span("inference_generation"):
+                answer = self.qa_chain.combine_documents_chain.invoke(
+                    {"input_documents": source_documents, "question": formatted_query}
+                )["output_text"]
+            response = {
+                "answer": answer,
+                "source_documents": [doc.metadata['source'] for doc in source_documents],
+                "model": self.llm_model_name,
+                "tier": "llm",
+                "similarity": similarity
+            }
+
+        self._count_tier(response["tier"])
+        if self.cache is not None:
+            self.cache.put(query, response)
+        return {**response, "cached": False}
+
+    def _answer_from_section(self, query: str):
+        """最も類似するマニュアルのセクションを探し、確信度が十分なら (応答, 類似度)、そうでなければ (None, 類似度) を返す"""
+        vector = self.embeddings.embed_query(query)
+        results = self.section_store.similarity_search_with_score_by_vector(vector, k=2)
+        if not results:
+            return None, None
+
+        best_doc, best_score = results[0]
+        best_score = float(best_score)
+        runner_up_score = float(results[1][1]) if len(results) > 1 else -1.0
+        if best_score < self.fast_path_threshold or best_score - runner_up_score < self.fast_path_margin:
+            return None, best_score
+
         return {
-            "answer": result["result"],
-            "source_documents": [doc.metadata['source'] for doc in result['source_documents']]
+            "answer": best_doc.page_content,
+            "source_documents": [best_doc.metadata['source']],
+            "section": best_doc.metadata.get('section'),
+            "model": self.embedding_model_name,
+            "tier": "retrieval",
+            "similarity": best_score
+        }, best_score
+
+    def _count_tier(self, tier: str):
+        with self._tier_lock:
+            self.tier_counts[tier] += 1
+
+    def tier_stats(self):
+        """段階ごとの応答件数と、LLMを呼ばずに済んだ割合"""
+        with self._tier_lock:
+            counts = dict(self.tier_counts)
+        total = sum(counts.values())
+        return {
+            "tiered": self.tiered,
+            "fast_path_threshold": self.fast_path_threshold,
+            "fast_path_margin": self.fast_path_margin,
+            **counts,
+            "total": total,
+            "llm_offload_rate": (counts["cache"] + counts["retrieval"]) / total if total else 0.0,
+            "retrieval_rate": counts["retrieval"] / total if total else 0.0
         }
 
-# シングルトンインスタンス
-inference_engine = InferenceEngine() 
\ No newline at end of file
+# シングルトンインスタンス (インポート時ではなく、初めて必要になった時点で構築する)
+_inference_engine = None
+_inference_engine_lock = threading.Lock()
+
+def get_inference_engine():
+    """推論エンジンのシングルトンを返す。未構築なら構築する (複数スレッドから呼ばれても1度だけ)"""
+    global _inference_engine
+    if _inference_engine is None:
+        with _inference_engine_lock:
+            if _inference_engine is None:
+                _inference_engine = InferenceEngine()
+    return _inference_engine
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import asyncio
+from typing import Callable, Dict, Any, List, Optional
+from sqlalchemy import func
+from .. import models
+from . import event_logger
+
+DEFAULT_NUM_WORKERS = int(os.getenv("INFERENCE_WORKERS", "4"))
+DEFAULT_MAX_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "100"))
+RECOVERY_PAGE_SIZE = 500
+
+
+class InferenceWorkerPool:
+    """記録済みのイベントに対する推論を、バックグラウンドのワーカーで実行するプール
+
+    キューの長さには上限があり、満杯のときは新しいイベントを受け付けない (バックプレッシャー)。
+    推論そのものはブロッキングな処理なので、ワーカーはスレッドプール上で実行する。
+    """
+
+    def __init__(self, session_factory, ask: Callable[[str], Dict[str, Any]],
+                 num_workers: int = DEFAULT_NUM_WORKERS, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE):
+        self.session_factory = session_factory
+        self.ask = ask
+        self.num_workers = num_workers
+        self.max_queue_size = max_queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self._workers = []
+        self._recovery: Optional[asyncio.Task] = None
+        self.recovered = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.num_workers)]
+        self._recovery = asyncio.create_task(self._recover_pending())
+
+    async def stop(self):
+        tasks = self._workers + ([self._recovery] if self._recovery is not None else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._recovery = None
+
+    def is_full(self) -> bool:
+        return self.queue is None or self.queue.full()
+
+    def submit(self, event_id: int) -> bool:
+        """イベントIDをキューに入れる。満杯なら False を返す"""
+        if self.is_full():
+            self.rejected += 1
+            return False
+        self.queue.put_nowait(event_id)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "max_queue_size": self.max_queue_size,
+            "workers": self.num_workers,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "recovered": self.recovered,
+            "recovering": self._recovery is not None and not self._recovery.done()
+        }
+
+    async def _recover_pending(self):
+        """前回の停止時に処理されずに残った pending のイベントを、ページ単位で読みながらキューの空きに合わせて再投入する
+
+        起動後に受け付けた pending は API が投入するので、起動時点の最大IDまでを対象にする。
+        """
+        last_id = await asyncio.to_thread(self._max_event_id)
+        after_id = 0
+        while True:
+            pending_ids = await asyncio.to_thread(self._pending_ids, after_id, last_id, RECOVERY_PAGE_SIZE)
+            for event_id in pending_ids:
+                # キューが満杯なら、ワーカーが処理して空きができるまで待つ
+                await self.queue.put(event_id)
+                self.recovered += 1
+            if len(pending_ids) < RECOVERY_PAGE_SIZE:
+                break
+            after_id = pending_ids[-1]
+        if self.recovered:
+            print(f"Re-queued {self.recovered} pending events for inference.")
+
+    def _max_event_id(self) -> int:
+        db = self.session_factory()
+        try:
+            return db.query(func.max(models.EventLog.id)).scalar() or 0
+        finally:
+            db.close()
+
+    def _pending_ids(self, after_id: int, last_id: int, limit: int) -> List[int]:
+        db = self.session_factory()
+        try:
+            return [
+                event_id for (event_id,) in db.query(models.EventLog.id)
+                .filter(models.EventLog.status == "pending",
+                        models.EventLog.id > after_id, models.EventLog.id <= last_id)
+                .order_by(models.EventLog.id)
+                .limit(limit)
+            ]
+        finally:
+            db.close()
+
+    async def _worker(self):
+        while True:
+            event_id = await self.queue.get()
+            self.in_flight += 1
+            try:
+                succeeded = await asyncio.to_thread(self._process, event_id)
+                if succeeded:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            finally:
+                self.in_flight -= 1
+                self.queue.task_done()
+
+    def _process(self, event_id: int) -> bool:
+        """1件のイベントに推論を実行し、結果を推論結果のテーブルに記録してステータスを更新する"""
+        db = self.session_factory()
+        try:
+            db_event = db.query(models.EventLog).filter(models.EventLog.id == event_id).first()
+            if db_event is None:
+                return False
+            started = time.perf_counter()
+            try:
+                query_str = json.dumps(db_event.raw_event, ensure_ascii=False, indent=2)
+                inference_result = self.ask(query_str)
+            except Exception as e:
+                latency_ms = (time.perf_counter() - started) * 1000
+                db_event.status = "error"
+                event_logger.log_inference_result(db, event_id, latency_ms=latency_ms, error=str(e))
+                return False
+
+            latency_ms = (time.perf_counter() - started) * 1000
+            db_event.status = "processed"
+            event_logger.log_inference_result(db, event_id, inference_result, latency_ms=latency_ms)
+            return True
+        finally:
+            db.close()
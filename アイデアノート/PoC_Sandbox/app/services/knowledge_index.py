@@ -0,0 +1,179 @@
+import os
+import re
+import json
+import glob
+import hashlib
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+
+MANIFEST_FILENAME = "manifest.json"
+HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.+?)\s*$")
+
+
+def split_markdown_sections(content):
+    """マークダウンを見出しごとのセクションに分割し、(見出しの階層, 本文) のリストを返す
+
+    見出しの階層は "親 > 子" の形式。本文のない見出し (子の見出しがすぐ続くもの) は単独のセクションにしない。
+    """
+    sections = []
+    titles = []
+    lines = []
+
+    def flush():
+        body = "\n".join(lines).strip()
+        if body and titles:
+            sections.append((" > ".join(title for _, title in titles), body))
+        elif body:
+            sections.append(("", body))
+
+    in_code_block = False
+    for line in content.splitlines():
+        if line.lstrip().startswith("```"):
+            in_code_block = not in_code_block
+        match = None if in_code_block else HEADING_PATTERN.match(line)
+        if match is None:
+            lines.append(line)
+            continue
+        flush()
+        level = len(match.group(1))
+        titles = [(lvl, title) for lvl, title in titles if lvl < level] + [(level, match.group(2))]
+        lines = []
+    flush()
+    return sections
+
+
+class KnowledgeIndex:
+    """ナレッジベースのFAISSインデックスとチャンクの対応表をディスクに保存し、差分だけを再構築する
+
+    文書ごとに内容のハッシュを記録しておき、起動時には保存済みのインデックスを読み込む。
+    追加・変更された文書だけを分割・埋め込みし、変更・削除された文書のチャンクはインデックスから除く。
+    split_mode="sections" では、文字数ではなくマークダウンの見出し単位で分割する (推論の検索のみの経路で使う)。
+    """
+
+    def __init__(self, source_dirs, index_dir, embeddings, embedding_model_name,
+                 chunk_size=1000, chunk_overlap=100, split_mode="chunks", vectorstore_kwargs=None):
+        self.source_dirs = list(source_dirs)
+        self.index_dir = index_dir
+        self.embeddings = embeddings
+        self.embedding_model_name = embedding_model_name
+        self.split_mode = split_mode
+        self.vectorstore_kwargs = vectorstore_kwargs or {} # FAISS の距離の種類など
+        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.manifest_path = os.path.join(index_dir, MANIFEST_FILENAME)
+        self.last_refresh = None # 直近の load_or_build で再利用・再埋め込み・削除した文書数
+
+    def _scan_documents(self):
+        """対象ディレクトリのマークダウン文書を {パス: (内容, ハッシュ)} で返す"""
+        documents = {}
+        for source_dir in self.source_dirs:
+            for path in sorted(glob.glob(os.path.join(source_dir, "**", "*.md"), recursive=True)):
+                with open(path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+                documents[path] = (content, hashlib.sha256(content.encode("utf-8")).hexdigest())
+        return documents
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        # 埋め込みモデルやチャンク設定が変わった場合は、保存済みのベクトルを使えない
+        if (manifest.get("embedding_model") != self.embedding_model_name
+                or manifest.get("split_mode", "chunks") != self.split_mode
+                or manifest.get("chunk_size") != self.text_splitter._chunk_size
+                or manifest.get("chunk_overlap") != self.text_splitter._chunk_overlap):
+            return None
+        return manifest
+
+    def _split(self, path, content, content_hash):
+        """1つの文書をチャンクに分割し、パスと内容のハッシュから決まるIDを付ける (同じ内容の別ファイルと衝突しない)"""
+        if self.split_mode == "sections":
+            chunks = [
+                Document(page_content=f"## {title}\n{body}" if title else body, metadata={"source": path, "section": title})
+                for title, body in split_markdown_sections(content)
+            ]
+        else:
+            chunks = self.text_splitter.split_documents([Document(page_content=content, metadata={"source": path})])
+        path_hash = hashlib.sha256(path.encode("utf-8")).hexdigest()
+        ids = [f"{path_hash[:12]}-{content_hash[:16]}-{i}" for i in range(len(chunks))]
+        return chunks, ids
+
+    def load_or_build(self):
+        """保存済みのインデックスを読み込み、文書の追加・変更・削除を反映して返す"""
+        documents = self._scan_documents()
+        if not documents:
+            raise ValueError(f"No knowledge documents found in {self.source_dirs}.")
+
+        manifest = self._load_manifest()
+        vectorstore = None
+        indexed = {}
+        if manifest is not None and os.path.exists(os.path.join(self.index_dir, "index.faiss")):
+            vectorstore = FAISS.load_local(self.index_dir, self.embeddings, allow_dangerous_deserialization=True,
+                                           **self.vectorstore_kwargs)
+            indexed = manifest.get("documents", {})
+
+        changed = [path for path, (_, content_hash) in documents.items()
+                   if indexed.get(path, {}).get("hash") != content_hash]
+        removed = [path for path in indexed if path not in documents]
+
+        # 追加・変更された文書だけを分割する
+        new_chunks, new_ids = [], []
+        new_entries = {}
+        for path in changed:
+            content, content_hash = documents[path]
+            chunks, ids = self._split(path, content, content_hash)
+            new_chunks.extend(chunks)
+            new_ids.extend(ids)
+            new_entries[path] = {"hash": content_hash, "chunk_ids": ids}
+
+        # 変更・削除された文書の古いチャンクを取り除く
+        # (前回の保存が対応表の書き換え前に中断した場合に備え、これから追加するIDも既存なら消しておく)
+        if vectorstore is not None:
+            stale_ids = [chunk_id for path in changed + removed for chunk_id in indexed.get(path, {}).get("chunk_ids", [])]
+            present = set(vectorstore.index_to_docstore_id.values())
+            stale_ids = [chunk_id for chunk_id in dict.fromkeys(stale_ids + new_ids) if chunk_id in present]
+            if stale_ids:
+                vectorstore.delete(stale_ids)
+
+        # 分割したチャンクをまとめて埋め込む
+        if new_chunks:
+            if vectorstore is None:
+                vectorstore = FAISS.from_documents(new_chunks, self.embeddings, ids=new_ids, **self.vectorstore_kwargs)
+            else:
+                vectorstore.add_documents(new_chunks, ids=new_ids)
+        if vectorstore is None:
+            # 文書はあってもすべて空で、保存済みのインデックスもない (保存も検索もできない)
+            raise ValueError(f"No knowledge documents with content found in {self.source_dirs}.")
+
+        entries = {path: entry for path, entry in indexed.items() if path in documents and path not in new_entries}
+        entries.update(new_entries)
+
+        if changed or removed or manifest is None:
+            self._save(vectorstore, entries)
+
+        self.last_refresh = {
+            "documents": len(documents),
+            "reused_documents": len(documents) - len(changed),
+            "reembedded_documents": len(changed),
+            "reembedded_chunks": len(new_chunks),
+            "removed_documents": len(removed)
+        }
+        print(f"Knowledge index ready: {self.last_refresh}")
+        return vectorstore
+
+    def _save(self, vectorstore, entries):
+        """インデックスを保存した後に対応表を書き換える (対応表が常に保存済みのインデックス以前を指すようにする)"""
+        if not os.path.exists(self.index_dir):
+            os.makedirs(self.index_dir)
+        vectorstore.save_local(self.index_dir)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "embedding_model": self.embedding_model_name,
+                "split_mode": self.split_mode,
+                "chunk_size": self.text_splitter._chunk_size,
+                "chunk_overlap": self.text_splitter._chunk_overlap,
+                "documents": entries
+            }, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
@@ -1,17 +1,52 @@
 import json
 import os
 import glob
+from concurrent.futures import ThreadPoolExecutor
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import PromptTemplate
 from dotenv import load_dotenv
+from .log_store import LogStore
+from .classification_agent import ClassificationAgent
+from .log_selection import group_logs, select_representatives, chunk_groups, format_group
+from .rate_limiter import call_with_retry
+from . import metrics
 
 load_dotenv()
 
+# 1回のプロンプトに載せるログの量 (推定トークン数)
+DEFAULT_TOKEN_BUDGET = int(os.getenv("SYNTHESIS_TOKEN_BUDGET", "6000"))
+# 代表ログに入らなかったログを要約する map ステップの最大回数 (1回のプロンプトも DEFAULT_TOKEN_BUDGET まで)
+DEFAULT_MAX_MAP_CHUNKS = int(os.getenv("SYNTHESIS_MAX_MAP_CHUNKS", "4"))
+
+MAP_PROMPT = """あなたは、シニアレベルのサイト信頼性エンジニア(SRE)です。
+以下は「{category_name}」という問題カテゴリに分類されたイベントログの一部です。
+先頭の count は、同じ内容のログ (IDや時刻、数値の違いを除く) の件数です。
+
+これらのログに見られるパターン、頻度、特徴的なエラーやサービスを、箇条書きで簡潔に要約してください。
+
+## ログ
+{logs_data}
+"""
+
 class KnowledgeSynthesisAgent:
-    def __init__(self, logs_dir="アイデアノート/PoC_Sandbox/data/raw_event_logs", categories_path="アイデアノート/PoC_Sandbox/data/discovered_categories.json"):
+    def __init__(self, logs_dir="アイデアノート/PoC_Sandbox/data/raw_event_logs", categories_path="アイデアノート/PoC_Sandbox/data/discovered_categories.json",
+                 token_budget=DEFAULT_TOKEN_BUDGET, map_reduce=True, max_map_chunks=DEFAULT_MAX_MAP_CHUNKS,
+                 use_embeddings=True, rate_limiter=None, max_retries=3, embedding_model=None, llm=None):
         self.logs_dir = logs_dir
+        # ログがセグメント化されたストアに保存されていれば、ファイルを個別に開かずにインデックスから引く
+        self.log_store = LogStore(logs_dir) if LogStore.is_store(logs_dir) else None
         self.categories = self._load_json(categories_path)
-        self.llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.2)
+        self.llm = llm or ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0.2)
+        # カテゴリのログが何件あっても、プロンプトは token_budget 程度、LLMの呼び出しは最大 1 + max_map_chunks 回に収める
+        self.token_budget = token_budget
+        self.map_reduce = map_reduce
+        self.max_map_chunks = max_map_chunks
+        # 代表ログの選択に使う埋め込み (発見・分類と同じキャッシュ付きモデルなので、多くはキャッシュから引ける)
+        self.log_embedder = ClassificationAgent(category_centroids={}, embedding_model=embedding_model) if use_embeddings else None
+        # map ステップのLLM呼び出しにも適用するレート制限 (TokenBucket)
+        self.rate_limiter = rate_limiter
+        # map ステップの各チャンクで、一時的なエラーを再試行する回数
+        self.max_retries = max_retries
 
     def _load_json(self, path):
         try:
@@ -21,25 +56,49 @@ class KnowledgeSynthesisAgent:
             print(f"Error: File not found at {path}")
             return None
 
-    def synthesize_knowledge_for_category(self, category_id, log_ids):
-        """特定のカテゴリに属するログから、ナレッジ記事を生成する"""
+    def synthesize_knowledge_for_category(self, category_id, log_ids=None, logs=None):
+        """特定のカテゴリに属するログから、ナレッジ記事を生成する
+
+        読み込み済みのログを logs で渡した場合は、ログファイルを開かずにそれを使う。
+        """
         if not self.categories or category_id not in self.categories:
             return f"Category ID '{category_id}' not found."
 
         category_name = self.categories[category_id]['name']
 
-        # 該当するログファイルの内容を読み込む
-        log_contents = []
-        for log_id in log_ids:
-            log_path = os.path.join(self.logs_dir, f"{log_id}.json")
-            log_data = self._load_json(log_path)
-            if log_data:
-                log_contents.append(log_data)
+        if logs is not None:
+            log_contents = list(logs)
+        elif self.log_store is not None:
+            log_contents = self.log_store.get_many(log_ids or [])
+        else:
+            # 該当するログファイルの内容を読み込む
+            log_contents = []
+            for log_id in log_ids or []:
+                log_path = os.path.join(self.logs_dir, f"{log_id}.json")
+                log_data = self._load_json(log_path)
+                if log_data:
+                    log_contents.append(log_data)
         
         if not log_contents:
             return f"No logs found for category '{category_name}'."
 
-        logs_str = "\\n---\\n".join([json.dumps(log, ensure_ascii=False, indent=2) for log in log_contents])
+        # 重複をまとめ、トークン予算の範囲で重心に近いログと多様な外れ値を選ぶ
+        groups = group_logs(log_contents)
+        selected, rest = select_representatives(groups, self.token_budget, vectors=self._embed_groups(groups))
+        logs_str = "\\n---\\n".join([format_group(group) for group in selected])
+        log_overview = (
+            f"全{len(log_contents)}件のログを、IDや時刻、数値の違いを除いて同じ内容のものにまとめると{len(groups)}種類になります。"
+            f"そのうち代表的な{len(selected)}種類 ({sum(group.count for group in selected)}件分) を示します。"
+            f"各ログ先頭の count は同じ内容のログの件数です。"
+        )
+        print(f"Selected {len(selected)} of {len(groups)} log templates "
+              f"({len(log_contents)} logs) for '{category_name}'.")
+
+        # 代表ログに入らなかった分は、チャンクごとに要約してから最終的な記事の材料にする (map-reduce)
+        if rest and self.map_reduce and self.max_map_chunks > 0:
+            summaries = self._summarize_groups(category_name, rest)
+            if summaries:
+                logs_str += "\\n\\n## 代表ログ以外のログの要約\\n" + "\\n---\\n".join(summaries)
 
         prompt = PromptTemplate.from_template(
             """あなたは、シニアレベルのサイト信頼性エンジニア(SRE)です。
@@ -54,6 +113,8 @@ class KnowledgeSynthesisAgent:
             - **恒久的な解決策/予防策**: この問題を将来的に防ぐための、より根本的な解決策やアーキテクチャの改善案を提案してください。
 
             ## 分析対象のログ群
+            {log_overview}
+
             {logs_data}
 
             ## 生成するナレッジ記事（マークダウン形式）
@@ -62,13 +123,55 @@ class KnowledgeSynthesisAgent:
         )
 
         chain = prompt | self.llm
-        response = chain.invoke({
-            "category_name": category_name,
-            "logs_data": logs_str
-        })
+        with metrics.span("synthesis_llm"):
+            response = chain.invoke({
+                "category_name": category_name,
+                "log_overview": log_overview,
+                "logs_data": logs_str
+            })
 
         return f"# {category_name} 対応マニュアル\\n" + response.content.strip()
 
+    def _embed_groups(self, groups):
+        """各グループの代表ログを埋め込む。埋め込みが使えなければ None (件数と単語の重なりで選ぶ)"""
+        if self.log_embedder is None or len(groups) < 2:
+            return None
+        try:
+            return self.log_embedder.embed_logs([group.representative for group in groups])
+        except Exception as e:
+            print(f"Warning: Could not embed logs for selection, falling back to frequency ({e}).")
+            return None
+
+    def _summarize_groups(self, category_name, groups):
+        """グループを token_budget ごとのチャンクに分けて並行して要約し、要約のリストを返す (map ステップ)
+
+        チャンクごとにレート制限のトークンを取ってから呼び出し、一時的なエラーはそのチャンクだけ再試行する。
+        """
+        chunks = chunk_groups(groups, self.token_budget, self.max_map_chunks)
+        dropped = len(groups) - sum(len(chunk) for chunk in chunks)
+        if dropped:
+            print(f"Map step for '{category_name}' skips {dropped} rare log templates beyond {self.max_map_chunks} chunks.")
+        if not chunks:
+            return []
+
+        chain = PromptTemplate.from_template(MAP_PROMPT) | self.llm
+
+        def summarize(numbered_chunk):
+            number, chunk = numbered_chunk
+            inputs = {"category_name": category_name,
+                      "logs_data": "\\n---\\n".join(format_group(group) for group in chunk)}
+            return call_with_retry(
+                lambda: chain.invoke(inputs),
+                max_retries=self.max_retries,
+                before_attempt=self.rate_limiter.acquire if self.rate_limiter is not None else None,
+                label=f"{category_name} (map {number + 1}/{len(chunks)})"
+            )
+
+        with metrics.span("synthesis_map_llm", items=len(chunks)), \
+                ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            responses = list(executor.map(summarize, enumerate(chunks)))
+        return [response.content.strip() for response in responses]
+
 # このファイル単体での実行ロジックは、パイプラインに統合されたため不要。
 # if __name__ == '__main__':
 #     agent = KnowledgeSynthesisAgent()
@@ -0,0 +1,197 @@
+import re
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, Optional
+import numpy as np
+
+# ログごとに値が異なるだけで、内容の種類を区別しないフィールド
+VOLATILE_FIELDS = ("log_id", "timestamp")
+MASKED_FIELDS = ("user_id", "ip_address", "product_id", "price", "quantity", "request_id", "session_id")
+# 文字列の中の可変部分 (上から順に置き換える)
+TEMPLATE_PATTERNS = (
+    (re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b"), "<uuid>"),
+    (re.compile(r"\b\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?"), "<timestamp>"),
+    (re.compile(r"\b\d{1,3}(?:\.\d{1,3}){3}\b"), "<ip>"),
+    (re.compile(r"\b[0-9a-fA-F]{12,}\b"), "<hex>"),
+    # "svc3" のような名前の一部の数字は残す
+    (re.compile(r"(?<![A-Za-z_])\d+(?:\.\d+)?"), "<num>"),
+)
+# 外れ値として選ぶ候補の上限 (件数の多い順)。距離の計算は候補の数に比例するため、種類が多いカテゴリでも抑える
+MAX_OUTLIER_CANDIDATES = 1000
+
+
+@dataclass
+class LogGroup:
+    """同じテンプレートに属するログのまとまり (代表のログ1件と件数)"""
+    template: str
+    representative: Dict[str, Any]
+    count: int = 1
+    first_seen: Optional[str] = None
+    last_seen: Optional[str] = None
+
+
+@lru_cache(maxsize=65536)
+def _mask_text(text):
+    # event_type やサービス名など、同じ文字列が何度も現れるのでキャッシュする
+    for pattern, replacement in TEMPLATE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _mask(value):
+    if isinstance(value, dict):
+        return {key: "<masked>" if key in MASKED_FIELDS else _mask(item)
+                for key, item in value.items() if key not in VOLATILE_FIELDS}
+    if isinstance(value, list):
+        return [_mask(item) for item in value]
+    if isinstance(value, str):
+        return _mask_text(value)
+    return value
+
+
+def log_template(log):
+    """ログIDや時刻、ユーザーID、文字列中の数値などを伏せた、ログの「型」を表す文字列"""
+    return json.dumps(_mask(log), ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def group_logs(logs):
+    """完全一致とテンプレートが同じログをまとめ、件数の多い順に LogGroup のリストで返す"""
+    groups = {}
+    for log in logs:
+        template = log_template(log)
+        timestamp = str(log["timestamp"]) if log.get("timestamp") else None
+        group = groups.get(template)
+        if group is None:
+            groups[template] = LogGroup(template, log, 1, timestamp, timestamp)
+            continue
+        group.count += 1
+        if timestamp:
+            group.first_seen = min(group.first_seen or timestamp, timestamp)
+            group.last_seen = max(group.last_seen or timestamp, timestamp)
+    return sorted(groups.values(), key=lambda group: group.count, reverse=True)
+
+
+def estimate_tokens(text):
+    """プロンプトのトークン数の概算 (日本語と英語の混在を考慮し、UTF-8で3バイトを1トークンとする)"""
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+def format_group(group):
+    """プロンプトに載せる形式 (件数と期間 + 代表のログを1行のJSON)"""
+    log = {key: value for key, value in group.representative.items() if key not in VOLATILE_FIELDS}
+    header = f"[count: {group.count}"
+    if group.first_seen:
+        header += f", first: {group.first_seen}" if group.first_seen == group.last_seen \
+            else f", first: {group.first_seen}, last: {group.last_seen}"
+    return f"{header}] {json.dumps(log, ensure_ascii=False, separators=(',', ':'))}"
+
+
+def _jaccard_distances(groups):
+    """テンプレートの単語の集合を0/1の行列にし、Jaccard 距離を行列とベクトルの積で計算する"""
+    token_sets = [set(re.findall(r"\w+", group.template)) for group in groups]
+    vocabulary = {token: n for n, token in enumerate(set().union(*token_sets))}
+    matrix = np.zeros((len(groups), max(len(vocabulary), 1)), dtype=np.float32)
+    for row, tokens in enumerate(token_sets):
+        matrix[row, [vocabulary[token] for token in tokens]] = 1.0
+    sizes = matrix.sum(axis=1)
+
+    def distances_from(j):
+        intersection = matrix @ matrix[j]
+        return 1.0 - intersection / np.maximum(sizes + sizes[j] - intersection, 1.0)
+    return distances_from
+
+
+def _farthest_first(candidates, selected, distances_from, size):
+    """選択済みのものから最も遠い候補を1つずつ返す (多様な外れ値の選択)
+
+    distances_from(j) は全グループから j までの距離の配列を返す。
+    """
+    nearest = np.ones(size)
+    for j in selected:
+        nearest = np.minimum(nearest, distances_from(j))
+    remaining = np.zeros(size, dtype=bool)
+    remaining[list(candidates)] = True
+    while remaining.any():
+        best = int(np.argmax(np.where(remaining, nearest, -np.inf)))
+        remaining[best] = False
+        yield best
+        nearest = np.minimum(nearest, distances_from(best))
+
+
+def select_representatives(groups, token_budget, vectors=None, outlier_fraction=0.3):
+    """トークン予算の範囲で、代表的なロググループを選ぶ
+
+    予算の (1 - outlier_fraction) を重心に近いグループ、残りを選択済みから遠い外れ値に使う
+    (外れ値の候補は、選ばなかったグループのうち件数の多い MAX_OUTLIER_CANDIDATES 件まで)。
+    vectors (グループごとの埋め込み) がなければ、件数の多さを重心への近さ、
+    テンプレートの単語の重なり (Jaccard) を距離の代わりに使う。
+    (選んだグループのリスト, 選ばなかったグループのリスト) を返す。
+    """
+    if not groups:
+        return [], []
+    costs = [estimate_tokens(format_group(group)) for group in groups]
+
+    if vectors is not None:
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        counts = np.array([group.count for group in groups], dtype=np.float32)
+        centroid = (matrix * counts[:, None]).sum(axis=0)
+        centroid /= max(float(np.linalg.norm(centroid)), 1e-12)
+        central_order = np.argsort(-(matrix @ centroid)).tolist()
+    else:
+        central_order = list(range(len(groups))) # group_logs が件数の多い順に並べている
+
+    selected, used = [], 0
+    core_budget = token_budget * (1.0 - outlier_fraction)
+    for i in central_order:
+        if used + costs[i] > core_budget:
+            break
+        selected.append(i)
+        used += costs[i]
+
+    chosen = set(selected)
+    candidates = [i for i in range(len(groups)) if i not in chosen][:MAX_OUTLIER_CANDIDATES]
+    smallest = min((costs[i] for i in candidates), default=0)
+    if outlier_fraction > 0 and candidates:
+        # 距離は選択済みと候補の間だけで計算する (pool の中の位置で扱い、グループの番号に戻す)
+        pool = selected + candidates
+        if vectors is not None:
+            pool_matrix = matrix[pool]
+            distances_from = lambda j: 1.0 - pool_matrix @ pool_matrix[j]
+        else:
+            distances_from = _jaccard_distances([groups[i] for i in pool])
+        positions = range(len(selected), len(pool))
+        order = (pool[position] for position in
+                 _farthest_first(positions, range(len(selected)), distances_from, len(pool)))
+    else:
+        order = candidates
+    for i in order:
+        if token_budget - used < smallest:
+            break
+        if used + costs[i] <= token_budget:
+            selected.append(i)
+            used += costs[i]
+
+    chosen = set(selected)
+    return [groups[i] for i in selected], [group for i, group in enumerate(groups) if i not in chosen]
+
+
+def chunk_groups(groups, token_budget, max_chunks=None):
+    """グループを、1つあたり token_budget に収まるチャンクに分ける (map-reduce の map 用)
+
+    max_chunks を超える分は、件数の少ないグループから切り捨てる (groups は件数の多い順を想定)。
+    """
+    chunks, current, used = [], [], 0
+    for group in groups:
+        cost = estimate_tokens(format_group(group))
+        if current and used + cost > token_budget:
+            chunks.append(current)
+            if max_chunks is not None and len(chunks) >= max_chunks:
+                return chunks
+            current, used = [], 0
+        current.append(group)
+        used += cost
+    if current and (max_chunks is None or len(chunks) < max_chunks):
+        chunks.append(current)
+    return chunks
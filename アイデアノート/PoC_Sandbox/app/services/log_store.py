@@ -0,0 +1,299 @@
+import os
+import json
+import mmap
+import glob
+import hashlib
+from datetime import datetime
+import numpy as np
+
+# インデックスは固定長レコードの配列として保存し、numpyでそのままメモリマップして引く
+LOG_ID_BYTES = 48
+INDEX_DTYPE = np.dtype([
+    ("log_id", f"S{LOG_ID_BYTES}"),
+    ("segment", "<u4"),
+    ("offset", "<u8"),
+    ("length", "<u4"),
+    ("timestamp", "<f8"), # UNIX時刻 (timestampが無いログは NaN)
+])
+INDEX_FILENAME = "index.bin"
+# flush ごとの追記分は、ソート済みの index.bin とは別のファイルに追記し、溜まったらまとめてマージする
+INDEX_DELTA_FILENAME = "index.delta.bin"
+# 追記分が index.bin の件数のこの割合 (かつ INDEX_COMPACT_MIN_RECORDS 件) を超えたらマージする
+INDEX_COMPACT_RATIO = 0.25
+INDEX_COMPACT_MIN_RECORDS = 4096
+# scan_time_range でまとめて読むレコード数 (メモリに載るのはこの件数分のログだけ)
+SCAN_CHUNK_SIZE = 1000
+SEGMENT_PATTERN = "segment_{:06d}.ndjson"
+DEFAULT_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def _index_key(log_id):
+    """インデックスに保存する log_id のキー
+
+    LOG_ID_BYTES バイトを超えるIDは、切り詰めると別のIDと衝突しうるので、SHA-256 のダイジェストにする。
+    先頭の 0xff はUTF-8に現れないバイトなので、ダイジェストのキーが短いIDのキーと重なることはない。
+    """
+    key = str(log_id).encode("utf-8")
+    if len(key) > LOG_ID_BYTES:
+        key = b"\xff" + hashlib.sha256(key).digest()
+    return key
+
+
+def _to_epoch(timestamp):
+    if timestamp is None:
+        return float("nan")
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    try:
+        return datetime.fromisoformat(str(timestamp)).timestamp()
+    except ValueError:
+        return float("nan")
+
+
+class LogStore:
+    """追記専用のデータセグメントと log_id → (セグメント, オフセット) のインデックスで構成するログストア
+
+    ログは1行1件のNDJSONとしてセグメントファイルに追記し、セグメントが segment_max_bytes を
+    超えたら次のファイルに切り替える。インデックスは log_id の昇順に並んだ固定長レコードで、
+    IDでの検索は二分探索、timestampでの範囲検索はインデックスの列に対するベクトル演算で行う。
+    どちらもディレクトリの走査やログ本体の全件読み込みを必要としない。
+    flush の追記分は index.delta.bin に追記するだけにし、index.bin の書き直しは追記分が
+    一定の割合まで溜まったときにまとめて行う (flush のたびにインデックス全体を書き直さない)。
+    """
+
+    def __init__(self, root_dir, segment_max_bytes=DEFAULT_SEGMENT_MAX_BYTES):
+        self.root_dir = root_dir
+        self.segment_max_bytes = segment_max_bytes
+        self.index_path = os.path.join(root_dir, INDEX_FILENAME)
+        self.delta_path = os.path.join(root_dir, INDEX_DELTA_FILENAME)
+        if not os.path.exists(root_dir):
+            os.makedirs(root_dir)
+
+        self._pending = [] # flush前の新しいインデックスレコード
+        self._writer = None
+        self._segment = self._last_segment()
+        self._index = None
+        self._index_mmap = None
+
+    @staticmethod
+    def is_store(path):
+        """path がログストアのディレクトリかどうか"""
+        return os.path.isfile(os.path.join(path, INDEX_FILENAME))
+
+    # --- 書き込み ---
+
+    def _segment_path(self, segment):
+        return os.path.join(self.root_dir, SEGMENT_PATTERN.format(segment))
+
+    def _last_segment(self):
+        segments = glob.glob(os.path.join(self.root_dir, "segment_*.ndjson"))
+        if not segments:
+            return 0
+        return max(int(os.path.basename(p)[len("segment_"):-len(".ndjson")]) for p in segments)
+
+    def append(self, log):
+        """ログを1件追記する。インデックスへの反映は flush() 時に行う"""
+        if self._writer is None:
+            self._writer = open(self._segment_path(self._segment), 'ab')
+        if self._writer.tell() >= self.segment_max_bytes:
+            self._writer.close()
+            self._segment += 1
+            self._writer = open(self._segment_path(self._segment), 'ab')
+
+        line = (json.dumps(log, ensure_ascii=False) + "\n").encode("utf-8")
+        log_id = _index_key(log["log_id"])
+
+        offset = self._writer.tell()
+        self._writer.write(line)
+        self._pending.append((log_id, self._segment, offset, len(line), _to_epoch(log.get("timestamp"))))
+
+    def append_many(self, logs):
+        for log in logs:
+            self.append(log)
+
+    def flush(self):
+        """セグメントを書き出し、追記分のインデックスレコードを index.delta.bin に追記する
+
+        追記分が index.bin に比べて十分に溜まったら、マージした index.bin にアトミックに置き換える。
+        """
+        if self._writer is not None:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+        if not self._pending:
+            return
+
+        new_records = np.array(self._pending, dtype=INDEX_DTYPE)
+        self._pending = []
+        if not os.path.exists(self.index_path):
+            self._write_base(self._dedupe(new_records))
+            return
+
+        with open(self.delta_path, 'ab') as f:
+            new_records.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        self._close_index()
+
+        base_count = os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize
+        delta_count = os.path.getsize(self.delta_path) // INDEX_DTYPE.itemsize
+        if delta_count >= max(INDEX_COMPACT_MIN_RECORDS, base_count * INDEX_COMPACT_RATIO):
+            self.compact()
+
+    def compact(self):
+        """index.delta.bin の追記分を index.bin にマージする"""
+        if not os.path.exists(self.delta_path):
+            return
+        merged = np.array(self._load_index())
+        self._write_base(merged)
+        # 置き換えた後で追記分を消す (途中で止まっても、次の読み込みで同じレコードが重ねてマージされるだけ)
+        os.remove(self.delta_path)
+        self._close_index()
+
+    def _write_base(self, records):
+        self._close_index()
+        tmp_path = f"{self.index_path}.tmp"
+        records.tofile(tmp_path)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def _dedupe(records):
+        """log_idの昇順に並べ、同じlog_idが複数ある場合は後から追記されたものを残す"""
+        records = records[np.argsort(records["log_id"], kind="stable")]
+        is_last = np.ones(len(records), dtype=bool)
+        is_last[:-1] = records["log_id"][:-1] != records["log_id"][1:]
+        return records[is_last]
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._close_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- 読み込み ---
+
+    def _load_index(self):
+        """インデックスを log_id の昇順の構造化配列として返す
+
+        index.bin はメモリマップしてそのまま使い、index.delta.bin に追記分があれば読み込んでマージする。
+        """
+        if self._index is not None:
+            return self._index
+        if not os.path.exists(self.index_path) or os.path.getsize(self.index_path) == 0:
+            base = np.empty(0, dtype=INDEX_DTYPE)
+        else:
+            with open(self.index_path, 'rb') as f:
+                self._index_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            base = np.frombuffer(self._index_mmap, dtype=INDEX_DTYPE)
+        delta = np.empty(0, dtype=INDEX_DTYPE)
+        if os.path.exists(self.delta_path):
+            # 書き込み途中の末尾のレコードは読まない
+            delta_count = os.path.getsize(self.delta_path) // INDEX_DTYPE.itemsize
+            delta = np.fromfile(self.delta_path, dtype=INDEX_DTYPE, count=delta_count)
+        self._index = self._dedupe(np.concatenate([base, delta])) if len(delta) else base
+        return self._index
+
+    def _close_index(self):
+        # 呼び出し元に配列のビューが残っていることがあるため、mmapは明示的に閉じずに参照を手放す
+        self._index = None
+        self._index_mmap = None
+
+    def __len__(self):
+        return len(self._load_index())
+
+    def _read_records(self, records):
+        """インデックスレコード群に対応するログを、セグメントごと・オフセット順にまとめて読む"""
+        logs = [None] * len(records)
+        order = np.lexsort((records["offset"], records["segment"]))
+        handle, handle_segment = None, None
+        try:
+            for position in order:
+                record = records[position]
+                if handle_segment != record["segment"]:
+                    if handle is not None:
+                        handle.close()
+                    handle_segment = record["segment"]
+                    handle = open(self._segment_path(int(handle_segment)), 'rb')
+                handle.seek(int(record["offset"]))
+                logs[position] = json.loads(handle.read(int(record["length"])))
+        finally:
+            if handle is not None:
+                handle.close()
+        return logs
+
+    def get(self, log_id):
+        """IDでログを1件取得する。見つからなければ None"""
+        logs = self.get_many([log_id])
+        return logs[0] if logs else None
+
+    def get_many(self, log_ids):
+        """複数のIDのログを取得する。見つからなかったIDは結果から除かれる"""
+        index = self._load_index()
+        if not len(index) or not log_ids:
+            return []
+        keys = np.array([_index_key(log_id) for log_id in log_ids], dtype=f"S{LOG_ID_BYTES}")
+        positions = np.searchsorted(index["log_id"], keys)
+        positions = np.minimum(positions, len(index) - 1)
+        found = index["log_id"][positions] == keys
+        return self._read_records(index[positions[found]])
+
+    def scan_time_range(self, start=None, end=None):
+        """timestampが [start, end) に入るログを時刻順に1件ずつ返す。start/endはISO形式の文字列かUNIX時刻
+
+        ログ本体は SCAN_CHUNK_SIZE 件ずつ読むので、範囲が広くてもメモリに載るのはその件数分だけになる。
+        """
+        index = self._load_index()
+        timestamps = index["timestamp"]
+        mask = ~np.isnan(timestamps)
+        if start is not None:
+            mask &= timestamps >= _to_epoch(start)
+        if end is not None:
+            mask &= timestamps < _to_epoch(end)
+        records = index[np.nonzero(mask)[0]]
+        records = records[np.argsort(records["timestamp"], kind="stable")]
+        for chunk_start in range(0, len(records), SCAN_CHUNK_SIZE):
+            yield from self._read_records(records[chunk_start:chunk_start + SCAN_CHUNK_SIZE])
+
+    def end_position(self):
+        """ディスク上の追記位置 (最後のセグメント番号, そのサイズ) を返す。scan_from_position に渡すと、これ以降の追記分だけを読める"""
+        segment = self._last_segment()
+        path = self._segment_path(segment)
+        return [segment, os.path.getsize(path) if os.path.exists(path) else 0]
+
+    def scan_from_position(self, position):
+        """追記位置 position (end_position の戻り値) 以降に追記されたログを、追記順に1件ずつ返す
+
+        timestampではなく追記の順序で絞り込むので、古いtimestampのログが遅れて届いても漏れない。
+        """
+        index = self._load_index()
+        segment, offset = position
+        mask = (index["segment"] > segment) | ((index["segment"] == segment) & (index["offset"] >= offset))
+        records = index[np.nonzero(mask)[0]]
+        records = records[np.lexsort((records["offset"], records["segment"]))]
+        for chunk_start in range(0, len(records), SCAN_CHUNK_SIZE):
+            yield from self._read_records(records[chunk_start:chunk_start + SCAN_CHUNK_SIZE])
+
+    def iter_logs(self):
+        """インデックスに載っている最新版のログを、セグメント・オフセット順に1件ずつ返す"""
+        index = self._load_index()
+        order = np.lexsort((index["offset"], index["segment"]))
+        handle, handle_segment = None, None
+        try:
+            for position in order:
+                record = index[position]
+                if handle_segment != record["segment"]:
+                    if handle is not None:
+                        handle.close()
+                    handle_segment = record["segment"]
+                    handle = open(self._segment_path(int(handle_segment)), 'rb')
+                handle.seek(int(record["offset"]))
+                yield json.loads(handle.read(int(record["length"])))
+        finally:
+            if handle is not None:
+                handle.close()
@@ -0,0 +1,94 @@
+import os
+import json
+import gzip
+import glob
+import random
+from itertools import islice
+from .log_store import LogStore
+
+# 1ファイル1ログのJSONと、1行1ログのNDJSONシャード(gzip圧縮も可)を読み込む
+SINGLE_LOG_SUFFIXES = (".json",)
+NDJSON_SUFFIXES = (".ndjson", ".jsonl", ".ndjson.gz", ".jsonl.gz")
+
+
+def iter_log_files(source):
+    """ログのファイルパスを名前順に列挙する。sourceはディレクトリでも単一ファイルでもよい"""
+    if os.path.isfile(source):
+        yield source
+        return
+    paths = []
+    for suffix in SINGLE_LOG_SUFFIXES + NDJSON_SUFFIXES:
+        paths.extend(glob.glob(os.path.join(source, f"*{suffix}")))
+    yield from sorted(set(paths))
+
+
+def _iter_ndjson(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def iter_logs(source):
+    """ログを1件ずつ読み出す。全件をメモリに載せないので、件数が増えても使用メモリは一定"""
+    # セグメント化されたログストアは、インデックスに従って最新版のログだけを読む
+    if os.path.isdir(source) and LogStore.is_store(source):
+        yield from LogStore(source).iter_logs()
+        return
+    for path in iter_log_files(source):
+        if path.endswith(NDJSON_SUFFIXES):
+            yield from _iter_ndjson(path)
+        else:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # 1ファイルにログの配列が入っている場合も受け付ける
+            if isinstance(data, list):
+                yield from data
+            else:
+                yield data
+
+
+def iter_batches(iterable, batch_size):
+    """任意のイテラブルを batch_size 件ずつのリストに区切る"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_log_batches(source, batch_size=1000):
+    """ログを batch_size 件ずつのリストで読み出す"""
+    return iter_batches(iter_logs(source), batch_size)
+
+
+class ReservoirSampler:
+    """ストリームから最大 size 件を一様にサンプリングする (Algorithm R)"""
+
+    def __init__(self, size, seed=42):
+        self.size = size
+        self.seen = 0
+        self.items = []
+        self._random = random.Random(seed)
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+            return
+        index = self._random.randrange(self.seen)
+        if index < self.size:
+            self.items[index] = item
+
+
+def sample_logs(source, size, seed=42):
+    """ログ全体から最大 size 件を一様にサンプリングする。size が None なら全件を返す"""
+    if size is None:
+        return list(iter_logs(source))
+    sampler = ReservoirSampler(size, seed=seed)
+    for log in iter_logs(source):
+        sampler.add(log)
+    return sampler.items
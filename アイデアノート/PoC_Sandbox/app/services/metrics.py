@@ -0,0 +1,227 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# 外部ライブラリを使わない、プロセス内のメトリクス (Prometheus のテキスト形式で出力できる)
+
+# 埋め込みのバッチ (数ミリ秒) からLLMの呼び出し (数十秒) までを1つのヒストグラムで扱えるバケット
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _label_text(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """ラベルごとに増え続ける値"""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, _label_text(self.labelnames, key), value) for key, value in items]
+
+
+class Gauge:
+    """ラベルごとの現在の値 (上下する)"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, _label_text(self.labelnames, key), value) for key, value in items]
+
+
+class Histogram:
+    """ラベルごとの観測値の分布 (累積バケット、合計、件数)"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {} # ラベル -> [各バケットの件数, 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        samples = []
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _label_text(self.labelnames + ("le",), key + (repr(float(bound)),))
+                samples.append((f"{self.name}_bucket", labels, cumulative))
+            samples.append((f"{self.name}_bucket", _label_text(self.labelnames + ("le",), key + ("+Inf",)), count))
+            samples.append((f"{self.name}_sum", _label_text(self.labelnames, key), total))
+            samples.append((f"{self.name}_count", _label_text(self.labelnames, key), count))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        """Prometheus のテキスト形式 (text/plain; version=0.0.4) で全メトリクスを出力する"""
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_DURATION = REGISTRY.histogram(
+    "poc_stage_duration_seconds", "Duration of instrumented processing stages.", ("stage",))
+STAGE_TOTAL = REGISTRY.counter(
+    "poc_stage_total", "Number of times each processing stage ran, by outcome.", ("stage", "status"))
+STAGE_ITEMS = REGISTRY.counter(
+    "poc_stage_items_total", "Number of items (logs, texts, events) processed by each stage.", ("stage",))
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    "poc_http_request_duration_seconds", "Latency of API requests by route.", ("method", "route", "status"))
+
+
+class SpanRecorder:
+    """記録中に完了したスパンを集め、ステージごとの集計を返す (パイプラインの実行レポート用)"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, items, status):
+        with self._lock:
+            self.spans.append({
+                "stage": stage,
+                "offset_seconds": time.perf_counter() - self.started - seconds,
+                "seconds": seconds,
+                "items": items,
+                "status": status
+            })
+
+    def summary(self):
+        """{ステージ: {count, errors, items, total_seconds, mean_seconds, max_seconds}}"""
+        with self._lock:
+            spans = list(self.spans)
+        stages = {}
+        for span in spans:
+            stage = stages.setdefault(span["stage"], {
+                "count": 0, "errors": 0, "items": 0, "total_seconds": 0.0, "max_seconds": 0.0
+            })
+            stage["count"] += 1
+            stage["errors"] += span["status"] == "error"
+            stage["items"] += span["items"] or 0
+            stage["total_seconds"] += span["seconds"]
+            stage["max_seconds"] = max(stage["max_seconds"], span["seconds"])
+        for stage in stages.values():
+            stage["mean_seconds"] = stage["total_seconds"] / stage["count"]
+        return stages
+
+
+_recorders = []
+_recorders_lock = threading.Lock()
+
+
+@contextmanager
+def record_spans():
+    """with ブロックの間に (どのスレッドで) 完了したスパンも SpanRecorder に集める"""
+    recorder = SpanRecorder()
+    with _recorders_lock:
+        _recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        with _recorders_lock:
+            _recorders.remove(recorder)
+
+
+@contextmanager
+def span(stage, items=None):
+    """処理の所要時間を計測し、ステージ別のヒストグラム・カウンタと記録中の SpanRecorder に残す"""
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_DURATION.observe(seconds, stage=stage)
+        STAGE_TOTAL.inc(stage=stage, status=status)
+        if items:
+            STAGE_ITEMS.inc(items, stage=stage)
+        if _recorders:
+            with _recorders_lock:
+                recorders = list(_recorders)
+            for recorder in recorders:
+                recorder.add(stage, seconds, items, status)
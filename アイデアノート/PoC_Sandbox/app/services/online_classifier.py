@@ -0,0 +1,431 @@
+import os
+import sys
+import json
+import time
+import queue
+import shlex
+import threading
+import subprocess
+from collections import deque
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+from . import event_logger, metrics
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 戦略パイプラインの出力先 (APIの作業ディレクトリによらず、strategic_pipeline.py の既定と同じ PoC_Sandbox/data)
+DEFAULT_DATA_DIR = os.getenv("STRATEGIC_DATA_DIR", os.path.join(os.path.dirname(APP_DIR), "data"))
+# 取り込み時の分類は埋め込みのAPIを呼ぶので、明示的に有効にしたときだけ動かす
+ONLINE_CLASSIFICATION_ENABLED = os.getenv("ONLINE_CLASSIFICATION", "false").lower() in ("1", "true", "yes")
+DEFAULT_MAX_BATCH_SIZE = int(os.getenv("ONLINE_CLASSIFICATION_MAX_BATCH_SIZE", "256"))
+DEFAULT_MAX_DELAY_MS = float(os.getenv("ONLINE_CLASSIFICATION_MAX_DELAY_MS", "50"))
+DEFAULT_QUEUE_SIZE = int(os.getenv("ONLINE_CLASSIFICATION_QUEUE_SIZE", "10000"))
+DEFAULT_SIMILARITY_THRESHOLD = float(os.getenv("ONLINE_CLASSIFICATION_THRESHOLD", "0.75"))
+# 直近 window_seconds 秒の未分類の割合が閾値を超えたら、戦略ループの差分実行を起動する
+DEFAULT_WINDOW_SECONDS = float(os.getenv("NOVELTY_WINDOW_SECONDS", "300"))
+DEFAULT_MIN_WINDOW_EVENTS = int(os.getenv("NOVELTY_MIN_EVENTS", "50"))
+DEFAULT_UNCLASSIFIED_THRESHOLD = float(os.getenv("NOVELTY_UNCLASSIFIED_THRESHOLD", "0.2"))
+DEFAULT_REDISCOVERY_COOLDOWN_SECONDS = float(os.getenv("NOVELTY_REDISCOVERY_COOLDOWN_SECONDS", "1800"))
+# 再発見の自動起動 (LLMと埋め込みのAPIを呼ぶパイプラインを起動するので、既定では無効)
+NOVELTY_REDISCOVERY_ENABLED = os.getenv("NOVELTY_REDISCOVERY", "false").lower() in ("1", "true", "yes")
+# 再発見に使うコマンド (省略時は strategic_pipeline.py --incremental)。空文字なら再発見を起動しない
+REDISCOVERY_COMMAND = os.getenv("NOVELTY_REDISCOVERY_COMMAND")
+
+PIPELINE_SCRIPT = os.path.join(APP_DIR, "strategic_pipeline.py")
+# APIのイベントを戦略ループのログとして書き出した位置 (最後に書き出したイベントID) を記録するファイル
+EXPORT_STATE_FILENAME = "api_event_export.json"
+EXPORT_CHUNK_SIZE = 1000
+
+CLASSIFIED_EVENTS = metrics.REGISTRY.counter(
+    "poc_online_classified_events_total", "Ingested events classified against the strategic loop centroids.", ("category",))
+UNCLASSIFIED_RATE = metrics.REGISTRY.gauge(
+    "poc_online_unclassified_rate", "Fraction of events left unclassified in the sliding window.")
+REDISCOVERIES = metrics.REGISTRY.counter(
+    "poc_online_rediscoveries_total", "Incremental strategic pipeline runs triggered by the unclassified rate.")
+EXPORTED_EVENTS = metrics.REGISTRY.counter(
+    "poc_online_exported_events_total", "Ingested events exported to the strategic pipeline's raw logs before rediscovery.")
+CLASSIFICATION_FAILURES = metrics.REGISTRY.counter(
+    "poc_online_classification_failures_total", "Ingested events whose online classification failed.")
+
+_STOP = object()
+
+
+def event_as_log(event_type: str, raw_event: Dict[str, Any]) -> Dict[str, Any]:
+    """APIのイベントを、戦略ループのログと同じ形 (event_type / details / service) にする"""
+    log = {"event_type": event_type, "details": raw_event or {}}
+    if isinstance(raw_event, dict) and "service" in raw_event:
+        log["service"] = raw_event["service"]
+    return log
+
+
+def event_as_pipeline_log(event) -> Dict[str, Any]:
+    """記録済みのイベント (EventLog) を、戦略ループの生ログと同じ形 (log_id / timestamp 付き) にする"""
+    log = event_as_log(event.event_type, event.raw_event)
+    log["log_id"] = f"api_event_{event.id}"
+    log["timestamp"] = event.timestamp.isoformat() if event.timestamp is not None else None
+    return log
+
+
+def export_events_for_pipeline(session_factory, data_dir: str, chunk_size: int = EXPORT_CHUNK_SIZE) -> int:
+    """前回の書き出し以降にAPIで記録したイベントを、戦略ループの生ログ (data_dir/raw_event_logs) に書き出す
+
+    生ログがログストアなら追記し、ディレクトリなら1回分を1つのNDJSONシャードにする。
+    差分実行はまだ分類していないログIDだけを処理するので、書き出したイベントが再発見の対象になる。
+    書き出した件数を返す。
+    """
+    from .log_store import LogStore
+
+    logs_dir = os.path.join(data_dir, "raw_event_logs")
+    state_dir = os.path.join(data_dir, "pipeline_state")
+    state_path = os.path.join(state_dir, EXPORT_STATE_FILENAME)
+    last_event_id = 0
+    if os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            last_event_id = json.load(f)["last_event_id"]
+    os.makedirs(logs_dir, exist_ok=True)
+
+    exported = 0
+    db = session_factory()
+    try:
+        chunks = event_logger.iter_events_after_id(db, last_event_id, chunk_size)
+        if LogStore.is_store(logs_dir):
+            with LogStore(logs_dir) as store:
+                for events in chunks:
+                    store.append_many(event_as_pipeline_log(event) for event in events)
+                    exported += len(events)
+                    last_event_id = events[-1].id
+        else:
+            shard_path = os.path.join(logs_dir, f"api_events_{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.ndjson")
+            tmp_path = f"{shard_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for events in chunks:
+                    for event in events:
+                        f.write(json.dumps(event_as_pipeline_log(event), ensure_ascii=False) + "\n")
+                    exported += len(events)
+                    last_event_id = events[-1].id
+            if exported:
+                os.replace(tmp_path, shard_path)
+            else:
+                os.remove(tmp_path)
+    finally:
+        db.close()
+
+    if exported:
+        os.makedirs(state_dir, exist_ok=True)
+        with open(f"{state_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({"last_event_id": last_event_id}, f)
+        os.replace(f"{state_path}.tmp", state_path)
+        EXPORTED_EVENTS.inc(exported)
+    return exported
+
+
+def launch_incremental_pipeline(data_dir: str):
+    """戦略ループの差分実行を別プロセスで起動する (APIのプロセスとはメモリもLLMの呼び出しも分ける)"""
+    if REDISCOVERY_COMMAND is not None:
+        if not REDISCOVERY_COMMAND.strip():
+            return None
+        command = shlex.split(REDISCOVERY_COMMAND)
+    else:
+        command = [sys.executable, PIPELINE_SCRIPT, "--incremental", "--base-dir", os.path.abspath(data_dir)]
+    return subprocess.Popen(command)
+
+
+class SlidingWindowRate:
+    """直近 window_seconds 秒に分類したイベントのうち、未分類になった割合
+
+    分類スレッドが追加し、APIのリクエストのスレッドが読むので、操作はロックの中で行う。
+    """
+
+    def __init__(self, window_seconds: float = DEFAULT_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._entries: deque = deque() # (時刻, 件数, 未分類の件数) をバッチ単位で持つ
+        self._lock = threading.Lock()
+        self.total = 0
+        self.unclassified = 0
+
+    def add(self, total: int, unclassified: int, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._entries.append((now, total, unclassified))
+            self.total += total
+            self.unclassified += unclassified
+            self._expire(now)
+
+    def _expire(self, now: float):
+        # 呼び出し元で self._lock を取っておく
+        while self._entries and self._entries[0][0] < now - self.window_seconds:
+            _, total, unclassified = self._entries.popleft()
+            self.total -= total
+            self.unclassified -= unclassified
+
+    def snapshot(self, now: Optional[float] = None) -> Tuple[int, int, float]:
+        """(件数, 未分類の件数, 未分類の割合) を同じ時点の値として返す"""
+        with self._lock:
+            self._expire(time.monotonic() if now is None else now)
+            return self.total, self.unclassified, self.unclassified / self.total if self.total else 0.0
+
+    def rate(self, now: Optional[float] = None) -> float:
+        return self.snapshot(now)[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total = 0
+            self.unclassified = 0
+
+
+class OnlineClassifier:
+    """取り込んだイベントを、戦略ループが計算したカテゴリの重心でマイクロバッチごとに分類するワーカー
+
+    記録済みのイベントIDを submit するとキューに入り、1つのスレッドが最大 max_batch_size 件
+    (または max_delay_ms の間に届いた分) をまとめて埋め込み、行列積で分類して、
+    カテゴリと類似度を1回のUPDATEで event_logs に書き込む。取り込みのリクエストは分類を待たない。
+    重心は pipeline_state/ のマニフェストから読み込み、パイプラインが更新すると次のバッチで読み直す。
+    直近の未分類の割合が閾値を超えると、戦略ループの差分実行 (必要なら再発見) を起動する。
+    """
+
+    def __init__(self, session_factory, data_dir: str = DEFAULT_DATA_DIR, embedding_model=None,
+                 max_batch_size: int = DEFAULT_MAX_BATCH_SIZE, max_delay_ms: float = DEFAULT_MAX_DELAY_MS,
+                 queue_size: int = DEFAULT_QUEUE_SIZE, similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+                 window_seconds: float = DEFAULT_WINDOW_SECONDS, min_window_events: int = DEFAULT_MIN_WINDOW_EVENTS,
+                 unclassified_threshold: float = DEFAULT_UNCLASSIFIED_THRESHOLD,
+                 rediscovery_cooldown_seconds: float = DEFAULT_REDISCOVERY_COOLDOWN_SECONDS,
+                 on_rediscovery=launch_incremental_pipeline if NOVELTY_REDISCOVERY_ENABLED else None):
+        self.session_factory = session_factory
+        self.data_dir = data_dir
+        self.state_dir = os.path.join(data_dir, "pipeline_state")
+        self.categories_path = os.path.join(data_dir, "discovered_categories.json")
+        # embedding_model を渡すと、EMBEDDING_BACKEND の代わりにそれを使う (ベンチマークのスタンドインなど)
+        self.embedding_model = embedding_model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self.similarity_threshold = similarity_threshold
+        self.window = SlidingWindowRate(window_seconds)
+        self.min_window_events = min_window_events
+        self.unclassified_threshold = unclassified_threshold
+        self.rediscovery_cooldown_seconds = rediscovery_cooldown_seconds
+        self.on_rediscovery = on_rediscovery
+
+        self.state = "cold" # cold / ready / no_centroids / incompatible / failed
+        self.error: Optional[str] = None
+        self.category_names: Dict[str, str] = {}
+        self.embedding_model_name: Optional[str] = None
+        self._agent = None
+        self._manifest_mtime = None
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._rediscovery = None
+        self._last_rediscovery: Optional[float] = None
+        # 直近の再発見の判定と起動の結果 (stats で確認する)
+        self.last_rediscovery: Optional[Dict[str, Any]] = None
+        self.batches = 0
+        self.classified = 0
+        self.unclassified = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rediscoveries = 0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="online-classifier", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """キューに残っているイベントを分類し終えてから停止する"""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def submit(self, event_id: int, event_type: str, raw_event: Dict[str, Any]) -> bool:
+        """記録済みのイベントを分類のキューに入れる。停止中やキューが満杯なら分類せずに False (取り込みは止めない)"""
+        if self._thread is None:
+            return False
+        try:
+            self._queue.put_nowait((event_id, event_type, raw_event))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        rediscovery_running = self._rediscovery_running()
+        window_events, window_unclassified, window_rate = self.window.snapshot()
+        return {
+            "state": self.state,
+            "error": self.error,
+            "embedding_model": self.embedding_model_name,
+            "categories": self.category_names,
+            "queued": self._queue.qsize(),
+            "batches": self.batches,
+            "classified": self.classified,
+            "unclassified": self.unclassified,
+            "skipped": self.skipped,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "window": {
+                "seconds": self.window.window_seconds,
+                "events": window_events,
+                "unclassified": window_unclassified,
+                "unclassified_rate": window_rate,
+                "threshold": self.unclassified_threshold,
+                "min_events": self.min_window_events
+            },
+            "rediscovery_enabled": self.on_rediscovery is not None,
+            "rediscoveries": self.rediscoveries,
+            "rediscovery_running": rediscovery_running,
+            "last_rediscovery": self.last_rediscovery
+        }
+
+    def _run(self):
+        # 重心と埋め込みモデルは最初のイベントを待たずに読み込んでおく
+        self._maybe_reload()
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            # 最初のイベントから max_delay の間、または max_batch_size 件に達するまで集める
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                self._classify(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                self.error = f"Classification of {len(batch)} events failed: {type(e).__name__}: {e}"
+                CLASSIFICATION_FAILURES.inc(len(batch))
+
+    def _classify(self, batch: List[tuple]):
+        self._maybe_reload()
+        if self._agent is None:
+            self.skipped += len(batch)
+            return
+
+        with metrics.span("online_classification", items=len(batch)):
+            results = self._agent.classify_many(
+                [event_as_log(event_type, raw_event) for _, event_type, raw_event in batch],
+                self.similarity_threshold
+            )
+        db = self.session_factory()
+        try:
+            event_logger.update_event_categories(
+                db, [(event_id, category, similarity) for (event_id, _, _), (category, similarity) in zip(batch, results)]
+            )
+        finally:
+            db.close()
+
+        unclassified = sum(1 for category, _ in results if category == "unclassified")
+        for category, _ in results:
+            CLASSIFIED_EVENTS.inc(category=category)
+        self.batches += 1
+        self.classified += len(batch) - unclassified
+        self.unclassified += unclassified
+        self.window.add(len(batch), unclassified)
+        UNCLASSIFIED_RATE.set(self.window.rate())
+        self._maybe_trigger_rediscovery()
+
+    def _maybe_reload(self):
+        """マニフェストが更新されていれば、重心とカテゴリ名を読み直す"""
+        from .pipeline_manifest import MANIFEST_FILENAME
+        manifest_path = os.path.join(self.state_dir, MANIFEST_FILENAME)
+        try:
+            mtime = os.stat(manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._manifest_mtime and self.state != "cold":
+            return
+        self._manifest_mtime = mtime
+        try:
+            self._load()
+        except Exception as e:
+            self._agent = None
+            self.state = "failed"
+            self.error = f"Could not load category centroids: {type(e).__name__}: {e}"
+        # 重心が変わると未分類の基準も変わるので、それまでの割合は捨てる
+        self.window.clear()
+
+    def _load(self):
+        from .pipeline_manifest import PipelineManifest
+        from .classification_agent import ClassificationAgent
+        from .embedding_backends import get_embedding_model, embedding_model_name
+
+        self.error = None
+        manifest = PipelineManifest.load(self.state_dir)
+        if manifest is None or not manifest.category_ids:
+            self._agent = None
+            self.state = "no_centroids"
+            return
+
+        embedding_model = self.embedding_model or get_embedding_model()
+        self.embedding_model_name = getattr(embedding_model, "model_name", None) or embedding_model_name()
+        if manifest.embedding_model not in (None, self.embedding_model_name):
+            # 別の埋め込みで計算した重心とは類似度を比較できない
+            self._agent = None
+            self.state = "incompatible"
+            self.error = (f"Centroids were computed with {manifest.embedding_model}, "
+                          f"but the API uses {self.embedding_model_name}.")
+            return
+
+        self.category_names = {cat_id: cat_id for cat_id in manifest.category_ids}
+        if os.path.exists(self.categories_path):
+            with open(self.categories_path, 'r', encoding='utf-8') as f:
+                categories = json.load(f)
+            self.category_names.update(
+                {cat_id: category.get("name", cat_id) for cat_id, category in categories.items() if cat_id in self.category_names}
+            )
+        self._agent = ClassificationAgent(manifest.category_centroids(), embedding_model=embedding_model)
+        self.state = "ready"
+
+    def _rediscovery_running(self) -> bool:
+        return self._rediscovery is not None and self._rediscovery.poll() is None
+
+    def _maybe_trigger_rediscovery(self):
+        """未分類の割合が閾値を超え、再発見が実行中でもクールダウン中でもなければ起動する"""
+        if self.on_rediscovery is None:
+            return
+        window_events, _, window_rate = self.window.snapshot()
+        if window_events < self.min_window_events:
+            return
+        if window_rate <= self.unclassified_threshold or self._rediscovery_running():
+            return
+        now = time.monotonic()
+        if self._last_rediscovery is not None and now - self._last_rediscovery < self.rediscovery_cooldown_seconds:
+            return
+        self._last_rediscovery = now
+        self.last_rediscovery = {
+            "at": datetime.now().isoformat(),
+            "unclassified_rate": window_rate,
+            "window_events": window_events,
+            "exported_events": 0,
+            "launched": False,
+            "error": None
+        }
+        try:
+            # 未分類を生んだイベントは event_logs にしかないので、先に戦略ループの生ログへ書き出す
+            exported = export_events_for_pipeline(self.session_factory, self.data_dir)
+            self.last_rediscovery["exported_events"] = exported
+            if not exported:
+                # 生ログが前回から変わっていなければ、再発見しても同じ結果にしかならない
+                return
+            self._rediscovery = self.on_rediscovery(self.data_dir)
+        except Exception as e:
+            self.last_rediscovery["error"] = f"{type(e).__name__}: {e}"
+            return
+        if self._rediscovery is None:
+            return
+        self.last_rediscovery["launched"] = True
+        self.last_rediscovery["command"] = [str(arg) for arg in getattr(self._rediscovery, "args", [])]
+        self.rediscoveries += 1
+        REDISCOVERIES.inc()
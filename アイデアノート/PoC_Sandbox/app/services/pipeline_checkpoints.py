@@ -0,0 +1,214 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+from datetime import datetime
+import numpy as np
+from .category_discovery_agent import DiscoveryResult
+
+# 保存形式を変えたら上げる (キーに含まれるので、古い形式のチェックポイントは使われなくなる)
+CHECKPOINT_FORMAT_VERSION = 1
+STAGES = ("discovery", "classification", "synthesis")
+COMPLETE_FILENAME = "complete.json"
+LAST_RUN_FILENAME = "last_run.json"
+DEFAULT_KEEP = int(os.getenv("PIPELINE_CHECKPOINT_KEEP", "3"))
+
+
+def fingerprint_files(source):
+    """ログのディレクトリ (またはファイル) の構成と更新状況を表すハッシュ値 (ファイルが増減・変更されると値が変わる)"""
+    digest = hashlib.sha256()
+    if os.path.isfile(source):
+        paths = [source]
+    else:
+        paths = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(source) for name in names
+            if not name.endswith(".tmp")
+        )
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{os.path.relpath(path, source)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def stage_key(stage, **inputs):
+    """ステージの入力とパラメータから、チェックポイントのキー (短いハッシュ値) を作る"""
+    payload = json.dumps({"stage": stage, "format_version": CHECKPOINT_FORMAT_VERSION, **inputs},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class CheckpointStore:
+    """戦略パイプラインの各ステージの出力を、入力のハッシュをキーとして base_dir/pipeline_checkpoints/ に保存する
+
+    チェックポイントは <ステージ>/<キー>/ のディレクトリで、最後に complete.json を書いたものだけを完成とみなす
+    (途中で失敗した書き込みは使われない)。ステージごとに新しいものから keep 個だけ残す。
+    """
+
+    def __init__(self, root_dir, keep=DEFAULT_KEEP):
+        self.root_dir = root_dir
+        self.keep = keep
+
+    def path(self, stage, key):
+        return os.path.join(self.root_dir, stage, key)
+
+    def exists(self, stage, key):
+        return os.path.exists(os.path.join(self.path(stage, key), COMPLETE_FILENAME))
+
+    def load_meta(self, stage, key):
+        """完成したチェックポイントの complete.json (作成日時と保存時に渡した meta) を返す"""
+        with open(os.path.join(self.path(stage, key), COMPLETE_FILENAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _begin(self, stage, key):
+        """書き込み用の空のディレクトリを用意する (同じキーの未完成のチェックポイントは消す)"""
+        path = self.path(stage, key)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+    def _complete(self, stage, key, meta=None):
+        path = self.path(stage, key)
+        tmp_path = os.path.join(path, f"{COMPLETE_FILENAME}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"stage": stage, "key": key, "format_version": CHECKPOINT_FORMAT_VERSION,
+                       "created_at": datetime.now().isoformat(), **(meta or {})}, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, os.path.join(path, COMPLETE_FILENAME))
+        self._prune(stage, keep_key=key)
+
+    def _prune(self, stage, keep_key):
+        stage_dir = os.path.join(self.root_dir, stage)
+        keys = sorted(
+            (key for key in os.listdir(stage_dir) if key != keep_key),
+            key=lambda key: os.path.getmtime(os.path.join(stage_dir, key)),
+            reverse=True
+        )
+        for key in keys[max(self.keep - 1, 0):]:
+            shutil.rmtree(os.path.join(stage_dir, key), ignore_errors=True)
+
+    def save_discovery(self, key, result, meta=None):
+        path = self._begin("discovery", key)
+        np.savez(
+            os.path.join(path, "arrays.npz"),
+            unique_vectors=result.unique_vectors,
+            inverse=result.inverse,
+            counts=result.counts,
+            labels=result.labels,
+            centroids=result.centroids
+        )
+        with open(os.path.join(path, "discovery.json"), 'w', encoding='utf-8') as f:
+            json.dump({
+                "categories": result.categories,
+                "k": int(result.k),
+                "category_clusters": {cat_id: int(cluster) for cat_id, cluster in result.category_clusters.items()}
+            }, f, ensure_ascii=False, indent=4)
+        self._complete("discovery", key, meta)
+
+    def load_discovery(self, key):
+        path = self.path("discovery", key)
+        with open(os.path.join(path, "discovery.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        with np.load(os.path.join(path, "arrays.npz")) as arrays:
+            return DiscoveryResult(
+                categories=meta["categories"],
+                unique_vectors=arrays["unique_vectors"],
+                inverse=arrays["inverse"],
+                counts=arrays["counts"],
+                labels=arrays["labels"],
+                centroids=arrays["centroids"],
+                k=meta["k"],
+                category_clusters=meta["category_clusters"]
+            )
+
+    def save_classification(self, key, classified_logs_path, counts, watermark, samples=None, meta=None):
+        """分類結果 (classified_logs.json のコピー、カテゴリごとの件数、ウォーターマーク) を保存する
+
+        samples を渡すと、ナレッジ合成に渡すカテゴリごとのログ (ストリーム処理のサンプル) も保存する。
+        """
+        path = self._begin("classification", key)
+        shutil.copyfile(classified_logs_path, os.path.join(path, "classified_logs.json"))
+        if samples is not None:
+            with open(os.path.join(path, "samples.ndjson"), 'w', encoding='utf-8') as f:
+                for cat_id, logs in samples.items():
+                    for log in logs:
+                        f.write(json.dumps({"category_id": cat_id, "log": log}, ensure_ascii=False) + "\n")
+        with open(os.path.join(path, "classification.json"), 'w', encoding='utf-8') as f:
+            json.dump({"counts": counts, "watermark": watermark, "has_samples": samples is not None},
+                      f, ensure_ascii=False, indent=4)
+        self._complete("classification", key, meta)
+
+    def load_classification(self, key):
+        """(classified_logs.json のパス, 件数, ウォーターマーク, サンプル or None) を返す"""
+        path = self.path("classification", key)
+        with open(os.path.join(path, "classification.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        samples = None
+        if meta["has_samples"]:
+            samples = {cat_id: [] for cat_id in meta["counts"]}
+            with open(os.path.join(path, "samples.ndjson"), 'r', encoding='utf-8') as f:
+                for line in f:
+                    item = json.loads(line)
+                    samples.setdefault(item["category_id"], []).append(item["log"])
+        return os.path.join(path, "classified_logs.json"), meta["counts"], meta["watermark"], samples
+
+    def synthesis_progress(self, key):
+        return SynthesisProgress(self, key)
+
+    def save_last_run(self, record):
+        os.makedirs(self.root_dir, exist_ok=True)
+        path = os.path.join(self.root_dir, LAST_RUN_FILENAME)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False, indent=4)
+        os.replace(f"{path}.tmp", path)
+
+    def load_last_run(self):
+        path = os.path.join(self.root_dir, LAST_RUN_FILENAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+
+class SynthesisProgress:
+    """ナレッジ合成のチェックポイント。完了したカテゴリを1件ずつ記録し、再実行ではそれを飛ばす
+
+    すべてのカテゴリが完了したら complete() でステージ全体を完成にする。
+    """
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.path = store.path("synthesis", key)
+        self.progress_path = os.path.join(self.path, "completed_categories.json")
+        self._lock = threading.Lock()
+        self.completed = {}
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path, 'r', encoding='utf-8') as f:
+                self.completed = json.load(f)
+
+    def is_done(self, category_id, article_path):
+        """カテゴリの記事が、このキーの合成で書き出したときのまま残っていれば True"""
+        digest = self.completed.get(category_id)
+        if digest is None or not os.path.exists(article_path):
+            return False
+        with open(article_path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest() == digest
+
+    def mark_done(self, category_id, article_path):
+        with open(article_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with self._lock:
+            self.completed[category_id] = digest
+            os.makedirs(self.path, exist_ok=True)
+            with open(f"{self.progress_path}.tmp", 'w', encoding='utf-8') as f:
+                json.dump(self.completed, f, ensure_ascii=False, indent=4)
+            os.replace(f"{self.progress_path}.tmp", self.progress_path)
+
+    def reset(self):
+        with self._lock:
+            self.completed = {}
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def complete(self, meta=None):
+        self.store._complete("synthesis", self.key, meta)
@@ -0,0 +1,140 @@
+import os
+import json
+from datetime import datetime
+import numpy as np
+
+MANIFEST_FILENAME = "manifest.json"
+CENTROIDS_FILENAME = "centroids.npz"
+
+
+class PipelineManifest:
+    """戦略パイプラインの差分実行に必要な状態 (ウォーターマーク、カテゴリの重心と件数) を保持する
+
+    処理済みのログIDは classified_logs.json に全件記録されているため、ここでは持たない。
+    重心は、直近のフル実行で発見した時点の値 (baseline) と、差分実行で移動平均として
+    更新した現在の値の両方を保存し、その差をドリフトとして再発見の判定に使う。
+    """
+
+    def __init__(self, state_dir, watermark=None, category_ids=None, centroids=None,
+                 baseline_centroids=None, counts=None, logs_since_discovery=0,
+                 unclassified_since_discovery=0, last_full_run=None, incremental_runs=0, embedding_model=None,
+                 store_position=None):
+        self.state_dir = state_dir
+        self.watermark = watermark # 処理済みログの最新timestamp (ISO形式の文字列)
+        self.category_ids = list(category_ids or [])
+        self.centroids = centroids
+        self.baseline_centroids = baseline_centroids
+        self.counts = counts # 各カテゴリの重心に寄与したログ数
+        self.logs_since_discovery = logs_since_discovery
+        self.unclassified_since_discovery = unclassified_since_discovery
+        self.last_full_run = last_full_run
+        self.incremental_runs = incremental_runs
+        self.embedding_model = embedding_model # 重心を計算した埋め込みの識別名 (変わると重心と比較できない)
+        # ログストアの処理済みの追記位置 [セグメント, オフセット] (ログストアでなければ None)
+        self.store_position = store_position
+
+    @classmethod
+    def load(cls, state_dir):
+        """保存済みの状態を読み込む。まだフル実行していなければ None"""
+        manifest_path = os.path.join(state_dir, MANIFEST_FILENAME)
+        centroids_path = os.path.join(state_dir, CENTROIDS_FILENAME)
+        if not os.path.exists(manifest_path) or not os.path.exists(centroids_path):
+            return None
+
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        with np.load(centroids_path) as arrays:
+            return cls(
+                state_dir,
+                watermark=meta.get("watermark"),
+                category_ids=meta["category_ids"],
+                centroids=arrays["centroids"],
+                baseline_centroids=arrays["baseline_centroids"],
+                counts=arrays["counts"],
+                logs_since_discovery=meta.get("logs_since_discovery", 0),
+                unclassified_since_discovery=meta.get("unclassified_since_discovery", 0),
+                last_full_run=meta.get("last_full_run"),
+                incremental_runs=meta.get("incremental_runs", 0),
+                embedding_model=meta.get("embedding_model"),
+                store_position=meta.get("store_position")
+            )
+
+    @classmethod
+    def from_full_run(cls, state_dir, category_centroids, category_counts, watermark, embedding_model=None,
+                      store_position=None):
+        """フル実行の結果から新しい状態を作る"""
+        category_ids = list(category_centroids.keys())
+        centroids = np.array([category_centroids[cat_id] for cat_id in category_ids], dtype=np.float64)
+        return cls(
+            state_dir,
+            watermark=watermark,
+            category_ids=category_ids,
+            centroids=centroids,
+            baseline_centroids=centroids.copy(),
+            counts=np.array([category_counts.get(cat_id, 0) for cat_id in category_ids], dtype=np.int64),
+            last_full_run=datetime.now().isoformat(),
+            embedding_model=embedding_model,
+            store_position=store_position
+        )
+
+    def category_centroids(self):
+        return {cat_id: self.centroids[i] for i, cat_id in enumerate(self.category_ids)}
+
+    def update_centroids(self, vector_sums, vector_counts):
+        """カテゴリごとの新規ベクトルの合計と件数から、重心を移動平均で更新する"""
+        for i, cat_id in enumerate(self.category_ids):
+            added = vector_counts.get(cat_id, 0)
+            if not added:
+                continue
+            total = self.counts[i] + added
+            self.centroids[i] = (self.centroids[i] * self.counts[i] + vector_sums[cat_id]) / total
+            self.counts[i] = total
+
+    def centroid_drift(self):
+        """発見時点からの重心の移動量の最大値 (1 - コサイン類似度)"""
+        if not self.category_ids:
+            return 0.0
+        current = self.centroids / np.linalg.norm(self.centroids, axis=1, keepdims=True)
+        baseline = self.baseline_centroids / np.linalg.norm(self.baseline_centroids, axis=1, keepdims=True)
+        return float(np.max(1.0 - np.sum(current * baseline, axis=1)))
+
+    def unclassified_fraction(self):
+        """前回のフル実行以降に差分処理したログのうち、未分類になった割合"""
+        if not self.logs_since_discovery:
+            return 0.0
+        return self.unclassified_since_discovery / self.logs_since_discovery
+
+    def advance_watermark(self, timestamp):
+        if timestamp and (self.watermark is None or str(timestamp) > self.watermark):
+            self.watermark = str(timestamp)
+
+    def save(self):
+        """状態をアトミックに書き出す"""
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir)
+
+        centroids_path = os.path.join(self.state_dir, CENTROIDS_FILENAME)
+        tmp_centroids_path = os.path.join(self.state_dir, f"tmp_{CENTROIDS_FILENAME}")
+        np.savez(
+            tmp_centroids_path,
+            centroids=self.centroids,
+            baseline_centroids=self.baseline_centroids,
+            counts=self.counts
+        )
+        os.replace(tmp_centroids_path, centroids_path)
+
+        manifest_path = os.path.join(self.state_dir, MANIFEST_FILENAME)
+        tmp_manifest_path = f"{manifest_path}.tmp"
+        with open(tmp_manifest_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "watermark": self.watermark,
+                "category_ids": self.category_ids,
+                "logs_since_discovery": self.logs_since_discovery,
+                "unclassified_since_discovery": self.unclassified_since_discovery,
+                "last_full_run": self.last_full_run,
+                "last_run": datetime.now().isoformat(),
+                "incremental_runs": self.incremental_runs,
+                "embedding_model": self.embedding_model,
+                "store_position": self.store_position
+            }, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_manifest_path, manifest_path)
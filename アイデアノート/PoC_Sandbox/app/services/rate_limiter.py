@@ -0,0 +1,72 @@
+import time
+import random
+import threading
+
+# 一時的なエラーとみなして再試行する例外のクラス名 (google.api_core などをインポートせずに判定する)
+TRANSIENT_ERROR_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+    "InternalServerError", "BadGateway", "GatewayTimeout", "Aborted",
+    "RateLimitError", "APITimeoutError", "APIConnectionError", "ReadTimeout", "ConnectTimeout",
+}
+
+
+class TokenBucket:
+    """トークンバケット方式のレート制限 (複数スレッドから共有できる)
+
+    rate_per_second の速さでトークンが補充され、最大 capacity 個まで貯まる。
+    acquire はトークンが得られるまで待つ。
+    """
+
+    def __init__(self, rate_per_second, capacity=1):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, requests_per_minute, capacity=1):
+        return cls(requests_per_minute / 60.0, capacity)
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate_per_second)
+                self._updated_at = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate_per_second
+            time.sleep(wait)
+
+
+def is_transient_error(error):
+    """レート制限・タイムアウト・一時的なサーバーエラーなど、再試行で回復しうるエラーか"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, (TimeoutError, ConnectionError)) or type(error).__name__ in TRANSIENT_ERROR_NAMES:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def call_with_retry(fn, max_retries=3, base_delay=1.0, max_delay=30.0,
+                    is_retryable=is_transient_error, before_attempt=None, label=""):
+    """fn を呼び出し、一時的なエラーなら指数バックオフ (ジッター付き) で最大 max_retries 回再試行する
+
+    before_attempt は各試行の直前に呼ばれる (レート制限のトークン取得など)。
+    """
+    for attempt in range(max_retries + 1):
+        if before_attempt is not None:
+            before_attempt()
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = min(max_delay, base_delay * (2 ** attempt)) * random.uniform(0.5, 1.0)
+            print(f"Transient error{f' for {label}' if label else ''} ({type(e).__name__}: {e}). "
+                  f"Retrying in {delay:.1f}s ({attempt + 1}/{max_retries})...")
+            time.sleep(delay)
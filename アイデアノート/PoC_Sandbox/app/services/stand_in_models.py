@@ -0,0 +1,125 @@
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+from typing import Any, List, Optional
+from pydantic import PrivateAttr
+from langchain_core.language_models.chat_models import SimpleChatModel
+from .embedding_backends import HashingEmbeddings
+
+# 外部APIを呼ばずに戦略ループ・戦術ループを動かすための、決定的なスタンドインのモデル。
+# 応答の中身に意味はないが、呼び出しの形 (入出力の型、件数、待ち時間) は本物と同じになる。
+
+
+class StandInEmbeddings(HashingEmbeddings):
+    """ハッシュ埋め込みに、埋め込みAPIの往復を模した待ち時間を加えたスタンドイン
+
+    latency_ms は1回の呼び出し (batch_size 件) ごと、per_text_latency_ms はテキスト1件ごとの待ち時間。
+    """
+
+    def __init__(self, n_features=256, batch_size=100, dtype="float32", latency_ms=0.0, per_text_latency_ms=0.0):
+        super().__init__(n_features=n_features, batch_size=batch_size, dtype=dtype)
+        self.model_name = f"stand-in-hashing-{n_features}"
+        self.latency_ms = latency_ms
+        self.per_text_latency_ms = per_text_latency_ms
+        self.calls = 0
+        self.texts = 0
+        self._lock = threading.Lock()
+
+    def embed_array(self, texts):
+        batches = -(-len(texts) // self.batch_size) if texts else 0
+        with self._lock:
+            self.calls += batches
+            self.texts += len(texts)
+        delay = (batches * self.latency_ms + len(texts) * self.per_text_latency_ms) / 1000
+        if delay > 0:
+            time.sleep(delay)
+        return super().embed_array(texts)
+
+
+class StandInChatModel(SimpleChatModel):
+    """プロンプトの種類に応じて決まった形の応答を返す、LLMのスタンドイン
+
+    カテゴリ名の生成プロンプト ("--- Cluster N Samples ---" を含む) にはクラスタごとの名前のJSONを、
+    それ以外にはプロンプトのハッシュを含むマークダウンを返す。
+    待ち時間は latency_ms + プロンプト1000文字あたり latency_per_1k_chars_ms。
+    """
+
+    model_name: str = "stand-in-llm"
+    latency_ms: float = 0.0
+    latency_per_1k_chars_ms: float = 0.0
+    _calls: int = PrivateAttr(default=0)
+    _prompt_chars: int = PrivateAttr(default=0)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "stand-in"
+
+    @property
+    def calls(self):
+        return self._calls
+
+    @property
+    def prompt_chars(self):
+        return self._prompt_chars
+
+    def _call(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        prompt = "\n".join(str(message.content) for message in messages)
+        with self._lock:
+            self._calls += 1
+            self._prompt_chars += len(prompt)
+        delay = (self.latency_ms + len(prompt) / 1000 * self.latency_per_1k_chars_ms) / 1000
+        if delay > 0:
+            time.sleep(delay)
+
+        clusters = sorted({int(number) for number in re.findall(r"--- Cluster (\d+) Samples ---", prompt)})
+        if clusters:
+            return "```json\n" + json.dumps({f"cluster_{i}": f"Stand-in Category {i}" for i in clusters}) + "\n```"
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+        return (
+            f"## 問題の概要\nスタンドインの応答です (prompt {digest}, {len(prompt)} chars)。\n\n"
+            "## 推奨される一次対応\n- ログを確認する\n- 影響範囲を確認する\n"
+        )
+
+
+class StandInInferenceEngine:
+    """InferenceEngine と同じインターフェース (ask / tier_stats / cache) を持つ、推論エンジンのスタンドイン
+
+    ナレッジベースの読み込みもベクトル検索もせず、latency_ms (+ 0〜jitter_ms の一様乱数) だけ待って
+    決まった形の応答を返す。APIのハンドラとDBの書き込みだけの性能を測るために使う。
+    """
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.llm_model_name = "stand-in-engine"
+        self.cache = None
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def ask(self, query: str):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency_ms + (self._rng.uniform(0, self.jitter_ms) if self.jitter_ms else 0.0)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        digest = hashlib.sha256(query.encode("utf-8")).hexdigest()[:12]
+        return {
+            "answer": f"スタンドインの応答です (query {digest})。",
+            "source_documents": [],
+            "model": self.llm_model_name,
+            "tier": "llm",
+            "similarity": None,
+            "cached": False
+        }
+
+    def reload_knowledge(self):
+        return None
+
+    def tier_stats(self):
+        return {"tiered": False, "cache": 0, "retrieval": 0, "llm": self.calls, "total": self.calls,
+                "llm_offload_rate": 0.0, "retrieval_rate": 0.0}
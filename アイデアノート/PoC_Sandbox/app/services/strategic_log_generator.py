@@ -1,17 +1,31 @@
+import gzip
 import json
 import os
 import random
 from datetime import datetime, timedelta
 
-def generate_strategic_logs(output_dir="アイデアノート/PoC_Sandbox/data/raw_event_logs", num_logs=100):
+def generate_strategic_logs(output_dir="アイデアノート/PoC_Sandbox/data/raw_event_logs", num_logs=100, output_format="files",
+                            seed=None, base_time=None, shard_size=100000, compress=False):
     """
     戦略ループの分析対象となる、多様なダミーイベントログを生成する。
+    output_format="files" は1ログ1ファイル、"store" はセグメント化されたログストアに、
+    "ndjson" は shard_size 件ずつのNDJSONシャード (compress=True ならgzip) に書き出す。
+    seed と base_time (タイムスタンプの基準時刻) を指定すると、毎回同じログが生成される。
     """
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    rng = random.Random(seed)
+    base_time = base_time or datetime.now()
+    store = None
+    if output_format == "store":
+        # スクリプトとして直接実行した場合 (output_format="files") にも動くよう、必要な時だけ読み込む
+        from .log_store import LogStore
+        store = LogStore(output_dir)
+    shard = None
+    shard_paths = []
 
-    user_ids = [f"user_{random.randint(100, 200)}" for _ in range(10)]
-    product_ids = [f"prod_{random.randint(1000, 1050)}" for _ in range(10)]
+    user_ids = [f"user_{rng.randint(100, 200)}" for _ in range(10)]
+    product_ids = [f"prod_{rng.randint(1000, 1050)}" for _ in range(10)]
     error_messages = [
         "Database connection timed out.",
         "Payment gateway API returned 503 Service Unavailable.",
@@ -20,12 +34,12 @@ def generate_strategic_logs(output_dir="アイデアノート/PoC_Sandbox/data/r
         "Unexpected null pointer exception in inventory service.",
         "Failed to process message from queue: malformed JSON."
     ]
-    ip_addresses = [f"192.168.1.{random.randint(1,20)}" for _ in range(5)] # 意図的に重複させる
+    ip_addresses = [f"192.168.1.{rng.randint(1,20)}" for _ in range(5)] # 意図的に重複させる
 
     for i in range(1, num_logs + 1):
-        log_type = random.choice(["purchase", "login_failure", "system_error"])
+        log_type = rng.choice(["purchase", "login_failure", "system_error"])
         
-        timestamp = datetime.now() - timedelta(days=random.randint(0, 30), hours=random.randint(0, 23))
+        timestamp = base_time - timedelta(days=rng.randint(0, 30), hours=rng.randint(0, 23))
         
         log_entry = {
             "log_id": f"log_{i:03d}",
@@ -35,20 +49,20 @@ def generate_strategic_logs(output_dir="アイデアノート/PoC_Sandbox/data/r
         if log_type == "purchase":
             log_entry.update({
                 "event_type": "item_purchase",
-                "user_id": random.choice(user_ids),
+                "user_id": rng.choice(user_ids),
                 "details": {
-                    "product_id": random.choice(product_ids),
-                    "quantity": random.randint(1, 3),
-                    "price": round(random.uniform(50.0, 200.0), 2),
-                    "success": random.choices([True, False], weights=[9, 1], k=1)[0] # 10%で失敗
+                    "product_id": rng.choice(product_ids),
+                    "quantity": rng.randint(1, 3),
+                    "price": round(rng.uniform(50.0, 200.0), 2),
+                    "success": rng.choices([True, False], weights=[9, 1], k=1)[0] # 10%で失敗
                 }
             })
         elif log_type == "login_failure":
             log_entry.update({
                 "event_type": "user_login_attempt",
-                "user_id": random.choice(user_ids),
+                "user_id": rng.choice(user_ids),
                  "details": {
-                    "ip_address": random.choice(ip_addresses),
+                    "ip_address": rng.choice(ip_addresses),
                     "reason": "Invalid credentials",
                     "success": False
                 }
@@ -56,18 +70,42 @@ def generate_strategic_logs(output_dir="アイデアノート/PoC_Sandbox/data/r
         elif log_type == "system_error":
              log_entry.update({
                 "event_type": "service_error",
-                "service": random.choice(["database", "api_gateway", "auth_service", "inventory_service"]),
+                "service": rng.choice(["database", "api_gateway", "auth_service", "inventory_service"]),
                  "details": {
-                    "error_code": random.choice([500, 503, 401]),
-                    "message": random.choice(error_messages),
-                    "severity": random.choice(["warning", "critical", "error"])
+                    "error_code": rng.choice([500, 503, 401]),
+                    "message": rng.choice(error_messages),
+                    "severity": rng.choice(["warning", "critical", "error"])
                 }
             })
         
+        if store is not None:
+            store.append(log_entry)
+            continue
+
+        if output_format == "ndjson":
+            if (i - 1) % shard_size == 0:
+                if shard is not None:
+                    shard.close()
+                shard_paths.append(os.path.join(output_dir, f"logs-{len(shard_paths):05d}.ndjson" + (".gz" if compress else "")))
+                shard = gzip.open(shard_paths[-1], 'wt', encoding='utf-8') if compress else open(shard_paths[-1], 'w', encoding='utf-8')
+            shard.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
+            continue
+
         file_path = os.path.join(output_dir, f"log_{i:03d}.json")
         with open(file_path, 'w', encoding='utf-8') as f:
             json.dump(log_entry, f, ensure_ascii=False, indent=4)
 
+    if store is not None:
+        store.close()
+        print(f"{num_logs} strategic logs appended to the log store in {output_dir}")
+        return
+
+    if output_format == "ndjson":
+        if shard is not None:
+            shard.close()
+        print(f"{num_logs} strategic logs written to {len(shard_paths)} NDJSON shards in {output_dir}")
+        return shard_paths
+
     print(f"{num_logs} strategic log files generated in {output_dir}")
 
 if __name__ == '__main__':
@@ -1,116 +1,673 @@
 import os
 import json
 import glob
-import numpy as np
+import random
+import shutil
+import argparse
+import tempfile
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from services.category_discovery_agent import CategoryDiscoveryAgent
 from services.classification_agent import ClassificationAgent
-from services.knowledge_synthesis_agent import KnowledgeSynthesisAgent
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from sklearn.cluster import KMeans
+from services.knowledge_synthesis_agent import KnowledgeSynthesisAgent, DEFAULT_TOKEN_BUDGET
+from services.log_stream import iter_log_batches, iter_batches, ReservoirSampler, sample_logs
+from services.log_store import LogStore
+from services.pipeline_manifest import PipelineManifest
+from services.pipeline_checkpoints import CheckpointStore, STAGES, fingerprint_files, stage_key
+from services.rate_limiter import TokenBucket, call_with_retry
+from services.embedding_backends import BACKENDS, get_embedding_model, embedding_model_name
+from services import metrics
+
+# --batch-size を指定し、--discovery-sample-size を省略した場合に、カテゴリ発見に使うログの件数
+STREAMING_DISCOVERY_SAMPLE_SIZE = int(os.getenv("STREAMING_DISCOVERY_SAMPLE_SIZE", "20000"))
+# 差分実行で記事に付ける追加分析の見出し。記事にはこの節を1つだけ置き、差分実行のたびに置き換える
+INCREMENTAL_SECTION_HEADING = "\n\n---\n\n## 追加分析 ("
 
 class StrategicPipeline:
-    def __init__(self, base_dir="アイデアノート/PoC_Sandbox/data"):
+    def __init__(self, base_dir="アイデアノート/PoC_Sandbox/data", discovery_options=None,
+                 batch_size=None, synthesis_sample_size=200,
+                 rediscovery_unclassified_threshold=0.2, rediscovery_drift_threshold=0.05,
+                 synthesis_concurrency=4, synthesis_requests_per_minute=None, synthesis_max_retries=3,
+                 synthesis_token_budget=None, embedding_backend=None, embedding_model=None, llm=None,
+                 use_checkpoints=True):
         self.base_dir = base_dir
+        # CategoryDiscoveryAgentに渡す追加設定 (例: {"k_selection": "fast", "sample_size": 20000})
+        # sample_size を指定すると、分類は batch_size を省略してもストリームで全ログに対して行う
+        self.discovery_options = discovery_options or {}
+        # batch_size を指定すると、分類以降をログ batch_size 件ずつのストリームで処理する (全件をメモリに載せない)
+        self.batch_size = batch_size
+        # ストリーム処理時に、カテゴリごとにナレッジ合成へ渡すログの最大件数
+        self.synthesis_sample_size = synthesis_sample_size
+        # 差分実行で、未分類の割合か重心のドリフト (1 - コサイン類似度) がこれを超えたらフル実行で再発見する
+        self.rediscovery_unclassified_threshold = rediscovery_unclassified_threshold
+        self.rediscovery_drift_threshold = rediscovery_drift_threshold
+        # ナレッジ合成を同時に実行するカテゴリ数、LLMへのリクエストの上限 (毎分、None なら無制限)、一時的なエラーの再試行回数
+        self.synthesis_concurrency = max(1, synthesis_concurrency)
+        self.synthesis_requests_per_minute = synthesis_requests_per_minute
+        self.synthesis_max_retries = synthesis_max_retries
+        # ナレッジ合成の1回のプロンプトに載せるログの推定トークン数 (None なら SYNTHESIS_TOKEN_BUDGET)
+        self.synthesis_token_budget = synthesis_token_budget
+        # 発見・分類・合成で共有する埋め込みの実装 (None なら EMBEDDING_BACKEND。"local" ならネットワーク不要)
+        self.embedding_backend = embedding_backend
+        # embedding_model / llm を渡すと、設定の代わりにそれを使う (ベンチマークのスタンドインなど)
+        self.embedding_model = embedding_model
+        self.embedding_model_name = getattr(embedding_model, "model_name", None) or embedding_model_name(embedding_backend)
+        self.llm = llm
         self.logs_dir = os.path.join(base_dir, "raw_event_logs")
         self.categories_path = os.path.join(base_dir, "discovered_categories.json")
         self.classified_logs_path = os.path.join(base_dir, "classified_logs.json")
         self.knowledge_dir = os.path.join(base_dir, "synthesized_knowledge")
-        self.embedding_model = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
+        self.state_dir = os.path.join(base_dir, "pipeline_state")
+        # 実行ごとのレポート (ステージ別の所要時間、結果、失敗したカテゴリ) の保存先
+        self.reports_dir = os.path.join(base_dir, "pipeline_reports")
+        # 前回の発見以降の新規ログのサンプル (カテゴリごと、最大 synthesis_sample_size 件)。追加分析はこれから生成する
+        self.incremental_samples_dir = os.path.join(self.state_dir, "incremental_samples")
+        self.last_report = None
+        self._report = None
+        # 各ステージの出力を入力のハッシュをキーとして保存し、入力が変わっていないステージは再実行しない
+        self.use_checkpoints = use_checkpoints
+        self.checkpoints = CheckpointStore(os.path.join(base_dir, "pipeline_checkpoints"))
         
         if not os.path.exists(self.knowledge_dir):
             os.makedirs(self.knowledge_dir)
 
-    def _get_text_for_embedding(self, log):
-        # ... (This is duplicated, could be a shared util) ...
-        details = log.get("details", {})
-        text = f"Event Type: {log.get('event_type', 'N/A')}. "
-        if "message" in details:
-            text += f"Message: {details['message']}. "
-        if "reason" in details:
-            text += f"Reason: {details['reason']}. "
-        if "service" in log:
-            text += f"Service: {log['service']}. "
-        return text
-
-    def run(self):
-        """戦略ループのパイプライン全体を実行する"""
-        
+    def run(self, from_stage=None, resume=False):
+        """戦略ループのパイプライン全体を実行し、実行レポートを書き出す
+
+        入力 (ログ・設定) が前回と同じステージはチェックポイントから復元して飛ばす。
+        from_stage を指定すると、そのステージ以降をチェックポイントを使わずに再実行する。
+        resume=True なら、前回の実行のカテゴリ発見の結果を使って、その実行が止まったところから続ける
+        (その後に追加されたログは、次の差分実行で処理する)。
+        """
+        if from_stage is not None and from_stage not in STAGES:
+            raise ValueError(f"Unknown stage '{from_stage}'. Expected one of: {', '.join(STAGES)}")
+        return self._run_with_report("full", lambda: self._run_full(from_stage, resume))
+
+    def run_incremental(self):
+        """前回の実行以降に追加されたログだけを埋め込み・分類し、出力ファイルを差分更新する
+
+        未分類の割合や重心のドリフトが閾値を超えた場合は、フル実行に切り替えてカテゴリを再発見する。
+        """
+        return self._run_with_report("incremental", self._run_incremental)
+
+    def _run_with_report(self, mode, step):
+        """step の実行中に完了したスパンを集計し、pipeline_reports/ に実行レポートのJSONを書き出す"""
+        if self._report is not None:
+            # 差分実行からフル実行に切り替えた場合は、同じレポートに記録する
+            self._report["mode"] = mode
+            return step()
+
+        self._report = {"mode": mode, "requested_mode": mode, "outcome": "completed", "failed_categories": {},
+                        "started_at": datetime.now().isoformat(), "embedding_model": self.embedding_model_name}
+        started = time.perf_counter()
+        try:
+            with metrics.record_spans() as recorder:
+                try:
+                    with metrics.span(f"pipeline_{mode}"):
+                        return step()
+                except Exception as e:
+                    self._report["outcome"] = "error"
+                    self._report["error"] = f"{type(e).__name__}: {e}"
+                    raise
+        finally:
+            report, self._report = self._report, None
+            report["finished_at"] = datetime.now().isoformat()
+            report["total_seconds"] = time.perf_counter() - started
+            report["stages"] = recorder.summary()
+            self.last_report = report
+            self._write_report(report)
+
+    def _write_report(self, report):
+        if not os.path.exists(self.reports_dir):
+            os.makedirs(self.reports_dir)
+        report_path = os.path.join(self.reports_dir, f"run-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.json")
+        tmp_path = f"{report_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, report_path)
+        print(f"Pipeline report saved to {report_path}")
+
+    def _run_full(self, from_stage=None, resume=False):
+        # from_stage 以降のステージは、チェックポイントがあっても再実行する
+        rerun = set(STAGES[STAGES.index(from_stage):]) if from_stage else set()
+        reusable = set() if not self.use_checkpoints else set(STAGES) - rerun
+        keys, logs_fingerprint = self._stage_keys(pin_discovery=resume and "discovery" not in rerun)
+        if self.use_checkpoints:
+            self._report["checkpoints"] = {"keys": keys, "reused_stages": [], "resumed_categories": 0}
+        try:
+            self._run_stages(keys, logs_fingerprint, reusable)
+        except Exception:
+            self._save_last_run(keys, logs_fingerprint, "error")
+            raise
+        self._save_last_run(keys, logs_fingerprint, self._report["outcome"])
+
+    def _run_stages(self, keys, logs_fingerprint, reusable):
+        # ログを読む前のログストアの追記位置 (これ以降の追記分は次の差分実行で処理する)
+        store_position = self._store_position()
+
         # --- Step 1: カテゴリ発見 ---
-        print("--- Step 1: Running Category Discovery Agent ---")
-        discovery_agent = CategoryDiscoveryAgent(logs_dir=self.logs_dir)
-        discovered_categories = discovery_agent.discover_categories()
+        discovery_logs = None
+        if "discovery" in reusable and self.checkpoints.exists("discovery", keys["discovery"]):
+            print(f"--- Step 1: Reusing category discovery checkpoint {keys['discovery']} ---")
+            discovery_result = self.checkpoints.load_discovery(keys["discovery"])
+            self._report["checkpoints"]["reused_stages"].append("discovery")
+        else:
+            print("--- Step 1: Running Category Discovery Agent ---")
+            with metrics.span("pipeline_discovery"):
+                discovery_agent = CategoryDiscoveryAgent(logs_dir=self.logs_dir, embedding_model=self._embedding_model(),
+                                                         llm=self.llm, **self.discovery_options)
+                discovery_result = discovery_agent.discover_categories()
+            discovery_logs = discovery_agent.logs
+            if self.use_checkpoints and discovery_result is not None and discovery_result.categories:
+                self.checkpoints.save_discovery(keys["discovery"], discovery_result,
+                                                meta={"logs_fingerprint": logs_fingerprint, "logs": len(discovery_logs)})
         
-        if not discovered_categories:
+        if discovery_result is None or not discovery_result.categories:
             print("No categories discovered. Halting pipeline.")
+            self._report["outcome"] = "no_categories"
             return
 
+        discovered_categories = discovery_result.categories
         with open(self.categories_path, 'w', encoding='utf-8') as f:
             json.dump(discovered_categories, f, ensure_ascii=False, indent=4)
         print(f"\\nDiscovered category definitions saved to {self.categories_path}")
 
         # --- Step 2: カテゴリの重心計算 & ログの分類 ---
-        print("\\n--- Step 2: Calculating Centroids and Classifying Logs ---")
-        
-        # 全ログのベクトルを一度だけ計算
-        all_logs = discovery_agent.logs
-        log_texts = [self._get_text_for_embedding(log) for log in all_logs]
-        log_vectors = self.embedding_model.embed_documents(log_texts)
-        log_vector_map = {log['log_id']: vec for log, vec in zip(all_logs, log_vectors)}
-
-        # カテゴリごとのログIDを取得 (これはDiscoveryAgentの内部情報に依存しているため、本来は分離すべき)
-        # PoCのため、ここでは再度クラスタリングを実行してログの割り当てを取得
-        optimal_k = len(discovered_categories)
-        kmeans = KMeans(n_clusters=optimal_k, random_state=42, n_init='auto').fit(log_vectors)
-        
-        # 重心計算
-        category_centroids = {}
-        for i in range(optimal_k):
-            cluster_indices = np.where(kmeans.labels_ == i)[0]
-            if len(cluster_indices) > 0:
-                centroid = np.mean(np.array(log_vectors)[cluster_indices], axis=0)
-                category_id = f"category_{i+1}"
-                category_centroids[category_id] = centroid
-
-        # 分類エージェントを重心で初期化
-        classification_agent = ClassificationAgent(category_centroids=category_centroids)
-        
-        # 分類実行
-        classified_data = {cat_id: [] for cat_id in discovered_categories.keys()}
-        classified_data["unclassified"] = [] # 未分類カテゴリを追加
-
-        for log in all_logs:
-            category_id = classification_agent.classify_log(log)
-            classified_data[category_id].append(log['log_id'])
+        category_ids = list(discovered_categories.keys()) + ["unclassified"] # 未分類カテゴリを追加
+        # 発見ステップで計算済みの重心で分類エージェントを初期化 (再埋め込み・再クラスタリングはしない)
+        category_centroids = discovery_result.category_centroids()
+        if "classification" in reusable and self.checkpoints.exists("classification", keys["classification"]):
+            print(f"\\n--- Step 2: Reusing classification checkpoint {keys['classification']} ---")
+            checkpoint_path, counts, watermark, samples = self.checkpoints.load_classification(keys["classification"])
+            shutil.copyfile(checkpoint_path, self.classified_logs_path)
+            store_position = self.checkpoints.load_meta("classification", keys["classification"]).get("store_position")
+            # メモリ上の実行ではログを保存していないので、合成が必要になったときに読み直す (None)
+            category_inputs = {
+                cat_id: (counts.get(cat_id, 0), samples.get(cat_id, []) if samples is not None else None)
+                for cat_id in category_ids
+            }
+            self._report["checkpoints"]["reused_stages"].append("classification")
+        else:
+            print("\\n--- Step 2: Calculating Centroids and Classifying Logs ---")
+            classification_agent = ClassificationAgent(category_centroids=category_centroids,
+                                                       embedding_model=self._embedding_model())
+            with metrics.span("pipeline_classification"):
+                if self._classify_by_stream():
+                    category_inputs, watermark = self._classify_streaming(classification_agent, category_ids)
+                else:
+                    vectors_result = discovery_result
+                    if discovery_logs is None:
+                        discovery_logs = self._load_discovery_logs()
+                        # 発見の後にログが変わっていれば、発見ステップのベクトルとログの順序が一致しないので埋め込み直す
+                        if (logs_fingerprint != fingerprint_files(self.logs_dir)
+                                or len(discovery_logs) != len(discovery_result.inverse)):
+                            vectors_result = None
+                    category_inputs, watermark = self._classify_in_memory(classification_agent, category_ids, discovery_logs, vectors_result)
+            if self.use_checkpoints:
+                self.checkpoints.save_classification(
+                    keys["classification"], self.classified_logs_path,
+                    {cat_id: count for cat_id, (count, _) in category_inputs.items()}, watermark,
+                    samples={cat_id: logs for cat_id, (_, logs) in category_inputs.items()} if self._classify_by_stream() else None,
+                    meta={"store_position": store_position}
+                )
+        self._report["categories"] = len(discovered_categories)
+        self._report["logs"] = sum(count for count, _ in category_inputs.values())
+        self._report["unclassified"] = category_inputs['unclassified'][0]
         
-        print(f"Classification complete. Unclassified logs: {len(classified_data['unclassified'])}")
-        with open(self.classified_logs_path, 'w', encoding='utf-8') as f:
-            json.dump(classified_data, f, ensure_ascii=False, indent=4)
+        print(f"Classification complete. Unclassified logs: {category_inputs['unclassified'][0]}")
         print(f"Classification results saved to {self.classified_logs_path}")
 
+        # 次回の差分実行のために、重心と処理済みの位置を保存
+        PipelineManifest.from_full_run(
+            self.state_dir,
+            category_centroids,
+            {cat_id: count for cat_id, (count, _) in category_inputs.items()},
+            watermark,
+            embedding_model=self.embedding_model_name,
+            store_position=store_position
+        ).save()
+
         # --- Step 3: ナレッジ合成 ---
-        print("\\n--- Step 3: Running Knowledge Synthesis Agent for each category ---")
-        synthesis_agent = KnowledgeSynthesisAgent(logs_dir=self.logs_dir, categories_path=self.categories_path)
-        
-        for category_id, log_ids in classified_data.items():
-            if not log_ids:
-                print(f"\\nSkipping knowledge synthesis for empty category '{category_id}'.")
-                continue
-                
-            print(f"\\nSynthesizing knowledge for '{category_id}' ({len(log_ids)} logs)...")
-            
-            article = synthesis_agent.synthesize_knowledge_for_category(category_id, log_ids)
-            
-            article_filename = f"{category_id}_manual.md"
-            output_path = os.path.join(self.knowledge_dir, article_filename)
-            
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(article)
-            
-            print(f"Knowledge article for '{category_id}' saved to {output_path}")
+        progress = None
+        if self.use_checkpoints:
+            progress = self.checkpoints.synthesis_progress(keys["synthesis"])
+            if "synthesis" not in reusable:
+                progress.reset()
+        pending = [
+            cat_id for cat_id, (count, _) in category_inputs.items()
+            if count and not (progress is not None and progress.is_done(cat_id, self._article_path(cat_id)))
+        ]
+        if progress is not None and not pending:
+            print(f"\\n--- Step 3: Reusing knowledge articles from synthesis checkpoint {keys['synthesis']} ---")
+            self._report["checkpoints"]["reused_stages"].append("synthesis")
+            failed = {}
+        else:
+            print("\\n--- Step 3: Running Knowledge Synthesis Agent for each category ---")
+            if any(logs is None for _, logs in category_inputs.values()):
+                category_inputs = self._restore_category_logs(category_inputs, pending, discovery_logs)
+            failed = self._synthesize(category_inputs, progress=progress)
+        if failed:
+            self._report.update(outcome="failed_categories", failed_categories=failed)
+            print(f"\\n--- Strategic Pipeline finished with {len(failed)} failed categories: {', '.join(sorted(failed))} ---")
+            if progress is not None:
+                print("Run the pipeline again (or with --resume) to retry only the failed categories.")
+            return
+        if progress is not None:
+            progress.complete()
             
         print("\\n--- Strategic Pipeline finished successfully! ---")
 
+    def _stage_keys(self, pin_discovery=False):
+        """各ステージのチェックポイントのキーと、カテゴリ発見の入力にしたログのハッシュ値を返す
+
+        後段のキーは前段のキーを含むので、前段の入力が変わると後段も再実行される。
+        pin_discovery=True なら、前回の実行のカテゴリ発見のキーをそのまま使う (--resume)。
+        """
+        discovery_key = logs_fingerprint = None
+        if pin_discovery:
+            last_run = self.checkpoints.load_last_run()
+            if last_run and self.checkpoints.exists("discovery", last_run["keys"]["discovery"]):
+                discovery_key = last_run["keys"]["discovery"]
+                logs_fingerprint = self.checkpoints.load_meta("discovery", discovery_key)["logs_fingerprint"]
+                print(f"Resuming the previous run (started {last_run['started_at']}, outcome: {last_run['outcome']}).")
+            else:
+                print("No previous run to resume. Running with the current logs.")
+        if discovery_key is None:
+            logs_fingerprint = fingerprint_files(self.logs_dir)
+            discovery_key = stage_key("discovery", logs=logs_fingerprint, options=self.discovery_options,
+                                      embedding_model=self.embedding_model_name, llm=self._llm_name())
+        classification_key = stage_key("classification", discovery=discovery_key, batch_size=self.batch_size,
+                                       synthesis_sample_size=self.synthesis_sample_size)
+        synthesis_key = stage_key("synthesis", classification=classification_key, llm=self._llm_name(),
+                                  token_budget=self.synthesis_token_budget or DEFAULT_TOKEN_BUDGET)
+        return {"discovery": discovery_key, "classification": classification_key, "synthesis": synthesis_key}, logs_fingerprint
+
+    def _save_last_run(self, keys, logs_fingerprint, outcome):
+        """--resume で続きから実行できるように、この実行のキーと結果を記録する"""
+        if not self.use_checkpoints:
+            return
+        self.checkpoints.save_last_run({
+            "started_at": self._report["started_at"],
+            "finished_at": datetime.now().isoformat(),
+            "outcome": outcome,
+            "keys": keys,
+            "logs_fingerprint": logs_fingerprint
+        })
+
+    def _llm_name(self):
+        if self.llm is None:
+            return "gemini-2.5-flash"
+        return getattr(self.llm, "model", None) or getattr(self.llm, "model_name", None) or type(self.llm).__name__
+
+    def _classify_by_stream(self):
+        """分類をストリームで行うか。カテゴリ発見がサンプルだけを見た場合も、分類は全ログに対して行う必要がある"""
+        return bool(self.batch_size or self.discovery_options.get("sample_size"))
+
+    def _load_discovery_logs(self):
+        """カテゴリ発見と同じログ (同じ順序) を読み込む"""
+        return sample_logs(self.logs_dir, self.discovery_options.get("sample_size"))
+
+    def _restore_category_logs(self, category_inputs, pending, discovery_logs=None):
+        """チェックポイントから復元した分類結果に、合成が必要なカテゴリのログを classified_logs.json から戻す"""
+        with open(self.classified_logs_path, 'r', encoding='utf-8') as f:
+            classified_data = json.load(f)
+        category_of = {log_id: cat_id for cat_id in pending for log_id in classified_data.get(cat_id, [])}
+        restored = {cat_id: [] for cat_id in category_inputs}
+        for log in discovery_logs if discovery_logs is not None else self._load_discovery_logs():
+            category_id = category_of.get(log['log_id'])
+            if category_id is not None:
+                restored[category_id].append(log)
+        return {cat_id: (count, restored[cat_id]) for cat_id, (count, _) in category_inputs.items()}
+
+    def _run_incremental(self):
+        manifest = PipelineManifest.load(self.state_dir)
+        if manifest is None or not os.path.exists(self.classified_logs_path):
+            print("No previous pipeline state found. Running the full pipeline.")
+            return self.run()
+        if manifest.embedding_model not in (None, self.embedding_model_name):
+            print(f"Embedding model changed ({manifest.embedding_model} -> {self.embedding_model_name}). "
+                  f"Running the full pipeline to rediscover categories.")
+            return self.run()
+
+        with open(self.classified_logs_path, 'r', encoding='utf-8') as f:
+            classified_data = json.load(f)
+        processed_ids = {log_id for log_ids in classified_data.values() for log_id in log_ids}
+
+        print(f"--- Incremental Step 1: Classifying logs newer than {manifest.watermark} ---")
+        classification_agent = ClassificationAgent(category_centroids=manifest.category_centroids(),
+                                                   embedding_model=self._embedding_model())
+        category_ids = manifest.category_ids + ["unclassified"]
+        new_ids = {cat_id: [] for cat_id in category_ids}
+        samplers = {cat_id: ReservoirSampler(self.synthesis_sample_size) for cat_id in category_ids}
+        vector_sums, vector_counts = {}, {}
+        new_total = 0
+
+        store_position = self._store_position()
+        with metrics.span("pipeline_incremental_classification"):
+            for batch in self._iter_new_log_batches(manifest.store_position, processed_ids):
+                vectors = classification_agent.embed_logs(batch)
+                results = classification_agent.classify_vectors(vectors)
+                for log, vector, (category_id, _) in zip(batch, vectors, results):
+                    new_ids[category_id].append(log['log_id'])
+                    samplers[category_id].add(log)
+                    manifest.advance_watermark(log.get('timestamp'))
+                    if category_id != "unclassified":
+                        vector_sums[category_id] = vector_sums.get(category_id, 0) + vector
+                        vector_counts[category_id] = vector_counts.get(category_id, 0) + 1
+                new_total += len(batch)
+
+        if not new_total:
+            print("No new logs since the last run. Nothing to do.")
+            self._report["outcome"] = "no_new_logs"
+            return
+
+        manifest.update_centroids(vector_sums, vector_counts)
+        manifest.logs_since_discovery += new_total
+        manifest.unclassified_since_discovery += len(new_ids["unclassified"])
+        unclassified_fraction = manifest.unclassified_fraction()
+        drift = manifest.centroid_drift()
+        self._report.update(logs=new_total, unclassified=len(new_ids["unclassified"]),
+                            unclassified_fraction=unclassified_fraction, centroid_drift=drift)
+        print(f"Classified {new_total} new logs. "
+              f"Unclassified fraction since discovery: {unclassified_fraction:.3f}, centroid drift: {drift:.4f}")
+
+        if (unclassified_fraction > self.rediscovery_unclassified_threshold
+                or drift > self.rediscovery_drift_threshold):
+            print("Rediscovery threshold exceeded. Running the full pipeline.")
+            return self.run()
+
+        # 既存の分類結果は再計算せず、新しいログIDだけを追記する
+        for category_id, log_ids in new_ids.items():
+            classified_data.setdefault(category_id, []).extend(log_ids)
+        self._write_classified_logs(classified_data)
+        print(f"Classification results patched in {self.classified_logs_path}")
+
+        print("\\n--- Incremental Step 2: Patching knowledge articles for updated categories ---")
+        failed = self._synthesize(
+            {cat_id: (len(new_ids[cat_id]), samplers[cat_id].items) for cat_id in category_ids},
+            patch=True
+        )
+
+        manifest.incremental_runs += 1
+        manifest.store_position = store_position
+        manifest.save()
+        if failed:
+            self._report.update(outcome="failed_categories", failed_categories=failed)
+            print(f"\\n--- Incremental Strategic Pipeline finished with {len(failed)} failed categories: {', '.join(sorted(failed))} ---")
+            return
+        print("\\n--- Incremental Strategic Pipeline finished successfully! ---")
+
+    def _store_position(self):
+        """ログストアの現在の追記位置 (ログストアでなければ None)"""
+        if not LogStore.is_store(self.logs_dir):
+            return None
+        return LogStore(self.logs_dir).end_position()
+
+    def _iter_new_log_batches(self, store_position, processed_ids):
+        """まだ分類していないログをバッチで返す"""
+        batch_size = self.batch_size or 1000
+        if LogStore.is_store(self.logs_dir) and store_position is not None:
+            # ログストアなら前回の追記位置より後のログだけを読む。timestampではなく追記順で絞り込むので、
+            # ウォーターマークより古いtimestampのログが遅れて届いても、ディレクトリの場合と同じく処理される
+            candidates = LogStore(self.logs_dir).scan_from_position(store_position)
+            new_logs = (log for log in candidates if log['log_id'] not in processed_ids)
+            yield from iter_batches(new_logs, batch_size)
+            return
+        for batch in iter_log_batches(self.logs_dir, batch_size):
+            new_logs = [log for log in batch if log['log_id'] not in processed_ids]
+            if new_logs:
+                yield new_logs
+
+    def _embedding_model(self):
+        return self.embedding_model or get_embedding_model(self.embedding_backend)
+
+    def _synthesize(self, category_inputs, patch=False, progress=None):
+        """カテゴリごとにナレッジ記事を生成する。patch=True なら既存の記事の追加分析の節を置き換える
+
+        カテゴリは synthesis_concurrency 件まで並行して処理し、LLMへのリクエストはトークンバケットで制限する。
+        一時的なエラーはバックオフを挟んで再試行し、それでも失敗したカテゴリは他のカテゴリを止めずに記録する。
+        progress (合成のチェックポイント) を渡すと、完了済みのカテゴリは飛ばし、完了したカテゴリを1件ずつ記録する。
+        失敗したカテゴリの {カテゴリID: エラー内容} を返す。
+        """
+        rate_limiter = None
+        if self.synthesis_requests_per_minute:
+            rate_limiter = TokenBucket.per_minute(self.synthesis_requests_per_minute)
+        agent_options = {"rate_limiter": rate_limiter, "max_retries": self.synthesis_max_retries}
+        if self.synthesis_token_budget:
+            agent_options["token_budget"] = self.synthesis_token_budget
+        synthesis_agent = KnowledgeSynthesisAgent(logs_dir=self.logs_dir, categories_path=self.categories_path,
+                                                  embedding_model=self._embedding_model(), llm=self.llm, **agent_options)
+
+        targets = []
+        for category_id, (log_count, category_logs) in category_inputs.items():
+            if not log_count:
+                print(f"\\nSkipping knowledge synthesis for empty category '{category_id}'.")
+                continue
+            if progress is not None and progress.is_done(category_id, self._article_path(category_id)):
+                print(f"\\nSkipping knowledge synthesis for '{category_id}' (already synthesized in this checkpoint).")
+                self._report["checkpoints"]["resumed_categories"] += 1
+                continue
+            targets.append((category_id, log_count, category_logs))
+
+        failed = {}
+        with metrics.span("pipeline_synthesis", items=len(targets)), \
+                ThreadPoolExecutor(max_workers=self.synthesis_concurrency) as executor:
+            futures = {
+                executor.submit(self._synthesize_category, synthesis_agent, rate_limiter,
+                                category_id, log_count, category_logs, patch): category_id
+                for category_id, log_count, category_logs in targets
+            }
+            for future in as_completed(futures):
+                category_id = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    failed[category_id] = f"{type(e).__name__}: {e}"
+                    print(f"Knowledge synthesis for '{category_id}' failed: {failed[category_id]}")
+                    continue
+                if progress is not None:
+                    progress.mark_done(category_id, self._article_path(category_id))
+        return failed
+
+    def _article_path(self, category_id):
+        return os.path.join(self.knowledge_dir, f"{category_id}_manual.md")
+
+    def _synthesize_category(self, synthesis_agent, rate_limiter, category_id, log_count, category_logs, patch):
+        """1つのカテゴリのナレッジ記事を生成し、アトミックに書き出す
+
+        patch=True なら、今回の新規ログを前回の発見以降のサンプルに合わせ、そのサンプルから追加分析を生成して
+        記事の追加分析の節を置き換える (節は1つで、サンプルは synthesis_sample_size 件まで)。
+        """
+        output_path = self._article_path(category_id)
+        sample_path = os.path.join(self.incremental_samples_dir, f"{category_id}.json")
+        if patch and os.path.exists(output_path):
+            log_count, category_logs = self._merge_incremental_sample(sample_path, log_count, category_logs)
+        else:
+            patch = False
+            # 記事を作り直すので、前の記事に対する追加分析のサンプルは捨てる
+            if os.path.exists(sample_path):
+                os.remove(sample_path)
+
+        print(f"\\nSynthesizing knowledge for '{category_id}' ({log_count} logs)...")
+
+        with metrics.span("synthesis_category", items=log_count):
+            article = call_with_retry(
+                lambda: synthesis_agent.synthesize_knowledge_for_category(category_id, logs=category_logs),
+                max_retries=self.synthesis_max_retries,
+                before_attempt=rate_limiter.acquire if rate_limiter is not None else None,
+                label=category_id
+            )
+
+        if patch:
+            with open(output_path, 'r', encoding='utf-8') as f:
+                # 前回までの追加分析の節 (以前の形式で複数ある場合はすべて) を除いた本文
+                existing = f.read().split(INCREMENTAL_SECTION_HEADING, 1)[0]
+            article = (
+                f"{existing.rstrip()}{INCREMENTAL_SECTION_HEADING}"
+                f"{datetime.now().strftime('%Y-%m-%d %H:%M')}, 前回の発見以降の新規ログ {log_count}件)\n\n"
+                f"{article}"
+            )
+
+        tmp_path = f"{output_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(article)
+        os.replace(tmp_path, output_path)
+        
+        if patch:
+            self._save_incremental_sample(sample_path, log_count, category_logs)
+        print(f"Knowledge article for '{category_id}' saved to {output_path}")
+
+    def _merge_incremental_sample(self, sample_path, log_count, category_logs):
+        """前回までのサンプルと今回の新規ログを、それぞれの件数に比例して synthesis_sample_size 件までに合わせる
+
+        (合計の件数, サンプル) を返す。
+        """
+        if not os.path.exists(sample_path):
+            return log_count, list(category_logs)[:self.synthesis_sample_size]
+        with open(sample_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        total = previous["log_count"] + log_count
+        size = self.synthesis_sample_size
+        sampler = random.Random(42)
+        keep_previous = min(len(previous["logs"]), round(size * previous["log_count"] / total))
+        new_logs = list(category_logs)
+        new_logs = sampler.sample(new_logs, min(len(new_logs), size - keep_previous))
+        keep_previous = min(len(previous["logs"]), size - len(new_logs))
+        return total, sampler.sample(previous["logs"], keep_previous) + new_logs
+
+    def _save_incremental_sample(self, sample_path, log_count, category_logs):
+        os.makedirs(self.incremental_samples_dir, exist_ok=True)
+        with open(f"{sample_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({"log_count": log_count, "logs": category_logs}, f, ensure_ascii=False, default=str)
+        os.replace(f"{sample_path}.tmp", sample_path)
+
+    def _classify_in_memory(self, classification_agent, category_ids, all_logs, discovery_result):
+        """発見ステップのベクトルをそのまま分類し、{カテゴリID: (件数, ログのリスト)} を返す
+
+        discovery_result が None (ベクトルがログと対応しない) なら、ログを埋め込み直して分類する。
+        """
+        category_logs = {cat_id: [] for cat_id in category_ids}
+        if discovery_result is None:
+            classification_results = classification_agent.classify_many(all_logs)
+        else:
+            # 発見ステップで重複を除いたベクトルだけを分類し、各ログに戻す
+            classification_results = classification_agent.classify_unique(discovery_result.unique_vectors, discovery_result.inverse)
+        for log, (category_id, _) in zip(all_logs, classification_results):
+            category_logs[category_id].append(log)
+
+        self._write_classified_logs({
+            cat_id: (log['log_id'] for log in logs) for cat_id, logs in category_logs.items()
+        })
+        watermark = max((str(log['timestamp']) for log in all_logs if log.get('timestamp')), default=None)
+        return {cat_id: (len(logs), logs) for cat_id, logs in category_logs.items()}, watermark
+
+    def _classify_streaming(self, classification_agent, category_ids):
+        """ログをバッチ単位で読み込み・埋め込み・分類し、合成用のログはカテゴリごとにサンプリングする
+
+        分類結果のログIDは一時ファイルに書き出すため、メモリ上に残るのは
+        1バッチ分のログと、カテゴリごとに最大 synthesis_sample_size 件のサンプルだけになる。
+        """
+        samplers = {cat_id: ReservoirSampler(self.synthesis_sample_size) for cat_id in category_ids}
+        spool_dir = tempfile.mkdtemp(prefix="classified_", dir=self.base_dir)
+        try:
+            spools = {
+                cat_id: open(os.path.join(spool_dir, f"{cat_id}.txt"), 'w', encoding='utf-8')
+                for cat_id in category_ids
+            }
+            try:
+                processed = 0
+                watermark = None
+                for batch in iter_log_batches(self.logs_dir, self.batch_size or 1000):
+                    results = classification_agent.classify_many(batch)
+                    for log, (category_id, _) in zip(batch, results):
+                        spools[category_id].write(f"{log['log_id']}\n")
+                        samplers[category_id].add(log)
+                        if log.get('timestamp') and (watermark is None or str(log['timestamp']) > watermark):
+                            watermark = str(log['timestamp'])
+                    processed += len(batch)
+                    print(f"Classified {processed} logs...")
+            finally:
+                for spool in spools.values():
+                    spool.close()
+
+            self._write_classified_logs({
+                cat_id: self._iter_spool(os.path.join(spool_dir, f"{cat_id}.txt")) for cat_id in category_ids
+            })
+        finally:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+        return {cat_id: (sampler.seen, sampler.items) for cat_id, sampler in samplers.items()}, watermark
+
+    @staticmethod
+    def _iter_spool(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                yield line.rstrip("\n")
+
+    def _write_classified_logs(self, classified_ids):
+        """{カテゴリID: ログIDのイテラブル} を、全件をリストにせずに classified_logs.json へ書き出す"""
+        tmp_path = f"{self.classified_logs_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("{")
+            for i, (cat_id, log_ids) in enumerate(classified_ids.items()):
+                f.write("," if i else "")
+                f.write(f"\n    {json.dumps(cat_id, ensure_ascii=False)}: [")
+                count = 0
+                for log_id in log_ids:
+                    f.write(("," if count else "") + f"\n        {json.dumps(log_id, ensure_ascii=False)}")
+                    count += 1
+                f.write("\n    ]" if count else "]")
+            f.write("\n}")
+        os.replace(tmp_path, self.classified_logs_path)
+
 
 if __name__ == '__main__':
-    pipeline = StrategicPipeline()
-    pipeline.run() 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="戦略ループのパイプラインを実行する")
+    parser.add_argument("--base-dir", default="アイデアノート/PoC_Sandbox/data",
+                        help="ログの読み込みと出力に使うデータディレクトリ")
+    parser.add_argument("--incremental", action="store_true", help="前回の実行以降に追加されたログだけを処理する")
+    parser.add_argument("--batch-size", type=int, default=None, help="ログをこの件数ずつストリームで処理する")
+    parser.add_argument("--discovery-sample-size", type=int, default=None,
+                        help="カテゴリ発見に使うログの件数 (省略時は全件、--batch-size 指定時は STREAMING_DISCOVERY_SAMPLE_SIZE)")
+    parser.add_argument("--k-selection", choices=["exhaustive", "fast"], default="exhaustive",
+                        help="カテゴリ発見のkの選び方 (fast はサンプル上で並列に試し、早期終了する)")
+    parser.add_argument("--synthesis-concurrency", type=int, default=4, help="ナレッジ合成を同時に実行するカテゴリ数")
+    parser.add_argument("--synthesis-rpm", type=float, default=None, help="ナレッジ合成でLLMに送るリクエストの上限 (毎分)")
+    parser.add_argument("--synthesis-max-retries", type=int, default=3, help="一時的なエラーで再試行する回数")
+    parser.add_argument("--synthesis-token-budget", type=int, default=None,
+                        help="ナレッジ合成の1回のプロンプトに載せるログの推定トークン数")
+    parser.add_argument("--embedding-backend", choices=BACKENDS, default=None,
+                        help="埋め込みの実装 (省略時は環境変数 EMBEDDING_BACKEND、local はネットワーク不要)")
+    parser.add_argument("--from-stage", choices=STAGES, default=None,
+                        help="このステージ以降をチェックポイントを使わずに再実行する")
+    parser.add_argument("--resume", action="store_true",
+                        help="前回の実行のカテゴリ発見の結果を使い、その実行が止まったところから続ける")
+    parser.add_argument("--no-checkpoints", action="store_true", help="ステージのチェックポイントを使わない")
+    args = parser.parse_args()
+    if args.incremental and (args.from_stage or args.resume):
+        parser.error("--from-stage and --resume cannot be combined with --incremental")
+
+    # ストリーム処理では、カテゴリ発見もサンプルに限って全ログをメモリに載せない
+    discovery_sample_size = args.discovery_sample_size
+    if discovery_sample_size is None and args.batch_size:
+        discovery_sample_size = STREAMING_DISCOVERY_SAMPLE_SIZE
+    discovery_options = {"k_selection": args.k_selection}
+    if discovery_sample_size is not None:
+        discovery_options["sample_size"] = discovery_sample_size
+
+    pipeline = StrategicPipeline(
+        base_dir=args.base_dir,
+        discovery_options=discovery_options,
+        batch_size=args.batch_size,
+        synthesis_concurrency=args.synthesis_concurrency,
+        synthesis_requests_per_minute=args.synthesis_rpm,
+        synthesis_max_retries=args.synthesis_max_retries,
+        synthesis_token_budget=args.synthesis_token_budget,
+        embedding_backend=args.embedding_backend,
+        use_checkpoints=not args.no_checkpoints
+    )
+    if args.incremental:
+        pipeline.run_incremental()
+    else:
+        pipeline.run(from_stage=args.from_stage, resume=args.resume)
\ No newline at end of file